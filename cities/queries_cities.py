@@ -1,4 +1,4 @@
-from functools import wraps
+import data.cache as dcache
 import data.db_connect as dbc
 COLLECTION = 'cities'
 
@@ -12,6 +12,9 @@ FOUNDED = 'founded'
 MAYOR = 'mayor'
 STATE_CODE = 'state_code'
 
+# bulk update items look like {NAME: ..., FIELDS: {...}}
+FIELDS = 'fields'
+
 SAMPLE_CITY = {
     NAME: 'New York City',
     POPULATION: '8,478,000',
@@ -23,22 +26,29 @@ SAMPLE_CITY = {
 }
 
 
-city_cache = {
-    1: SAMPLE_CITY
-}
+INDEXES = [
+    {dbc.INDEX_KEYS: [(ID, dbc.ASCENDING)]},
+    # the sorts we page through end in _id: see `dbc.page_sort()`
+    {dbc.INDEX_KEYS: [(NAME, dbc.ASCENDING), (dbc.MONGO_ID, dbc.ASCENDING)]},
+    # for ?collation=ci
+    {dbc.INDEX_KEYS: [(NAME, dbc.ASCENDING), (dbc.MONGO_ID, dbc.ASCENDING)],
+     dbc.INDEX_COLLATION: dbc.CI_COLLATION},
+    {dbc.INDEX_KEYS: [(STATE_CODE, dbc.ASCENDING), (NAME, dbc.ASCENDING),
+                      (dbc.MONGO_ID, dbc.ASCENDING)]},
+]
+dbc.register_indexes(COLLECTION, INDEXES)
 
+# what the cache keeps a slot for in each record
+RECORD_FIELDS = (ID, NAME, POPULATION, STATE, STATE_CODE, AREA,
+                 FOUNDED, MAYOR)
 
-def needs_cache(fn):
-    @wraps(fn)
-    def wrapper(*args, **kwargs):
-        if not city_cache:
-            docs = dbc.read(COLLECTION)
-            for doc in docs:
-                county_id = doc.get(ID)
-                if county_id is not None:
-                    city_cache[county_id] = doc
-        return fn(*args, **kwargs)
-    return wrapper
+city_cache = dcache.EntityCache(COLLECTION, id_field=ID,
+                                index_on=[(NAME,), (NAME, STATE_CODE),
+                                          (STATE_CODE,)],
+                                record_fields=RECORD_FIELDS,
+                                sorted_on=NAME)
+needs_cache = dcache.needs_cache(city_cache)
+writes = dcache.writes(city_cache)
 
 
 def is_valid_id(_id: str):
@@ -54,7 +64,7 @@ def num_cities():
     return len(city_cache)
 
 
-def create(fields: dict):
+def validate_create(fields: dict):
     if (not isinstance(fields, dict)):
         raise ValueError(f'Bad type for {type(fields)=}')
     if (not fields.get(NAME)):
@@ -65,17 +75,83 @@ def create(fields: dict):
         raise ValueError(
             f'Bad value for {fields.get(STATE_CODE)=}'
         )
+
+
+@writes
+def create(fields: dict):
+    validate_create(fields)
     new_id = dbc.create(COLLECTION, fields)
-    city_cache[new_id] = fields
+    city_cache[new_id] = dcache.record(fields)
     return new_id
 
 
-@needs_cache
-def read(city_id=None):
-    return dbc.read(COLLECTION)
+def read(city_id=None, filt=None, fields=None, sort=None, limit=0,
+         collation=None):
+    """
+    With an id, the one city (or None), from the cache if we can.
+    Otherwise filter, projection, sort and limit are all passed down to
+    the db.
+    """
+    if city_id is not None:
+        return city_cache.fetch(city_id)
+    return dbc.read(COLLECTION, filt=filt, fields=fields, sort=sort,
+                    limit=limit, collation=collation)
 
 
-def update(name: str, fields: dict):
+def read_range(start=None, end=None, filt=None, fields=None, sort=None,
+               limit=0, collation=None) -> list:
+    """
+    The cities named from `start` up to (not including) `end`; see
+    `dcache.read_range()`.
+    """
+    return dcache.read_range(city_cache, start=start, end=end, filt=filt,
+                             fields=fields, sort=sort, limit=limit,
+                             collation=collation)
+
+
+def read_iter(filt=None, fields=None, sort=None, limit=0, collation=None):
+    """
+    Stream docs from the db rather than building a list.
+    """
+    return dbc.read_iter(COLLECTION, filt=filt, fields=fields, sort=sort,
+                         limit=limit, collation=collation)
+
+
+def read_json_iter(filt=None, fields=None, sort=None, limit=0,
+                   collation=None):
+    """
+    Stream docs as JSON strings, never decoding them into dicts if we
+    can help it; see `dbc.read_json_iter()`.
+    """
+    return dbc.read_json_iter(COLLECTION, filt=filt, fields=fields,
+                              sort=sort, limit=limit, collation=collation)
+
+
+def read_page(filt=None, fields=None, sort=None,
+              limit=dbc.DEFAULT_PAGE_SIZE, after=None,
+              collation=None) -> tuple:
+    """
+    One page of docs, plus the cursor for the next; see `dbc.read_page()`.
+    """
+    return dbc.read_page(COLLECTION, filt=filt, fields=fields, sort=sort,
+                         limit=limit, after=after, collation=collation)
+
+
+def count(filt=None) -> int:
+    """
+    Counted by the db, without fetching any docs.
+    """
+    return dbc.count(COLLECTION, filt=filt)
+
+
+def count_by(field: str, filt=None) -> dict:
+    """
+    {value of `field`: number of docs}, grouped by the db.
+    """
+    return dbc.group_count(COLLECTION, field, filt=filt)
+
+
+def validate_update(name: str, fields: dict):
     if not isinstance(fields, dict):
         raise ValueError(f'Bad type for {type(fields)=}')
     if not name or not isinstance(name, str):
@@ -105,22 +181,89 @@ def update(name: str, fields: dict):
                             not isinstance(fields[MAYOR], str)):
         raise ValueError(f'Bad value for {fields.get(MAYOR)=}')
 
+
+@writes
+def update(name: str, fields: dict):
+    validate_update(name, fields)
     result = dbc.update(COLLECTION, {NAME: name}, fields)
     if result < 1:
         raise ValueError(f'City not found: {name}')
 
-    # Update cache
-    if city_cache:
-        for key, city in city_cache.items():
-            if city.get(NAME) == name:
-                city_cache[key].update(fields)
-                break
-
+    update_cache(name, fields)
     return result
 
 
+def update_cache(name: str, fields: dict):
+    city_cache.update_one({NAME: name}, fields)
+
+
+@writes
 def delete(name: str):
     result = dbc.delete(COLLECTION, {NAME: name})
     if result < 1:
         raise ValueError(f'City not found: {name}')
+    drop_cache(name)
     return result
+
+
+def drop_cache(name: str):
+    city_cache.delete_one({NAME: name})
+
+
+@writes
+def create_many(recs: list, ordered: bool = True) -> list:
+    """
+    Validate and insert a batch of cities in one go.
+    Returns one result per record: {dbc.BULK_ID: ...} or
+    {dbc.BULK_ERROR: ...}.
+    """
+    results = dbc.create_many(COLLECTION, recs, ordered=ordered,
+                              validate=validate_create)
+    city_cache.update({res[dbc.BULK_ID]: dcache.record(rec)
+                       for rec, res in zip(recs, results)
+                       if dbc.BULK_ID in res})
+    return results
+
+
+def update_op(item: dict) -> tuple:
+    if not isinstance(item, dict):
+        raise ValueError(f'Bad type for {type(item)=}')
+    validate_update(item.get(NAME), item.get(FIELDS))
+    return (dbc.UPDATE, {NAME: item[NAME]}, item[FIELDS])
+
+
+@writes
+def update_many(items: list, ordered: bool = True) -> dict:
+    """
+    Apply a batch of {NAME: ..., FIELDS: {...}} updates with one
+    bulk write, then bring the cache up to date.
+    """
+    ret = dbc.bulk_write(COLLECTION, items, ordered=ordered,
+                         make_op=update_op)
+    failed = {err[dbc.BULK_INDEX] for err in ret[dbc.BULK_ERRORS]}
+    for i, item in enumerate(items):
+        if i not in failed:
+            update_cache(item[NAME], item[FIELDS])
+    return ret
+
+
+def delete_op(item: dict) -> tuple:
+    if not isinstance(item, dict):
+        raise ValueError(f'Bad type for {type(item)=}')
+    if not item.get(NAME) or not isinstance(item[NAME], str):
+        raise ValueError(f'Bad value for {item.get(NAME)=}')
+    return (dbc.DELETE, {NAME: item[NAME]})
+
+
+@writes
+def delete_many(items: list, ordered: bool = True) -> dict:
+    """
+    Delete a batch of {NAME: ...} cities with one bulk write.
+    """
+    ret = dbc.bulk_write(COLLECTION, items, ordered=ordered,
+                         make_op=delete_op)
+    failed = {err[dbc.BULK_INDEX] for err in ret[dbc.BULK_ERRORS]}
+    for i, item in enumerate(items):
+        if i not in failed:
+            drop_cache(item[NAME])
+    return ret
@@ -0,0 +1,46 @@
+"""
+Coroutine versions of the queries in queries_cities.py, for use from an
+async worker. Validation and the cache are shared with that module.
+"""
+import data.cache as dcache
+import data.db_connect_async as dbca
+import cities.queries_cities as qry
+
+
+@qry.writes
+async def create(fields: dict):
+    qry.validate_create(fields)
+    new_id = await dbca.create(qry.COLLECTION, fields)
+    qry.city_cache[new_id] = dcache.record(fields)
+    return new_id
+
+
+async def read(city_id=None, filt=None, fields=None, sort=None, limit=0,
+               collation=None):
+    """
+    With an id, the one city (or None), from the cache if we can.
+    Otherwise everything is passed down to the db.
+    """
+    if city_id is not None:
+        return await qry.city_cache.fetch_async(city_id)
+    return await dbca.read(qry.COLLECTION, filt=filt, fields=fields,
+                           sort=sort, limit=limit, collation=collation)
+
+
+@qry.writes
+async def update(name: str, fields: dict):
+    qry.validate_update(name, fields)
+    result = await dbca.update(qry.COLLECTION, {qry.NAME: name}, fields)
+    if result < 1:
+        raise ValueError(f'City not found: {name}')
+    qry.update_cache(name, fields)
+    return result
+
+
+@qry.writes
+async def delete(name: str):
+    result = await dbca.delete(qry.COLLECTION, {qry.NAME: name})
+    if result < 1:
+        raise ValueError(f'City not found: {name}')
+    qry.drop_cache(name)
+    return result
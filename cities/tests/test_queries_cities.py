@@ -142,4 +142,78 @@ def test_city_has_valid_mayor():
     test_mayor = test_city.get(qry.MAYOR)
     assert test_mayor == 'Richard', f"Expected mayor 'Richard, got '{test_mayor}'"
     assert isinstance(test_mayor, str), "Mayor name should be a string"
-    assert len(test_mayor) > 0, "Mayor name should not be empty"
\ No newline at end of file
+    assert len(test_mayor) > 0, "Mayor name should not be empty"
+
+@patch('data.db_connect.read')
+def test_read_pushes_down_filter(mock_dbc_read):
+    mock_dbc_read.return_value = [{qry.NAME: 'New York City'}]
+    ret = qry.read(filt={qry.STATE_CODE: 'NY'}, fields=[qry.NAME], limit=10)
+    assert ret == [{qry.NAME: 'New York City'}]
+    mock_dbc_read.assert_called_once_with(qry.COLLECTION,
+                                          filt={qry.STATE_CODE: 'NY'},
+                                          fields=[qry.NAME], sort=None,
+                                          limit=10, collation=None)
+
+
+def test_read_by_id(temp_city):
+    assert qry.read(temp_city) == create_temp_city()
+    qry.city_cache.invalidate(temp_city)
+    assert qry.read(temp_city) == create_temp_city()  # from the db
+    assert temp_city in qry.city_cache
+
+
+@patch('data.db_connect.read_one', return_value=None)
+def test_read_by_id_not_found(mock_read_one):
+    assert qry.read('5f1d7f1e9d3b2a0012345678') is None
+    assert mock_read_one.call_count == 2  # by _id, then by id
+
+
+def test_update_and_delete_keep_cache():
+    city = create_temp_city()
+    city[qry.NAME] = 'Cache Test City'
+    new_id = qry.create(city)
+    qry.update(city[qry.NAME], {qry.MAYOR: 'Someone'})
+    assert qry.read(new_id)[qry.MAYOR] == 'Someone'
+    qry.delete(city[qry.NAME])
+    assert new_id not in qry.city_cache
+
+
+def test_read_range():
+    city = create_temp_city()
+    city[qry.NAME] = 'Zz Range Test City'
+    new_id = qry.create(city)
+    names = [doc[qry.NAME] for doc in qry.read_range('Zz', 'Zzz')]
+    assert names == [city[qry.NAME]]
+    qry.delete(city[qry.NAME])
+    assert qry.read_range('Zz', 'Zzz') == []
+    assert new_id not in qry.city_cache
+
+
+def test_count_after_invalidate_and_create():
+    first = create_temp_city()
+    first[qry.NAME] = 'Count Test City'
+    qry.create(first)
+    qry.city_cache.invalidate()
+    city = create_temp_city()
+    city[qry.NAME] = 'Count Test City 2'
+    qry.create(city)  # the only record cached now
+    try:
+        assert qry.num_cities() == qry.dbc.count(qry.COLLECTION)
+    finally:
+        qry.delete(first[qry.NAME])
+        qry.delete(city[qry.NAME])
+
+
+@patch('data.db_connect.create_many')
+def test_create_many_updates_cache(mock_create_many):
+    mock_create_many.return_value = [{'id': 'bulk1'}, {'error': 'bad'}]
+    recs = [create_temp_city(), {}]
+    results = qry.create_many(recs)
+    assert results == mock_create_many.return_value
+    assert qry.city_cache['bulk1'] == recs[0]
+    del qry.city_cache['bulk1']
+
+
+def test_update_op_bad_item():
+    with pytest.raises(ValueError):
+        qry.update_op({qry.NAME: 'Albany', qry.FIELDS: {qry.MAYOR: 7}})
@@ -0,0 +1,60 @@
+import asyncio
+from copy import deepcopy
+from unittest.mock import AsyncMock, patch
+
+import pytest
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import queries_cities_async as aqry
+
+qry = aqry.qry
+
+
+@patch('data.db_connect_async.create', new_callable=AsyncMock)
+def test_create(mock_create):
+    mock_create.return_value = 'async-id'
+    city = deepcopy(qry.SAMPLE_CITY)
+    assert asyncio.run(aqry.create(city)) == 'async-id'
+    assert qry.city_cache['async-id'] == city
+    del qry.city_cache['async-id']
+
+
+def test_create_bad_param_type():
+    with pytest.raises(ValueError):
+        asyncio.run(aqry.create([1, 2, 3]))
+
+
+@patch('data.db_connect_async.read', new_callable=AsyncMock)
+def test_read(mock_read):
+    mock_read.return_value = [qry.SAMPLE_CITY]
+    assert asyncio.run(aqry.read(filt={qry.STATE_CODE: 'NY'})) == [
+        qry.SAMPLE_CITY]
+
+
+@patch('data.db_connect_async.read', new_callable=AsyncMock)
+def test_read_collation(mock_read):
+    mock_read.return_value = []
+    asyncio.run(aqry.read(sort=[(qry.NAME, 1)],
+                          collation=qry.dbc.CI_COLLATION))
+    assert mock_read.call_args.kwargs['collation'] == qry.dbc.CI_COLLATION
+
+
+@patch('data.db_connect_async.delete', new_callable=AsyncMock)
+def test_delete_not_there(mock_delete):
+    mock_delete.return_value = 0
+    with pytest.raises(ValueError):
+        asyncio.run(aqry.delete('Atlantis'))
+
+
+@patch('data.db_connect_async.read_one', new_callable=AsyncMock)
+def test_read_by_id(mock_read_one):
+    oid = '5f1d7f1e9d3b2a00123456a1'
+    mock_read_one.return_value = {qry.dbc.MONGO_ID: oid, **qry.SAMPLE_CITY}
+    assert asyncio.run(aqry.read(oid)) == qry.SAMPLE_CITY
+    assert asyncio.run(aqry.read(oid)) == qry.SAMPLE_CITY  # now cached
+    mock_read_one.assert_called_once()
+    del qry.city_cache[oid]
@@ -1,4 +1,4 @@
-from functools import wraps
+import data.cache as dcache
 import data.db_connect as dbc
 
 COLLECTION = 'counties'
@@ -13,6 +13,9 @@ FOUNDED = 'founded'
 COUNTY_SEAT = 'county_seat'
 STATE_CODE = 'STATE_CODE'
 
+# bulk update items look like {NAME: ..., STATE_CODE: ..., FIELDS: {...}}
+FIELDS = 'fields'
+
 SAMPLE_COUNTY = {
     NAME: 'Los Angeles County',
     POPULATION: 10000000,
@@ -23,22 +26,33 @@ SAMPLE_COUNTY = {
     STATE_CODE: 'CA'
 }
 
-county_cache = {
-    1: SAMPLE_COUNTY,
-}
-
-
-def needs_cache(fn):
-    @wraps(fn)
-    def wrapper(*args, **kwargs):
-        if not county_cache:
-            docs = dbc.read(COLLECTION)
-            for doc in docs:
-                county_id = doc.get(ID)
-                if county_id is not None:
-                    county_cache[county_id] = doc
-        return fn(*args, **kwargs)
-    return wrapper
+# read() looks a county up by ID; update() and delete() find one by
+# (NAME, STATE_CODE)
+INDEXES = [
+    {dbc.INDEX_KEYS: [(ID, dbc.ASCENDING)]},
+    # the sorts we page through end in _id: see `dbc.page_sort()`
+    {dbc.INDEX_KEYS: [(NAME, dbc.ASCENDING), (dbc.MONGO_ID, dbc.ASCENDING)]},
+    # for ?collation=ci
+    {dbc.INDEX_KEYS: [(NAME, dbc.ASCENDING), (dbc.MONGO_ID, dbc.ASCENDING)],
+     dbc.INDEX_COLLATION: dbc.CI_COLLATION},
+    {dbc.INDEX_KEYS: [(STATE_CODE, dbc.ASCENDING), (NAME, dbc.ASCENDING)],
+     dbc.INDEX_UNIQUE: True},
+    {dbc.INDEX_KEYS: [(STATE_CODE, dbc.ASCENDING), (NAME, dbc.ASCENDING),
+                      (dbc.MONGO_ID, dbc.ASCENDING)]},
+]
+dbc.register_indexes(COLLECTION, INDEXES)
+
+# what the cache keeps a slot for in each record
+RECORD_FIELDS = (ID, NAME, POPULATION, STATE, STATE_CODE, AREA,
+                 FOUNDED, COUNTY_SEAT)
+
+county_cache = dcache.EntityCache(COLLECTION, id_field=ID,
+                                  index_on=[(NAME,), (NAME, STATE_CODE),
+                                            (STATE_CODE,)],
+                                  record_fields=RECORD_FIELDS,
+                                  sorted_on=NAME)
+needs_cache = dcache.needs_cache(county_cache)
+writes = dcache.writes(county_cache)
 
 
 def is_valid_id(_id: str):
@@ -62,7 +76,7 @@ def is_valid_population(_population):
     return True
 
 
-def create(fields: dict):
+def validate_create(fields: dict):
 
     if not isinstance(fields, dict):
         raise ValueError(f'Bad type for {type(fields)=}')
@@ -85,17 +99,82 @@ def create(fields: dict):
     if not fields.get(COUNTY_SEAT) or not isinstance(fields[COUNTY_SEAT], str):
         raise ValueError(f'Bad value for {fields.get(COUNTY_SEAT)=}')
 
+
+@writes
+def create(fields: dict):
+    validate_create(fields)
     new_id = dbc.create(COLLECTION, fields)
-    county_cache[new_id] = fields
+    county_cache[new_id] = dcache.record(fields)
     return new_id
 
 
-@needs_cache
-def read(county_id=None):
-    return dbc.read(COLLECTION)
-
-
-def update(name: str, state_code: str, fields: dict):
+def read(county_id=None, filt=None, fields=None, sort=None, limit=0,
+         collation=None):
+    """
+    With an id, the one county (or None), from the cache if we can.
+    Otherwise filter, projection, sort and limit are all passed down to
+    the db.
+    """
+    if county_id is not None:
+        return county_cache.fetch(county_id)
+    return dbc.read(COLLECTION, filt=filt, fields=fields, sort=sort,
+                    limit=limit, collation=collation)
+
+
+def read_range(start=None, end=None, filt=None, fields=None, sort=None,
+               limit=0, collation=None) -> list:
+    """
+    The counties named from `start` up to (not including) `end`; see
+    `dcache.read_range()`.
+    """
+    return dcache.read_range(county_cache, start=start, end=end, filt=filt,
+                             fields=fields, sort=sort, limit=limit,
+                             collation=collation)
+
+
+def read_iter(filt=None, fields=None, sort=None, limit=0, collation=None):
+    """
+    Stream docs from the db rather than building a list.
+    """
+    return dbc.read_iter(COLLECTION, filt=filt, fields=fields, sort=sort,
+                         limit=limit, collation=collation)
+
+
+def read_json_iter(filt=None, fields=None, sort=None, limit=0,
+                   collation=None):
+    """
+    Stream docs as JSON strings, never decoding them into dicts if we
+    can help it; see `dbc.read_json_iter()`.
+    """
+    return dbc.read_json_iter(COLLECTION, filt=filt, fields=fields,
+                              sort=sort, limit=limit, collation=collation)
+
+
+def read_page(filt=None, fields=None, sort=None,
+              limit=dbc.DEFAULT_PAGE_SIZE, after=None,
+              collation=None) -> tuple:
+    """
+    One page of docs, plus the cursor for the next; see `dbc.read_page()`.
+    """
+    return dbc.read_page(COLLECTION, filt=filt, fields=fields, sort=sort,
+                         limit=limit, after=after, collation=collation)
+
+
+def count(filt=None) -> int:
+    """
+    Counted by the db, without fetching any docs.
+    """
+    return dbc.count(COLLECTION, filt=filt)
+
+
+def count_by(field: str, filt=None) -> dict:
+    """
+    {value of `field`: number of docs}, grouped by the db.
+    """
+    return dbc.group_count(COLLECTION, field, filt=filt)
+
+
+def validate_update(name: str, state_code: str, fields: dict):
     if not isinstance(fields, dict):
         raise ValueError(f'Bad type for {type(fields)=}')
     if not name or not isinstance(name, str):
@@ -126,24 +205,94 @@ def update(name: str, state_code: str, fields: dict):
                                  not isinstance(fields[STATE_CODE], str)):
         raise ValueError(f'Bad value for {fields.get(STATE_CODE)=}')
 
+
+@writes
+def update(name: str, state_code: str, fields: dict):
+    validate_update(name, state_code, fields)
     result = dbc.update(COLLECTION, {NAME: name, STATE_CODE: state_code},
                         fields)
     if result < 1:
         raise ValueError(f'County not found: {name}, {state_code}')
 
-    # Update cache
-    if county_cache:
-        for key, county in county_cache.items():
-            if (county.get(NAME) == name and
-                    county.get(STATE_CODE) == state_code):
-                county_cache[key].update(fields)
-                break
-
+    update_cache(name, state_code, fields)
     return result
 
 
+def update_cache(name: str, state_code: str, fields: dict):
+    county_cache.update_one({NAME: name, STATE_CODE: state_code}, fields)
+
+
+@writes
 def delete(name: str, state_code: str):
     result = dbc.delete(COLLECTION, {NAME: name, STATE_CODE: state_code})
     if result < 1:
         raise ValueError(f'County not found: {name}, {state_code}')
+    drop_cache(name, state_code)
     return result
+
+
+def drop_cache(name: str, state_code: str):
+    county_cache.delete_one({NAME: name, STATE_CODE: state_code})
+
+
+@writes
+def create_many(recs: list, ordered: bool = True) -> list:
+    """
+    Validate and insert a batch of counties in one go.
+    Returns one result per record: {dbc.BULK_ID: ...} or
+    {dbc.BULK_ERROR: ...}.
+    """
+    results = dbc.create_many(COLLECTION, recs, ordered=ordered,
+                              validate=validate_create)
+    county_cache.update({res[dbc.BULK_ID]: dcache.record(rec)
+                         for rec, res in zip(recs, results)
+                         if dbc.BULK_ID in res})
+    return results
+
+
+def update_op(item: dict) -> tuple:
+    if not isinstance(item, dict):
+        raise ValueError(f'Bad type for {type(item)=}')
+    validate_update(item.get(NAME), item.get(STATE_CODE), item.get(FIELDS))
+    return (dbc.UPDATE, {NAME: item[NAME], STATE_CODE: item[STATE_CODE]},
+            item[FIELDS])
+
+
+@writes
+def update_many(items: list, ordered: bool = True) -> dict:
+    """
+    Apply a batch of {NAME: ..., STATE_CODE: ..., FIELDS: {...}} updates
+    with one bulk write, then bring the cache up to date.
+    """
+    ret = dbc.bulk_write(COLLECTION, items, ordered=ordered,
+                         make_op=update_op)
+    failed = {err[dbc.BULK_INDEX] for err in ret[dbc.BULK_ERRORS]}
+    for i, item in enumerate(items):
+        if i not in failed:
+            update_cache(item[NAME], item[STATE_CODE], item[FIELDS])
+    return ret
+
+
+def delete_op(item: dict) -> tuple:
+    if not isinstance(item, dict):
+        raise ValueError(f'Bad type for {type(item)=}')
+    if not item.get(NAME) or not isinstance(item[NAME], str):
+        raise ValueError(f'Bad value for {item.get(NAME)=}')
+    if not item.get(STATE_CODE) or not isinstance(item[STATE_CODE], str):
+        raise ValueError(f'Bad value for {item.get(STATE_CODE)=}')
+    return (dbc.DELETE, {NAME: item[NAME], STATE_CODE: item[STATE_CODE]})
+
+
+@writes
+def delete_many(items: list, ordered: bool = True) -> dict:
+    """
+    Delete a batch of {NAME: ..., STATE_CODE: ...} counties with one
+    bulk write.
+    """
+    ret = dbc.bulk_write(COLLECTION, items, ordered=ordered,
+                         make_op=delete_op)
+    failed = {err[dbc.BULK_INDEX] for err in ret[dbc.BULK_ERRORS]}
+    for i, item in enumerate(items):
+        if i not in failed:
+            drop_cache(item[NAME], item[STATE_CODE])
+    return ret
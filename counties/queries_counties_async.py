@@ -0,0 +1,49 @@
+"""
+Coroutine versions of the queries in queries_counties.py, for use from
+an async worker. Validation and the cache are shared with that module.
+"""
+import data.cache as dcache
+import data.db_connect_async as dbca
+import counties.queries_counties as qry
+
+
+@qry.writes
+async def create(fields: dict):
+    qry.validate_create(fields)
+    new_id = await dbca.create(qry.COLLECTION, fields)
+    qry.county_cache[new_id] = dcache.record(fields)
+    return new_id
+
+
+async def read(county_id=None, filt=None, fields=None, sort=None, limit=0,
+               collation=None):
+    """
+    With an id, the one county (or None), from the cache if we can.
+    Otherwise everything is passed down to the db.
+    """
+    if county_id is not None:
+        return await qry.county_cache.fetch_async(county_id)
+    return await dbca.read(qry.COLLECTION, filt=filt, fields=fields,
+                           sort=sort, limit=limit, collation=collation)
+
+
+@qry.writes
+async def update(name: str, state_code: str, fields: dict):
+    qry.validate_update(name, state_code, fields)
+    result = await dbca.update(qry.COLLECTION,
+                               {qry.NAME: name, qry.STATE_CODE: state_code},
+                               fields)
+    if result < 1:
+        raise ValueError(f'County not found: {name}, {state_code}')
+    qry.update_cache(name, state_code, fields)
+    return result
+
+
+@qry.writes
+async def delete(name: str, state_code: str):
+    result = await dbca.delete(qry.COLLECTION,
+                               {qry.NAME: name, qry.STATE_CODE: state_code})
+    if result < 1:
+        raise ValueError(f'County not found: {name}, {state_code}')
+    qry.drop_cache(name, state_code)
+    return result
@@ -0,0 +1,47 @@
+import asyncio
+from copy import deepcopy
+from unittest.mock import AsyncMock, patch
+
+import pytest
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import queries_counties_async as aqry
+
+qry = aqry.qry
+
+
+@patch('data.db_connect_async.create', new_callable=AsyncMock)
+def test_create(mock_create):
+    mock_create.return_value = 'async-id'
+    county = deepcopy(qry.SAMPLE_COUNTY)
+    assert asyncio.run(aqry.create(county)) == 'async-id'
+    assert qry.county_cache['async-id'] == county
+    del qry.county_cache['async-id']
+
+
+def test_create_bad_population():
+    county = deepcopy(qry.SAMPLE_COUNTY)
+    county[qry.POPULATION] = 'lots'
+    with pytest.raises(ValueError):
+        asyncio.run(aqry.create(county))
+
+
+@patch('data.db_connect_async.update', new_callable=AsyncMock)
+def test_update_not_there(mock_update):
+    mock_update.return_value = 0
+    with pytest.raises(ValueError):
+        asyncio.run(aqry.update('Nowhere County', 'CA', {}))
+
+
+@patch('data.db_connect_async.read_one', new_callable=AsyncMock)
+def test_read_by_id(mock_read_one):
+    oid = '5f1d7f1e9d3b2a00123456a2'
+    mock_read_one.return_value = {qry.dbc.MONGO_ID: oid, **qry.SAMPLE_COUNTY}
+    assert asyncio.run(aqry.read(oid)) == qry.SAMPLE_COUNTY
+    assert asyncio.run(aqry.read(oid)) == qry.SAMPLE_COUNTY  # now cached
+    mock_read_one.assert_called_once()
+    del qry.county_cache[oid]
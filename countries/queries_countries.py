@@ -1,7 +1,6 @@
+import data.cache as dcache
 import data.db_connect as dbc
 
-from functools import wraps
-
 COUNTRIES_COLLECTION = "countries"
 
 MIN_ID_LEN = 1
@@ -15,6 +14,9 @@ AREA = 'area'
 FOUNDED = 'founded'
 PRESIDENT = 'president'
 
+# bulk update items look like {NAME: ..., FIELDS: {...}}
+FIELDS = 'fields'
+
 
 SAMPLE_COUNTRY = {
     NAME: 'United States of America',
@@ -28,22 +30,27 @@ SAMPLE_COUNTRY = {
 }
 
 
-country_cache = None
+INDEXES = [
+    {dbc.INDEX_KEYS: [(ID, dbc.ASCENDING)]},
+    # the sorts we page through end in _id: see `dbc.page_sort()`
+    {dbc.INDEX_KEYS: [(NAME, dbc.ASCENDING), (dbc.MONGO_ID, dbc.ASCENDING)]},
+    # for ?collation=ci
+    {dbc.INDEX_KEYS: [(NAME, dbc.ASCENDING), (dbc.MONGO_ID, dbc.ASCENDING)],
+     dbc.INDEX_COLLATION: dbc.CI_COLLATION},
+]
+dbc.register_indexes(COUNTRIES_COLLECTION, INDEXES)
+
 
+# what the cache keeps a slot for in each record
+RECORD_FIELDS = (ID, NAME, POPULATION, CONTENTIENT, CAPITAL, GDP,
+                 AREA, FOUNDED, PRESIDENT)
 
-def needs_cache(fn):
-    @wraps(fn)
-    def wrapper(*args, **kwargs):
-        global country_cache
-        if not country_cache:
-            country_cache = {}
-            docs = dbc.read(COUNTRIES_COLLECTION)
-            for doc in docs:
-                country_id = doc.get(ID)
-                if country_id is not None:
-                    country_cache[country_id] = doc
-        return fn(*args, **kwargs)
-    return wrapper
+country_cache = dcache.EntityCache(COUNTRIES_COLLECTION, id_field=ID,
+                                   index_on=[(NAME,)],
+                                   record_fields=RECORD_FIELDS,
+                                   sorted_on=NAME)
+needs_cache = dcache.needs_cache(country_cache)
+writes = dcache.writes(country_cache)
 
 
 def is_valid_id(_id: str):
@@ -67,7 +74,7 @@ def num_countries():
     return len(country_cache)
 
 
-def create(fields: dict):
+def validate_create(fields: dict):
     if (not isinstance(fields, dict)):
         raise ValueError(f'Bad type for {type(fields)=}')
     if (not fields.get(NAME) or not isinstance(fields[NAME], str)):
@@ -87,17 +94,84 @@ def create(fields: dict):
         raise ValueError(f'Bad value for {fields.get(FOUNDED)=}')
     if (not fields.get(PRESIDENT) or not isinstance(fields[PRESIDENT], str)):
         raise ValueError(f'Bad value for {fields.get(PRESIDENT)=}')
+
+
+@writes
+def create(fields: dict):
+    validate_create(fields)
     new_id = dbc.create(COUNTRIES_COLLECTION, fields)
-    country_cache[new_id] = fields
+    country_cache[new_id] = dcache.record(fields)
     return new_id
 
 
-@needs_cache
-def read(country_id=None):
-    return dbc.read(COUNTRIES_COLLECTION)
+def read(country_id=None, filt=None, fields=None, sort=None, limit=0,
+         collation=None):
+    """
+    With an id, the one country (or None), from the cache if we can.
+    Otherwise filter, projection, sort and limit are all passed down to
+    the db.
+    """
+    if country_id is not None:
+        return country_cache.fetch(country_id)
+    return dbc.read(COUNTRIES_COLLECTION, filt=filt, fields=fields, sort=sort,
+                    limit=limit, collation=collation)
 
 
-def update(name: str, fields: dict):
+def read_range(start=None, end=None, filt=None, fields=None, sort=None,
+               limit=0, collation=None) -> list:
+    """
+    The countries named from `start` up to (not including) `end`; see
+    `dcache.read_range()`.
+    """
+    return dcache.read_range(country_cache, start=start, end=end, filt=filt,
+                             fields=fields, sort=sort, limit=limit,
+                             collation=collation)
+
+
+def read_iter(filt=None, fields=None, sort=None, limit=0, collation=None):
+    """
+    Stream docs from the db rather than building a list.
+    """
+    return dbc.read_iter(COUNTRIES_COLLECTION, filt=filt, fields=fields,
+                         sort=sort, limit=limit, collation=collation)
+
+
+def read_json_iter(filt=None, fields=None, sort=None, limit=0,
+                   collation=None):
+    """
+    Stream docs as JSON strings, never decoding them into dicts if we
+    can help it; see `dbc.read_json_iter()`.
+    """
+    return dbc.read_json_iter(COUNTRIES_COLLECTION, filt=filt, fields=fields,
+                              sort=sort, limit=limit, collation=collation)
+
+
+def read_page(filt=None, fields=None, sort=None,
+              limit=dbc.DEFAULT_PAGE_SIZE, after=None,
+              collation=None) -> tuple:
+    """
+    One page of docs, plus the cursor for the next; see `dbc.read_page()`.
+    """
+    return dbc.read_page(COUNTRIES_COLLECTION, filt=filt, fields=fields,
+                         sort=sort, limit=limit, after=after,
+                         collation=collation)
+
+
+def count(filt=None) -> int:
+    """
+    Counted by the db, without fetching any docs.
+    """
+    return dbc.count(COUNTRIES_COLLECTION, filt=filt)
+
+
+def count_by(field: str, filt=None) -> dict:
+    """
+    {value of `field`: number of docs}, grouped by the db.
+    """
+    return dbc.group_count(COUNTRIES_COLLECTION, field, filt=filt)
+
+
+def validate_update(name: str, fields: dict):
     if not isinstance(fields, dict):
         raise ValueError(f'Bad type for {type(fields)=}')
     if not name or not isinstance(name, str):
@@ -129,19 +203,89 @@ def update(name: str, fields: dict):
                                 not isinstance(fields[PRESIDENT], str)):
         raise ValueError(f'Bad value for {fields.get(PRESIDENT)=}')
 
+
+@writes
+def update(name: str, fields: dict):
+    validate_update(name, fields)
     result = dbc.update(COUNTRIES_COLLECTION, {NAME: name}, fields)
     if result < 1:
         raise ValueError(f'Country not found: {name}')
 
-    # Update cache
-    if country_cache and name in country_cache:
-        country_cache[name].update(fields)
-
+    update_cache(name, fields)
     return result
 
 
+def update_cache(name: str, fields: dict):
+    country_cache.update_one({NAME: name}, fields)
+
+
+@writes
 def delete(name: str):
     result = dbc.delete(COUNTRIES_COLLECTION, {NAME: name})
     if result < 1:
         raise ValueError(f'Country not found: {name}')
+    drop_cache(name)
     return result
+
+
+def drop_cache(name: str):
+    country_cache.delete_one({NAME: name})
+
+
+@writes
+def create_many(recs: list, ordered: bool = True) -> list:
+    """
+    Validate and insert a batch of countries in one go.
+    Returns one result per record: {dbc.BULK_ID: ...} or
+    {dbc.BULK_ERROR: ...}.
+    """
+    results = dbc.create_many(COUNTRIES_COLLECTION, recs,
+                              ordered=ordered, validate=validate_create)
+    country_cache.update({res[dbc.BULK_ID]: dcache.record(rec)
+                          for rec, res in zip(recs, results)
+                          if dbc.BULK_ID in res})
+    return results
+
+
+def update_op(item: dict) -> tuple:
+    if not isinstance(item, dict):
+        raise ValueError(f'Bad type for {type(item)=}')
+    validate_update(item.get(NAME), item.get(FIELDS))
+    return (dbc.UPDATE, {NAME: item[NAME]}, item[FIELDS])
+
+
+@writes
+def update_many(items: list, ordered: bool = True) -> dict:
+    """
+    Apply a batch of {NAME: ..., FIELDS: {...}} updates with one
+    bulk write, then bring the cache up to date.
+    """
+    ret = dbc.bulk_write(COUNTRIES_COLLECTION, items, ordered=ordered,
+                         make_op=update_op)
+    failed = {err[dbc.BULK_INDEX] for err in ret[dbc.BULK_ERRORS]}
+    for i, item in enumerate(items):
+        if i not in failed:
+            update_cache(item[NAME], item[FIELDS])
+    return ret
+
+
+def delete_op(item: dict) -> tuple:
+    if not isinstance(item, dict):
+        raise ValueError(f'Bad type for {type(item)=}')
+    if not item.get(NAME) or not isinstance(item[NAME], str):
+        raise ValueError(f'Bad value for {item.get(NAME)=}')
+    return (dbc.DELETE, {NAME: item[NAME]})
+
+
+@writes
+def delete_many(items: list, ordered: bool = True) -> dict:
+    """
+    Delete a batch of {NAME: ...} countries with one bulk write.
+    """
+    ret = dbc.bulk_write(COUNTRIES_COLLECTION, items, ordered=ordered,
+                         make_op=delete_op)
+    failed = {err[dbc.BULK_INDEX] for err in ret[dbc.BULK_ERRORS]}
+    for i, item in enumerate(items):
+        if i not in failed:
+            drop_cache(item[NAME])
+    return ret
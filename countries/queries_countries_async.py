@@ -0,0 +1,47 @@
+"""
+Coroutine versions of the queries in queries_countries.py, for use from
+an async worker. Validation and the cache are shared with that module.
+"""
+import data.cache as dcache
+import data.db_connect_async as dbca
+import countries.queries_countries as qry
+
+
+@qry.writes
+async def create(fields: dict):
+    qry.validate_create(fields)
+    new_id = await dbca.create(qry.COUNTRIES_COLLECTION, fields)
+    qry.country_cache[new_id] = dcache.record(fields)
+    return new_id
+
+
+async def read(country_id=None, filt=None, fields=None, sort=None, limit=0,
+               collation=None):
+    """
+    With an id, the one country (or None), from the cache if we can.
+    Otherwise everything is passed down to the db.
+    """
+    if country_id is not None:
+        return await qry.country_cache.fetch_async(country_id)
+    return await dbca.read(qry.COUNTRIES_COLLECTION, filt=filt, fields=fields,
+                           sort=sort, limit=limit, collation=collation)
+
+
+@qry.writes
+async def update(name: str, fields: dict):
+    qry.validate_update(name, fields)
+    result = await dbca.update(qry.COUNTRIES_COLLECTION, {qry.NAME: name},
+                               fields)
+    if result < 1:
+        raise ValueError(f'Country not found: {name}')
+    qry.update_cache(name, fields)
+    return result
+
+
+@qry.writes
+async def delete(name: str):
+    result = await dbca.delete(qry.COUNTRIES_COLLECTION, {qry.NAME: name})
+    if result < 1:
+        raise ValueError(f'Country not found: {name}')
+    qry.drop_cache(name)
+    return result
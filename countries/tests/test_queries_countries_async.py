@@ -0,0 +1,40 @@
+import asyncio
+from unittest.mock import AsyncMock, patch
+
+import pytest
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import queries_countries_async as aqry
+
+qry = aqry.qry
+
+
+def test_create_bad_param_type():
+    with pytest.raises(ValueError):
+        asyncio.run(aqry.create(None))
+
+
+@patch('data.db_connect_async.read', new_callable=AsyncMock)
+def test_read(mock_read):
+    mock_read.return_value = [qry.SAMPLE_COUNTRY]
+    assert asyncio.run(aqry.read()) == [qry.SAMPLE_COUNTRY]
+
+
+@patch('data.db_connect_async.update', new_callable=AsyncMock)
+def test_update(mock_update):
+    mock_update.return_value = 1
+    assert asyncio.run(aqry.update('Canada', {qry.CAPITAL: 'Ottawa'})) == 1
+
+
+@patch('data.db_connect_async.read_one', new_callable=AsyncMock)
+def test_read_by_id(mock_read_one):
+    oid = '5f1d7f1e9d3b2a00123456a4'
+    mock_read_one.return_value = {qry.dbc.MONGO_ID: oid, **qry.SAMPLE_COUNTRY}
+    assert asyncio.run(aqry.read(oid)) == qry.SAMPLE_COUNTRY
+    assert asyncio.run(aqry.read(oid)) == qry.SAMPLE_COUNTRY  # now cached
+    mock_read_one.assert_called_once()
+    del qry.country_cache[oid]
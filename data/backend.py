@@ -0,0 +1,78 @@
+"""
+The interface a storage engine implements to stand in for MongoDB
+behind data/db_connect.py.
+Each method has the same name and arguments as the db_connect function
+it replaces, and must return the same kind of result.
+Filters, projections and sorts are written in Mongo's syntax, so the
+query modules don't know which engine they are talking to.
+"""
+import json
+
+from data.db_connect import SE_DB
+
+
+class Backend:
+    def create(self, collection, doc, db=SE_DB) -> str:
+        """
+        Insert a single doc, setting its `_id`, and return the id as a str.
+        """
+        raise NotImplementedError()
+
+    def read_one(self, collection, filt, db=SE_DB) -> dict | None:
+        raise NotImplementedError()
+
+    def read(self, collection, db=SE_DB, no_id=True, filt=None, fields=None,
+             sort=None, limit=0, collation=None) -> list:
+        """
+        A case-insensitive `collation` (see `dbc.is_case_insensitive()`)
+        must make the filter and sort ignore case; others may be ignored.
+        """
+        raise NotImplementedError()
+
+    def read_iter(self, collection, db=SE_DB, no_id=True, filt=None,
+                  fields=None, sort=None, limit=0, batch_size=0,
+                  collation=None):
+        raise NotImplementedError()
+
+    def count(self, collection, filt=None, db=SE_DB) -> int:
+        raise NotImplementedError()
+
+    def group_count(self, collection, field, filt=None, db=SE_DB) -> dict:
+        """
+        Return {value of `field`: number of docs}, with None for docs
+        without the field.
+        """
+        raise NotImplementedError()
+
+    def read_json_iter(self, collection, db=SE_DB, filt=None, fields=None,
+                       sort=None, limit=0, batch_size=0, collation=None):
+        """
+        Yield each doc, without `_id`, as a JSON string. Engines that
+        hold JSON already can do better than this.
+        """
+        for doc in self.read_iter(collection, db=db, filt=filt,
+                                  fields=fields, sort=sort, limit=limit,
+                                  collation=collation):
+            yield json.dumps(doc, default=str)
+
+    def update(self, collection, filters, update_dict, db=SE_DB) -> int:
+        """
+        `$set` `update_dict` on the first matching doc and return the
+        number of docs modified.
+        """
+        raise NotImplementedError()
+
+    def delete(self, collection, filt, db=SE_DB) -> int:
+        raise NotImplementedError()
+
+    def insert_many(self, collection, docs, db=SE_DB, ordered=True) -> list:
+        """
+        Return one {BULK_ID}/{BULK_ERROR} result per doc.
+        """
+        raise NotImplementedError()
+
+    def write_ops(self, collection, ops, db=SE_DB, ordered=True) -> tuple:
+        """
+        Return the totals and a {position: reason} dict of failed ops.
+        """
+        raise NotImplementedError()
@@ -0,0 +1,948 @@
+"""
+The in-process cache each query module keeps of its collection.
+An EntityCache behaves like the dict the modules used to keep (keyed by
+the record's `_id`), but entries expire after a TTL, the least recently
+used ones are evicted beyond a size bound, and it counts its hits,
+misses, evictions and expirations.
+"""
+import atexit
+import bisect
+import inspect
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import warnings
+
+from collections import OrderedDict
+from functools import wraps
+
+import bson
+from bson import ObjectId
+
+import data.db_connect as dbc
+import data.db_connect_async as dbca
+from data import records
+from data import shared
+
+# how long a record may be served from the cache, in seconds
+CACHE_TTL = dbc.env_float('CACHE_TTL', 300.0)
+# how many records each cache may hold
+CACHE_MAX_SIZE = dbc.env_int('CACHE_MAX_SIZE', 100000)
+# how often `start_refreshers()` reloads each cache, in seconds; 0 for never
+CACHE_REFRESH = dbc.env_float('CACHE_REFRESH', 0.0)
+# where to keep cache snapshots for fast starts; unset for nowhere
+CACHE_SNAPSHOT_DIR = os.environ.get('CACHE_SNAPSHOT_DIR')
+# share version stamps and snapshots, through CACHE_SNAPSHOT_DIR, with
+# the other workers on this host; see data/shared.py
+CACHE_SHARED = dbc.env_bool('CACHE_SHARED', False)
+
+# a snapshot file is SNAPSHOT_MAGIC, then SNAPSHOT_HEADER (the format
+# version, when it was written and the version of the collection it
+# holds), then one BSON doc per record with its key as the _id
+SNAPSHOT_MAGIC = b'WCACHE'
+SNAPSHOT_HEADER = struct.Struct('<HdQ')
+SNAPSHOT_FORMAT = 2
+SNAPSHOT_EXT = '.snapshot'
+
+# keys of EntityCache.stats()
+HITS = 'hits'
+MISSES = 'misses'
+EVICTIONS = 'evictions'
+EXPIRATIONS = 'expirations'
+SIZE = 'size'
+MAX_SIZE = 'max_size'
+TTL = 'ttl'
+LOADED_AT = 'loaded_at'
+REFRESHES = 'refreshes'
+REFRESH_ERRORS = 'refresh_errors'
+VERSION = 'version'
+RECORD_BYTES = 'record_bytes'
+DICT_BYTES = 'dict_bytes'
+
+# how many records `EntityCache.record_sizes()` looks at
+RECORD_SAMPLE = 100
+
+# collection name -> its EntityCache, for `all_stats()`
+caches = {}
+
+
+class CacheRefreshWarning(UserWarning):
+    pass
+
+
+class DuplicateCacheWarning(UserWarning):
+    pass
+
+
+def record(doc: dict) -> dict:
+    """
+    What we cache for a doc: the doc less its `_id`, which is the key.
+    """
+    return {key: val for key, val in doc.items() if key != dbc.MONGO_ID}
+
+
+def sort_key(val) -> tuple:
+    """
+    Orders any values the way the db does, more or less: missing first,
+    then numbers, then strings, then anything else.
+    """
+    if val is None:
+        return (0, 0)
+    if isinstance(val, (int, float)) and not isinstance(val, bool):
+        return (1, val)
+    if isinstance(val, str):
+        return (2, val)
+    return (3, str(val))
+
+
+def load_collection(collection: str) -> dict:
+    """
+    Read a whole collection as {_id: record}.
+    """
+    recs = {}
+    for doc in dbc.read(collection, no_id=False):
+        recs[doc.pop(dbc.MONGO_ID)] = doc
+    return recs
+
+
+def write_snapshot(path: str, items: list, version: int = 0):
+    """
+    Write (key, record) pairs to a snapshot file, atomically, so that a
+    reader never sees half of one.
+    """
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_FORMAT, time.time(),
+                                         version))
+            for key, rec in items:
+                f.write(bson.encode({dbc.MONGO_ID: key, **rec}))
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def read_snapshot(path: str) -> dict:
+    """
+    {key: record} from a snapshot file, read through a memory map.
+    Raise ValueError if it isn't one we can read.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError('empty snapshot')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = len(SNAPSHOT_MAGIC) + SNAPSHOT_HEADER.size
+            if mm[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                raise ValueError('not a cache snapshot')
+            fmt, _, _ = SNAPSHOT_HEADER.unpack_from(mm, len(SNAPSHOT_MAGIC))
+            if fmt != SNAPSHOT_FORMAT:
+                raise ValueError(f'snapshot format {fmt}, '
+                                 f'not {SNAPSHOT_FORMAT}')
+            try:
+                docs = bson.decode_all(mm[start:])
+            except bson.errors.InvalidBSON as e:
+                raise ValueError(str(e)) from e
+    return {doc.pop(dbc.MONGO_ID): doc for doc in docs}
+
+
+def snapshot_version(path: str) -> int | None:
+    """
+    The version of the collection a snapshot file holds, or None if
+    there is no snapshot we can read there.
+    """
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(len(SNAPSHOT_MAGIC) + SNAPSHOT_HEADER.size)
+    except OSError:
+        return None
+    if (len(head) < len(SNAPSHOT_MAGIC) + SNAPSHOT_HEADER.size
+            or not head.startswith(SNAPSHOT_MAGIC)):
+        return None
+    fmt, _, version = SNAPSHOT_HEADER.unpack_from(head, len(SNAPSHOT_MAGIC))
+    return version if fmt == SNAPSHOT_FORMAT else None
+
+
+def register_cache(cache):
+    """
+    Put `cache` in `caches`, which the stats, refreshers, sharing and
+    snapshots all go through. A second cache of the same collection
+    would leave those working on one of the two, so it is refused with a
+    warning and the first is kept.
+    """
+    if caches.get(cache.collection, cache) is not cache:
+        warnings.warn(f'{cache.collection} already has a cache; this one '
+                      'is not registered.', DuplicateCacheWarning,
+                      stacklevel=3)
+        return
+    caches[cache.collection] = cache
+
+
+class EntityCache:
+    def __init__(self, collection: str, ttl: float = None,
+                 max_size: int = None, loader=None, id_field: str = None,
+                 index_on: list = None, record_fields=None,
+                 sorted_on: str = None, register: bool = True):
+        self.collection = collection
+        # records are kept as these (see data/records.py), or as dicts
+        self.record_type = (records.record_type(collection, record_fields)
+                            if record_fields else None)
+        # a field some records carry their own id in
+        self.id_field = id_field
+        self.ttl = CACHE_TTL if ttl is None else ttl
+        self.max_size = CACHE_MAX_SIZE if max_size is None else max_size
+        self.loader = loader or (lambda: load_collection(collection))
+        # guards the entries and indexes; records themselves are never
+        # changed in place, so a reader may keep one it was handed
+        self.lock = threading.RLock()
+        # held by the one thread loading the collection
+        self.load_lock = threading.Lock()
+        # while a load is running: key -> record (None if dropped) for
+        # each write since it started, to be replayed over what it read
+        self.pending = None
+        # bumped whenever everything is invalidated, so a load that was
+        # already running knows to throw away what it read
+        self.generation = 0
+        # (thread, stop event) of the background refresher, if running
+        self.refresher = None
+        self.refresh_interval = None
+        # is a stale cache being reloaded in the background? Until it is
+        # done we serve what we have, expired or not
+        self.refreshing = False
+        # key -> (record, expires at), least recently used first
+        self.entries = OrderedDict()
+        # secondary indexes, one per tuple of fields in `index_on`:
+        # fields -> {their values in a record: keys of those records}
+        self.indexes = {}
+        for fields in ([(id_field,)] if id_field else []) + (index_on or []):
+            self.indexes[tuple(sorted(fields))] = {}
+        # (sort_key(value of `sorted_on`), key) for every record, in order
+        self.sorted_on = sorted_on
+        self.order = []
+        # when the whole collection was last loaded; None if it never was
+        self.loaded_at = None
+        # do we hold every record, as of that load?
+        self.complete = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+        # bumped by every write through a query module and every load
+        self.version = 0
+        # when shared with other workers: the version stamp we all bump,
+        # and the stamp's version that our contents are up to date with
+        self.shared = None
+        self.seen = None
+        if register:
+            register_cache(self)
+
+    def pack(self, rec: dict):
+        if self.record_type is None:
+            return rec
+        return self.record_type.from_dict(rec)
+
+    def unpack(self, rec) -> dict:
+        return rec if self.record_type is None else rec.to_dict()
+
+    def expired(self, expires_at: float, now: float = None) -> bool:
+        return (not self.refreshing
+                and (now or time.monotonic()) >= expires_at)
+
+    def index(self, key, rec: dict, add: bool = True, indexes=None):
+        """
+        Add `key` to (or take it out of) the secondary indexes under
+        `rec`'s values. Call with the lock held, unless the indexes
+        are a new set that nobody else can see yet.
+        """
+        for fields, index in (indexes or self.indexes).items():
+            vals = tuple(rec.get(field) for field in fields)
+            try:
+                if add:
+                    index.setdefault(vals, set()).add(key)
+                elif vals in index:
+                    index[vals].discard(key)
+                    if not index[vals]:
+                        del index[vals]
+            except TypeError:  # unhashable values aren't indexed
+                pass
+        if indexes is None and self.sorted_on is not None:
+            self.place(key, rec, add)
+
+    def place(self, key, rec, add: bool = True):
+        """
+        Insert `key` in (or remove it from) the sorted view.
+        Call with the lock held.
+        """
+        item = (sort_key(rec.get(self.sorted_on)), key)
+        i = bisect.bisect_left(self.order, item)
+        if add:
+            self.order.insert(i, item)
+        elif i < len(self.order) and self.order[i] == item:
+            del self.order[i]
+
+    def drop(self, key, deleted: bool = False):
+        """
+        Remove an entry and return it, or None.
+        Only a `deleted` record is kept out of a load under way: one that
+        merely expired or was evicted is in what the load read, and so
+        comes back with it.
+        Call with the lock held.
+        """
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.index(key, entry[0], add=False)
+        if deleted and self.pending is not None:
+            self.pending[key] = None
+        return entry
+
+    def live(self, key):
+        """
+        The entry for `key`, dropping it if it has expired.
+        Call with the lock held.
+        """
+        entry = self.entries.get(key)
+        if entry is not None and self.expired(entry[1]):
+            self.drop(key)
+            self.expirations += 1
+            self.complete = False
+            return None
+        return entry
+
+    def __contains__(self, key) -> bool:
+        with self.lock:
+            return self.live(key) is not None
+
+    def __getitem__(self, key):
+        with self.lock:
+            entry = self.live(key)
+            if entry is None:
+                self.misses += 1
+                raise KeyError(key)
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.unpack(entry[0])
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def where(self, match: dict) -> list:
+        """
+        Keys of the records whose fields equal `match`: from the index
+        on exactly those fields if there is one, else by a scan.
+        """
+        fields = tuple(sorted(match))
+        with self.lock:
+            if fields not in self.indexes:
+                return [key for key, rec in self.items()
+                        if all(rec.get(field) == val
+                               for field, val in match.items())]
+            vals = tuple(match[field] for field in fields)
+            keys = list(self.indexes[fields].get(vals, ()))
+            return [key for key in keys if self.live(key) is not None]
+
+    def fetch(self, key: str):
+        """
+        The record for `key`: from the cache if we have it, else read
+        from the db by `_id` (or by `id_field`) and cached.
+        None if there is no such record.
+        """
+        rec = self.cached(key)
+        if rec is not None:
+            return rec
+        for filt in self.lookups(key):
+            doc = dbc.read_one(self.collection, filt)
+            if doc is not None:
+                return self.keep(doc)
+        return None
+
+    async def fetch_async(self, key: str):
+        """
+        `fetch()`, reading the db with `dbca.read_one()`.
+        """
+        rec = self.cached(key)
+        if rec is not None:
+            return rec
+        for filt in self.lookups(key):
+            doc = await dbca.read_one(self.collection, filt)
+            if doc is not None:
+                return self.keep(doc)
+        return None
+
+    def cached(self, key: str):
+        """
+        The record for `key` if we hold it, under its key or its
+        `id_field`; else None.
+        """
+        if self.entries and (self.behind() or (self.loaded_at is not None
+                                               and self.needs_load())):
+            self.ensure_loaded(wait=False)
+        rec = self.get(key)
+        if rec is not None:
+            return rec
+        if self.id_field:
+            for cached in self.where({self.id_field: key}):
+                return self[cached]
+        return None
+
+    def lookups(self, key: str) -> list:
+        """
+        The filters to find `key` in the db with, in turn.
+        """
+        filts = []
+        if ObjectId.is_valid(key):
+            filts.append({dbc.MONGO_ID: ObjectId(key)})
+        if self.id_field:
+            filts.append({self.id_field: key})
+        return filts
+
+    def keep(self, doc: dict) -> dict:
+        rec = record(doc)
+        self[doc[dbc.MONGO_ID]] = rec
+        return rec
+
+    def __setitem__(self, key, record):
+        with self.lock:
+            self.drop(key)
+            self.entries[key] = (self.pack(record),
+                                 time.monotonic() + self.ttl)
+            self.index(key, record)
+            if self.pending is not None:
+                self.pending[key] = record
+            while len(self.entries) > self.max_size:
+                self.drop(next(iter(self.entries)))
+                self.evictions += 1
+                self.complete = False
+
+    def __delitem__(self, key):
+        with self.lock:
+            if self.drop(key, deleted=True) is None:
+                raise KeyError(key)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.drop(key, deleted=True)
+        return default if entry is None else self.unpack(entry[0])
+
+    def update(self, recs: dict):
+        for key, record in recs.items():
+            self[key] = record
+
+    def update_record(self, key, fields: dict) -> bool:
+        """
+        Replace a cached record with a copy that has `fields` applied.
+        False if we don't have it.
+        """
+        with self.lock:
+            entry = self.live(key)
+            if entry is None:
+                return False
+            rec = {**self.unpack(entry[0]), **fields}
+            self.index(key, entry[0], add=False)
+            self.entries[key] = (self.pack(rec), entry[1])
+            self.index(key, rec)
+            if self.pending is not None:
+                self.pending[key] = rec
+            return True
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def items(self) -> list:
+        """
+        A snapshot of the live (key, record) pairs.
+        """
+        now = time.monotonic()
+        with self.lock:
+            return [(key, self.unpack(record))
+                    for key, (record, expires_at) in self.entries.items()
+                    if not self.expired(expires_at, now)]
+
+    def keys(self) -> list:
+        return [key for key, _ in self.items()]
+
+    def values(self) -> list:
+        return [record for _, record in self.items()]
+
+    def clear(self):
+        self.invalidate()
+
+    def invalidate(self, key=None):
+        """
+        Drop one record, or everything, so it is read from the db again.
+        """
+        with self.lock:
+            if key is None:
+                self.generation += 1
+                self.entries.clear()
+                for index in self.indexes.values():
+                    index.clear()
+                self.order = []
+                self.loaded_at = None
+                self.complete = False
+            else:
+                self.drop(key, deleted=True)
+                # it may still be in the db, just not in the sorted view
+                self.complete = False
+
+    def update_one(self, match: dict, fields: dict):
+        """
+        Follow the db's update_one() on a record matching `match`.
+        If we hold more than one we can't tell which it changed, so we
+        forget them all, to be read again.
+        """
+        keys = self.where(match)
+        if len(keys) == 1:
+            self.update_record(keys[0], fields)
+        else:
+            for key in keys:
+                self.invalidate(key)
+
+    def delete_one(self, match: dict):
+        """
+        Follow the db's delete_one() on a record matching `match`, as
+        `update_one()` does.
+        """
+        keys = self.where(match)
+        if len(keys) == 1:
+            self.pop(keys[0])
+        else:
+            for key in keys:
+                self.invalidate(key)
+
+    def between(self, start=None, end=None, limit: int = 0,
+                descending: bool = False) -> list:
+        """
+        The records whose `sorted_on` field is from `start` up to (not
+        including) `end`, in order, found by bisecting the sorted view:
+        O(log n + k) for k records, with no sorting.
+        """
+        now = time.monotonic()
+        with self.lock:
+            order = self.order
+            lo = 0 if start is None else bisect.bisect_left(
+                order, (sort_key(start),))
+            hi = len(order) if end is None else bisect.bisect_left(
+                order, (sort_key(end),))
+            positions = range(hi - 1, lo - 1, -1) if descending \
+                else range(lo, hi)
+            recs = []
+            for i in positions:
+                rec, expires_at = self.entries[order[i][1]]
+                if self.expired(expires_at, now):
+                    continue
+                recs.append(self.unpack(rec))
+                if len(recs) == limit:
+                    break
+            return recs
+
+    def behind(self) -> bool:
+        """
+        Has another worker written since we loaded?
+        """
+        return self.shared is not None and self.shared.version() != self.seen
+
+    def needs_load(self) -> bool:
+        loaded_at = self.loaded_at
+        return (loaded_at is None or time.monotonic() - loaded_at >= self.ttl
+                or self.behind())
+
+    def load(self, loader=None, seen: int = None):
+        """
+        Read the whole collection (or whatever `loader` returns) and build
+        new entries and indexes from it while readers carry on with the
+        old ones. Then swap them in, and replay the writes made in the
+        meantime.
+        `seen` is the shared version that what we read is up to date
+        with, if not the one current when we start.
+        """
+        if seen is None and self.shared is not None:
+            seen = self.shared.version()
+        with self.lock:
+            self.pending = {}
+            generation = self.generation
+        try:
+            recs = (loader or self.loader)()
+            now = time.monotonic()
+            entries = OrderedDict()
+            indexes = {fields: {} for fields in self.indexes}
+            # past max_size, only the last records read are kept
+            for key in list(recs)[-self.max_size:]:
+                entries[key] = (self.pack(recs[key]), now + self.ttl)
+                self.index(key, recs[key], indexes=indexes)
+            order = []
+            if self.sorted_on is not None:
+                order = sorted((sort_key(recs[key].get(self.sorted_on)), key)
+                               for key in entries)
+        except BaseException:
+            with self.lock:
+                self.pending = None
+            raise
+        with self.lock:
+            pending, self.pending = self.pending, None
+            if generation != self.generation:
+                return
+            self.entries, self.indexes = entries, indexes
+            self.order = order
+            self.complete = len(recs) <= self.max_size
+            self.evictions += max(len(recs) - self.max_size, 0)
+            for key, rec in pending.items():
+                if rec is None:
+                    self.drop(key)
+                else:
+                    self[key] = rec
+            self.loaded_at = now
+            self.refreshes += 1
+            self.seen = seen
+            if self.shared is None:
+                self.bump()
+
+    def reload(self):
+        """
+        Load the collection. Workers sharing it take turns, and load the
+        snapshot that another has written of the current version rather
+        than go to the db again.
+        """
+        if self.shared is None:
+            self.load()
+            return
+        with shared.file_lock(self.shared_path(shared.LOCK_EXT)):
+            version = self.shared.version()
+            path = self.snapshot_path()
+            if snapshot_version(path) == version:
+                self.load(lambda: read_snapshot(path), seen=version)
+            else:
+                self.load(seen=version)
+                self.dump()
+
+    def refresh(self):
+        """
+        Load the collection unless another thread already is.
+        """
+        if not self.load_lock.acquire(blocking=False):
+            return
+        try:
+            self.reload()
+            if CACHE_SNAPSHOT_DIR and self.shared is None:
+                self.dump()
+        except Exception as e:
+            self.refresh_errors += 1
+            warnings.warn(f'Could not refresh the {self.collection} cache: '
+                          f'{e}', CacheRefreshWarning)
+        finally:
+            self.refreshing = False
+            self.load_lock.release()
+
+    def ensure_loaded(self, wait: bool = True):
+        """
+        Load the collection if it is missing or expired, in one thread
+        only. While we hold all of it, as of an earlier load, the load
+        runs in the background and everybody carries on with the records
+        we have until it is done. Otherwise what we hold doesn't stand
+        for the collection, so the others wait for it, unless told not
+        to: a lookup of one key can do with that key's entry.
+        """
+        if not self.needs_load():
+            return
+        if not wait or (self.loaded_at is not None and self.complete):
+            self.refreshing = True
+            if not self.load_lock.locked():
+                threading.Thread(target=self.refresh, daemon=True).start()
+            return
+        with self.load_lock:
+            try:
+                if self.needs_load():
+                    self.reload()
+            finally:
+                self.refreshing = False
+
+    def bump(self):
+        with self.lock:
+            if self.shared is None:
+                self.version += 1
+                return
+            version = self.shared.bump()
+            # if nobody else wrote since we loaded, we are still current:
+            # our own write is already in the cache
+            if self.seen == version - 1:
+                self.seen = version
+
+    def etag(self) -> str | None:
+        """
+        A validator for the collection as it is now, or None if we
+        can't give one: our own version only counts this process's
+        writes, so only the shared stamp that every worker bumps will do.
+        Writes made outside the app are not seen even then.
+        The stamp's epoch is part of it, so a stamp file made afresh,
+        back at version 0, doesn't hand out ETags clients already hold.
+        """
+        if self.shared is None:
+            return None
+        version, _, epoch = self.shared.read()
+        return f'{self.collection}-{epoch:x}-{version}'
+
+    def last_modified(self) -> float | None:
+        if self.shared is None:
+            return None
+        return self.shared.modified_at()
+
+    def share(self, directory: str):
+        """
+        Share our version stamp with the other workers using `directory`.
+        """
+        self.shared = shared.SharedStamp(
+            os.path.join(directory, f'{self.collection}{shared.STAMP_EXT}'))
+
+    def shared_path(self, ext: str) -> str:
+        return os.path.join(os.path.dirname(self.shared.path),
+                            f'{self.collection}{ext}')
+
+    def snapshot_path(self) -> str:
+        if self.shared is not None:
+            return self.shared_path(SNAPSHOT_EXT)
+        return os.path.join(CACHE_SNAPSHOT_DIR, f'{self.collection}'
+                                                f'{SNAPSHOT_EXT}')
+
+    def dump(self, path: str = None):
+        """
+        Write the cached records to a snapshot file.
+        """
+        version = self.version if self.shared is None else self.seen
+        write_snapshot(path or self.snapshot_path(), self.items(), version)
+
+    def load_snapshot(self, path: str = None) -> bool:
+        """
+        Fill the cache from a snapshot file, if there is a good one, then
+        catch up with the db in the background.
+        """
+        path = path or self.snapshot_path()
+        with self.load_lock:
+            try:
+                # shared, it is as current as the version it holds
+                self.load(lambda: read_snapshot(path),
+                          seen=snapshot_version(path))
+            except (OSError, ValueError) as e:
+                warnings.warn(f'Could not load the {self.collection} cache '
+                              f'snapshot {path}: {e}', CacheRefreshWarning)
+                return False
+        threading.Thread(target=self.refresh, daemon=True).start()
+        return True
+
+    def start_refresher(self, interval: float = None):
+        """
+        Reload the collection every `interval` seconds in a daemon thread,
+        so that no request has to wait for it.
+        """
+        self.refresh_interval = interval or CACHE_REFRESH
+        self.stop_refresher()
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(self.refresh_interval):
+                self.refresh()
+
+        self.refresher = (threading.Thread(target=run, daemon=True), stop)
+        self.refresher[0].start()
+
+    def stop_refresher(self):
+        if self.refresher is not None:
+            self.refresher[1].set()
+            self.refresher = None
+
+    def after_fork(self):
+        """
+        Threads and held locks don't survive a fork: start over.
+        """
+        self.lock = threading.RLock()
+        self.load_lock = threading.Lock()
+        self.pending = None
+        self.refresher = None
+        self.refreshing = False
+        if self.refresh_interval:
+            self.start_refresher(self.refresh_interval)
+
+    def record_sizes(self, sample: int = RECORD_SAMPLE) -> tuple:
+        """
+        Average bytes per record as we keep them, and as dicts, over a
+        sample of the records.
+        """
+        with self.lock:
+            recs = [entry[0] for entry, _ in
+                    zip(self.entries.values(), range(sample))]
+        if not recs:
+            return 0, 0
+        kept = sum(records.size(rec) for rec in recs) / len(recs)
+        as_dicts = sum(records.size(self.unpack(rec))
+                       for rec in recs) / len(recs)
+        return round(kept), round(as_dicts)
+
+    def stats(self) -> dict:
+        kept, as_dicts = self.record_sizes()
+        with self.lock:
+            return {
+                RECORD_BYTES: kept,
+                DICT_BYTES: as_dicts,
+                HITS: self.hits,
+                MISSES: self.misses,
+                EVICTIONS: self.evictions,
+                EXPIRATIONS: self.expirations,
+                SIZE: len(self.entries),
+                MAX_SIZE: self.max_size,
+                TTL: self.ttl,
+                LOADED_AT: self.loaded_at,
+                REFRESHES: self.refreshes,
+                REFRESH_ERRORS: self.refresh_errors,
+                VERSION: (self.version if self.shared is None
+                          else self.shared.version()),
+            }
+
+
+def needs_cache(cache: EntityCache):
+    """
+    Decorate functions that want the whole collection in `cache`.
+    """
+    def deco(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            cache.ensure_loaded()
+            return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+
+def writes(cache: EntityCache):
+    """
+    Decorate functions (or coroutines) that write the collection, to bump
+    `cache`'s version. A ValueError means nothing was written.
+    """
+    def deco(fn):
+        if inspect.iscoroutinefunction(fn):
+            @wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                try:
+                    ret = await fn(*args, **kwargs)
+                except ValueError:
+                    raise
+                except BaseException:
+                    cache.bump()
+                    raise
+                cache.bump()
+                return ret
+            return async_wrapper
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            try:
+                ret = fn(*args, **kwargs)
+            except ValueError:
+                raise
+            except BaseException:
+                cache.bump()
+                raise
+            cache.bump()
+            return ret
+        return wrapper
+    return deco
+
+
+def read_range(cache: EntityCache, start=None, end=None, filt=None,
+               fields=None, sort=None, limit=0, collation=None) -> list:
+    """
+    Docs whose `cache.sorted_on` field is from `start` up to (not
+    including) `end`, e.g. the cities from 'A' to 'D'.
+    Sliced from the cache's sorted view if it holds the whole collection
+    and all that is asked for is that range in that order; otherwise the
+    range joins the filter and everything goes to the db.
+    """
+    field = cache.sorted_on
+    sort = sort or [(field, dbc.ASCENDING)]
+    if (not filt and not collation and len(sort) == 1
+            and sort[0][0] == field and not isinstance(fields, dict)):
+        cache.ensure_loaded()
+        if cache.complete:
+            docs = cache.between(start, end, limit=limit,
+                                 descending=sort[0][1] == dbc.DESCENDING)
+            if fields is not None:
+                docs = [{name: doc[name] for name in fields if name in doc}
+                        for doc in docs]
+            return docs
+    bounds = {}
+    if start is not None:
+        bounds['$gte'] = start
+    if end is not None:
+        bounds['$lt'] = end
+    if bounds:
+        filt = ({'$and': [filt, {field: bounds}]} if filt
+                else {field: bounds})
+    return dbc.read(cache.collection, filt=filt, fields=fields, sort=sort,
+                    limit=limit, collation=collation)
+
+
+def all_stats() -> dict:
+    return {collection: cache.stats() for collection, cache in caches.items()}
+
+
+def start_refreshers(interval: float = None):
+    """
+    Start a background refresher for every cache, if we have an interval.
+    """
+    if interval or CACHE_REFRESH:
+        for cache in caches.values():
+            cache.start_refresher(interval)
+
+
+def share_caches():
+    """
+    Share every cache with the other workers, if CACHE_SHARED is set.
+    """
+    if not (CACHE_SHARED and CACHE_SNAPSHOT_DIR):
+        return
+    if not shared.available():
+        warnings.warn('Caches cannot be shared on this platform.',
+                      CacheRefreshWarning)
+        return
+    os.makedirs(CACHE_SNAPSHOT_DIR, exist_ok=True)
+    for cache in caches.values():
+        cache.share(CACHE_SNAPSHOT_DIR)
+
+
+def load_snapshots():
+    """
+    Warm every cache from its snapshot, if we keep them.
+    """
+    if CACHE_SNAPSHOT_DIR:
+        for cache in caches.values():
+            if os.path.exists(cache.snapshot_path()):
+                cache.load_snapshot()
+
+
+def dump_snapshots():
+    if CACHE_SNAPSHOT_DIR:
+        for cache in caches.values():
+            if cache.loaded_at is not None:
+                cache.dump()
+
+
+def after_fork():
+    for cache in caches.values():
+        cache.after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=after_fork)
+
+atexit.register(dump_snapshots)
@@ -2,14 +2,38 @@
 All interaction with MongoDB should be through this file!
 We may be required to use a new database at any point.
 """
+import base64
+import binascii
+import json
+import math
 import os
+import random
+import threading
+import time
+import warnings
 
 import pymongo as pm
 
 from functools import wraps
-from pymongo.errors import AutoReconnect, NetworkTimeout
+from pymongo import monitoring
+from pymongo.collation import Collation
+from pymongo.errors import AutoReconnect, BulkWriteError, NetworkTimeout
 
-import certifi 
+import certifi
+
+import bson
+
+from bson import ObjectId, json_util
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+try:
+    # turns BSON straight into JSON, in C
+    import bsonjs
+except ImportError:
+    bsonjs = None
+
+from data import metrics
 
 LOCAL = "0"
 CLOUD = "1"
@@ -18,10 +42,62 @@ SE_DB = 'seDB'
 
 client = None
 
+# storage engines; see `get_backend()`
+MONGO = 'mongo'
+MEMORY = 'memory'
+SQLITE = 'sqlite'
+DB_BACKEND = os.getenv('DB_BACKEND', MONGO)
+
+backend = None
+
 MONGO_ID = '_id'
 
+ASCENDING = pm.ASCENDING
+DESCENDING = pm.DESCENDING
+
 MIN_ID_LEN = 4
 
+# How many docs the server sends per round trip when streaming.
+DEFAULT_BATCH_SIZE = int(os.getenv('MONGO_BATCH_SIZE', 1000))
+# How many docs `read_page()` returns when not told.
+DEFAULT_PAGE_SIZE = int(os.getenv('MONGO_PAGE_SIZE', 100))
+# How many docs go to the server in one bulk write.
+BULK_BATCH_SIZE = int(os.getenv('MONGO_BULK_BATCH_SIZE', 1000))
+
+# Read with this to get each doc as undecoded bytes.
+RAW_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+# keys of bulk write results
+BULK_ID = 'id'
+BULK_ERROR = 'error'
+BULK_INDEX = 'index'
+BULK_ERRORS = 'errors'
+BULK_MATCHED = 'matched'
+BULK_MODIFIED = 'modified'
+BULK_DELETED = 'deleted'
+NOT_ATTEMPTED = 'Not attempted: an earlier record failed.'
+
+# bulk_write() operations
+UPDATE = 'update'
+DELETE = 'delete'
+
+# keys of index specs, as passed to `register_indexes()`
+INDEX_KEYS = 'keys'
+INDEX_UNIQUE = 'unique'
+INDEX_COLLATION = 'collation'
+
+# A case-insensitive collation, for `read(collation=...)` and for index
+# specs: Mongo only uses an index to sort if the collations match.
+CI_COLLATION = {'locale': 'en', 'strength': 2}
+
+# Build the registered indexes whenever a process first connects.
+ENSURE_INDEXES = os.getenv('MONGO_ENSURE_INDEXES', '1') != '0'
+
+# collection name -> list of index specs
+index_registry = {}
+# (collection, filter keys) pairs we have already warned about
+collscan_warned = set()
+
 user_nm = os.getenv('MONGO_USER_NM', 'mattiasshularsson_db_user')
 cloud_svc = os.getenv('MONGO_HOST', 'cluster0.nbhhiox.mongodb.net')
 passwd = os.environ.get("MONGO_PASSWD", '')
@@ -34,161 +110,1166 @@ CONN_TIMEOUT = 'connectTimeoutMS'
 SOCK_TIMEOUT = 'socketTimeoutMS'
 CONNECT = 'connect'
 MAX_POOL_SIZE = 'maxPoolSize'
+MIN_POOL_SIZE = 'minPoolSize'
+MAX_IDLE_TIME = 'maxIdleTimeMS'
+WAIT_QUEUE_TIMEOUT = 'waitQueueTimeoutMS'
+
+TRUE_STRS = ('1', 'true', 'yes', 'on')
+
+
+def env_int(name: str, default: int | None) -> int | None:
+    val = os.getenv(name)
+    if val is None or val.strip() == '':
+        return default
+    return int(val)
+
+
+def env_float(name: str, default: float) -> float:
+    val = os.getenv(name)
+    if val is None or val.strip() == '':
+        return default
+    return float(val)
+
+
+def env_bool(name: str, default: bool) -> bool:
+    val = os.getenv(name)
+    if val is None or val.strip() == '':
+        return default
+    return val.strip().lower() in TRUE_STRS
+
 
 # Recommended Python Anywhere settings.
-PA_MONGO = os.getenv('PA_MONGO', True)
+# The client is created per process (see `connect_db()`), so we can
+# afford a real pool rather than a single socket.
+PA_MONGO = env_bool('PA_MONGO', True)
 PA_SETTINGS = {
-    CONN_TIMEOUT: os.getenv('MONGO_CONN_TIMEOUT', 30000),
-    SOCK_TIMEOUT: os.getenv('MONGO_SOCK_TIMEOUT', None),
-    CONNECT: os.getenv('MONGO_CONNECT', False),
-    MAX_POOL_SIZE: os.getenv('MONGO_MAX_POOL_SIZE', 1),
+    CONN_TIMEOUT: env_int('MONGO_CONN_TIMEOUT', 30000),
+    SOCK_TIMEOUT: env_int('MONGO_SOCK_TIMEOUT', None),
+    CONNECT: env_bool('MONGO_CONNECT', False),
+    MAX_POOL_SIZE: env_int('MONGO_MAX_POOL_SIZE', 10),
+    MIN_POOL_SIZE: env_int('MONGO_MIN_POOL_SIZE', 0),
+    MAX_IDLE_TIME: env_int('MONGO_MAX_IDLE_TIME_MS', 60000),
+    WAIT_QUEUE_TIMEOUT: env_int('MONGO_WAIT_QUEUE_TIMEOUT_MS', 5000),
 }
 
+# keys of pool_stats()
+POOL_PID = 'pid'
+POOL_MAX_SIZE = 'max_pool_size'
+POOL_OPEN = 'open'
+POOL_IN_USE = 'in_use'
+POOL_UTILIZATION = 'utilization'
+POOL_CHECKOUTS = 'checkouts'
+POOL_CHECKOUT_FAILURES = 'checkout_failures'
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """
+    Counts the connections in this process's pool, so we can see how
+    busy it is.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.open = 0
+            self.in_use = 0
+            self.checkouts = 0
+            self.checkout_failures = 0
+
+    def connection_created(self, event):
+        with self.lock:
+            self.open += 1
+
+    def connection_closed(self, event):
+        with self.lock:
+            self.open -= 1
+
+    def connection_checked_out(self, event):
+        with self.lock:
+            self.in_use += 1
+            self.checkouts += 1
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.in_use -= 1
+
+    def connection_check_out_failed(self, event):
+        with self.lock:
+            self.checkout_failures += 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+
+pool_monitor = PoolMonitor()
+
+# Guards creation of `client`, so concurrent first use makes one client.
+client_lock = threading.Lock()
+
+
+def forget_client():
+    """
+    Run in a child process after fork(): the parent's client (and its
+    sockets) must not be shared, so the child will make its own.
+    """
+    global client, client_lock
+    client = None
+    client_lock = threading.Lock()
+    pool_monitor.reset()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=forget_client)
+
+
+def pool_stats() -> dict:
+    """
+    Report how much of this process's connection pool is in use.
+    """
+    max_size = PA_SETTINGS[MAX_POOL_SIZE]
+    with pool_monitor.lock:
+        return {
+            POOL_PID: os.getpid(),
+            POOL_MAX_SIZE: max_size,
+            POOL_OPEN: pool_monitor.open,
+            POOL_IN_USE: pool_monitor.in_use,
+            POOL_UTILIZATION: (pool_monitor.in_use / max_size
+                               if max_size else 0.0),
+            POOL_CHECKOUTS: pool_monitor.checkouts,
+            POOL_CHECKOUT_FAILURES: pool_monitor.checkout_failures,
+        }
+
+
+backend_lock = threading.Lock()
+
+
+def make_backend(name: str):
+    # imported here as the backends themselves import this module
+    if name == MEMORY:
+        from data.memory_backend import MemoryBackend
+        return MemoryBackend()
+    if name == SQLITE:
+        from data.sqlite_backend import SQLiteBackend
+        return SQLiteBackend()
+    raise ValueError(f'Unknown DB_BACKEND: {name}')
+
+
+def get_backend():
+    """
+    The engine standing in for Mongo (chosen with the DB_BACKEND env
+    var), or None if we are using Mongo itself.
+    """
+    global backend
+    if backend is None and DB_BACKEND != MONGO:
+        with backend_lock:
+            if backend is None:
+                backend = make_backend(DB_BACKEND)
+    return backend
+
+
+def set_backend(name: str):
+    """
+    Switch engines at run time, e.g. from a test. Starts out empty.
+    """
+    global DB_BACKEND, backend
+    with backend_lock:
+        DB_BACKEND = name
+        backend = None if name == MONGO else make_backend(name)
+
+
+def pluggable(fn):
+    """
+    Hand the call to the selected backend, if we aren't using Mongo.
+    This goes inside `handle_errors` and `retry_mongo`, so every engine
+    gets the same error handling, and outside `needs_db`, so the other
+    engines never open a Mongo client.
+    """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        engine = get_backend()
+        if engine is not None:
+            return getattr(engine, fn.__name__)(*args, **kwargs)
+        return fn(*args, **kwargs)
+    return wrapper
+
+
 def needs_db(fn):
     @wraps(fn)
     def wrapper(*args, **kwargs):
-        global client
-        if not client:
+        if client is None:
             connect_db()
         return fn(*args, **kwargs)
     return wrapper
 
-def retry_mongo(retries=3):   
-    def deco(fn):             
+
+# Retry and circuit breaker settings.
+RETRY_BASE_DELAY = env_float('MONGO_RETRY_BASE_DELAY', 0.1)  # seconds
+RETRY_MAX_DELAY = env_float('MONGO_RETRY_MAX_DELAY', 2.0)
+RETRY_DEADLINE = env_float('MONGO_RETRY_DEADLINE', 10.0)
+# consecutive connection failures that open the circuit
+BREAKER_THRESHOLD = env_int('MONGO_BREAKER_THRESHOLD', 5)
+# how long the circuit stays open before we let a trial call through
+BREAKER_RESET = env_float('MONGO_BREAKER_RESET', 30.0)
+
+# errors that mean "couldn't reach Mongo", as opposed to a bad query
+RETRYABLE = (AutoReconnect, NetworkTimeout)
+
+# circuit breaker states
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# keys of retry_stats()
+RETRIES = 'retries'
+GIVE_UPS = 'give_ups'
+TRIPS = 'trips'
+REJECTED = 'rejected'
+BREAKER_STATE = 'breaker_state'
+
+
+class DBError(Exception):
+    pass
+
+
+class CircuitOpenError(DBError):
+    """
+    Mongo has been failing, so we fail fast instead of waiting on it.
+    """
+
+
+class CircuitBreaker:
+    """
+    After `threshold` connection failures in a row we stop calling Mongo
+    for `reset_after` seconds; then one trial call decides whether to
+    close the circuit again.
+    """
+    def __init__(self, threshold: int, reset_after: float):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.opened_at = 0.0
+            self.trips = 0
+            self.rejected = 0
+
+    def before_call(self):
+        with self.lock:
+            if self.state == CLOSED:
+                return
+            if (self.state == OPEN
+                    and time.monotonic() - self.opened_at >= self.reset_after):
+                self.state = HALF_OPEN  # this caller is the trial
+                return
+            self.rejected += 1
+        raise CircuitOpenError('The database is unavailable; '
+                               'not trying again yet.')
+
+    def record_success(self):
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if (self.state == HALF_OPEN
+                    or (self.state == CLOSED
+                        and self.failures >= self.threshold)):
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                self.trips += 1
+
+    def is_open(self) -> bool:
+        return self.state != CLOSED
+
+
+breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_RESET)
+
+retry_counts = {RETRIES: 0, GIVE_UPS: 0}
+retry_counts_lock = threading.Lock()
+
+
+def count_retry(key: str):
+    with retry_counts_lock:
+        retry_counts[key] += 1
+
+
+def retry_stats() -> dict:
+    with retry_counts_lock:
+        stats = dict(retry_counts)
+    stats[TRIPS] = breaker.trips
+    stats[REJECTED] = breaker.rejected
+    stats[BREAKER_STATE] = breaker.state
+    return stats
+
+
+def backoff_delay(attempt: int, base: float = None,
+                  cap: float = None) -> float:
+    """
+    Exponential backoff with "full jitter": a random wait of up to
+    base * 2**attempt seconds (capped), so clients that failed together
+    don't all come back together.
+    """
+    base = RETRY_BASE_DELAY if base is None else base
+    cap = RETRY_MAX_DELAY if cap is None else cap
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def retry_decision(attempt: int, retries: int, give_up_at: float):
+    """
+    Record a connection failure and say how long to wait before the
+    next attempt, or None if we should give up.
+    Shared by the sync and async `retry_mongo()`s.
+    """
+    breaker.record_failure()
+    delay = backoff_delay(attempt)
+    if (attempt == retries - 1 or breaker.is_open()
+            or time.monotonic() + delay > give_up_at):
+        count_retry(GIVE_UPS)
+        return None
+    count_retry(RETRIES)
+    return delay
+
+
+def retry_mongo(retries=3, deadline=None):
+    """
+    Retry connection failures with backoff, for at most `deadline`
+    seconds in all, going through the circuit breaker on every attempt.
+    """
+    def deco(fn):
         @wraps(fn)
-        def wrapper(*args, **kwargs):  
+        def wrapper(*args, **kwargs):
+            give_up_at = time.monotonic() + (RETRY_DEADLINE
+                                             if deadline is None
+                                             else deadline)
             for attempt in range(retries):
+                breaker.before_call()
                 try:
-                    return fn(*args, **kwargs)
-                except (AutoReconnect, NetworkTimeout):
-                    if attempt == retries - 1:
+                    ret = fn(*args, **kwargs)
+                except RETRYABLE:
+                    delay = retry_decision(attempt, retries, give_up_at)
+                    if delay is None:
                         raise
+                    metrics.record_retry(
+                        metrics.op_collection(args, kwargs), fn.__name__)
+                    time.sleep(delay)
+                except BaseException:
+                    # anything else means the db is there (and ends a
+                    # trial call, which would otherwise hold the circuit
+                    # half open for good)
+                    breaker.record_success()
+                    raise
+                else:
+                    breaker.record_success()
+                    return ret
         return wrapper
     return deco
 
-class DBError(Exception):
-    pass
 
 def handle_errors(fn):
+    """
+    Turn pymongo errors into DBErrors, and time the whole call, retries
+    included, for `get_metrics()`.
+    """
     @wraps(fn)
     def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        ret, error = None, True
         try:
-            return fn(*args, **kwargs)
+            ret = fn(*args, **kwargs)
+            error = False
+            return ret
         except pm.errors.PyMongoError as e:
             raise DBError(str(e)) from e
+        finally:
+            metrics.record_op(metrics.op_collection(args, kwargs),
+                              fn.__name__,
+                              (time.perf_counter() - start) * 1000,
+                              metrics.doc_count(ret), error)
     return wrapper
 
+
+def stream_errors(fn):
+    """
+    The streamed reads can't be retried once the caller is consuming
+    them, but they still go through the circuit breaker, and we pull
+    the first doc before handing them back: a db that is down then fails
+    the call, as a DBError, rather than a response already under way.
+    The time to that first doc is recorded for `get_metrics()`.
+    """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        error = True
+        breaker.before_call()
+        try:
+            docs = fn(*args, **kwargs)
+            first = next(docs, None)
+            error = False
+        except (pm.errors.PyMongoError, DBError) as e:
+            cause = e if isinstance(e, pm.errors.PyMongoError) else e.__cause__
+            if isinstance(cause, RETRYABLE):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            if isinstance(e, DBError):
+                raise
+            raise DBError(str(e)) from e
+        except BaseException:
+            breaker.record_success()
+            raise
+        finally:
+            metrics.record_op(metrics.op_collection(args, kwargs),
+                              fn.__name__,
+                              (time.perf_counter() - start) * 1000,
+                              0, error)
+        breaker.record_success()
+        return rest_of(first, docs)
+    return wrapper
+
+
+def rest_of(first, docs):
+    """
+    `docs` again, with the `first` already pulled put back in front.
+    """
+    if first is None:
+        return
+    yield first
+    yield from docs
+
+
+def get_metrics() -> dict:
+    """
+    Latency histograms and counts per collection and operation: see
+    data/metrics.py.
+    """
+    return metrics.snapshot()
+
+
+def reset_metrics():
+    metrics.reset()
+
+
 def connect_db():
     """
     This provides a uniform way to connect to the DB across all uses.
-    Returns a mongo client object... maybe we shouldn't?
-    Also set global client variable.
-    We should probably either return a client OR set a
-    client global.
+    Sets the global client for this process and returns it.
+    The lock makes sure threads racing through first use share one
+    client, and `forget_client()` makes sure a forked child never uses
+    its parent's.
     """
     global client
     if client is None:  # not connected yet!
-        if os.environ.get('CLOUD_MONGO', LOCAL) == CLOUD:
-            password = os.environ.get('MONGO_PASSWD')
-            if not password:
-                raise ValueError('You must set your password '
-                                 + 'to use Mongo in the cloud.')
-            print('Connecting to Mongo in the cloud.')
-            client = pm.MongoClient(f'{cloud_mdb}://{user_nm}:{password}'
-                                    + f'@{cloud_svc}/{SE_DB}'
-                                    + f'?{db_params}',
-                                    tlsCAFile=certifi.where(), **PA_SETTINGS)
-            client.admin.command("ping")
-            print("MongoDB ping successful")
-        else:
-            print("Connecting to Mongo locally.")
-            client = pm.MongoClient()
+        with client_lock:
+            if client is None:
+                new = new_client()
+                if ENSURE_INDEXES:
+                    build_indexes(new)
+                client = new
     return client
 
 
+class CollScanWarning(UserWarning):
+    """
+    A query filters on fields that no registered index covers, so Mongo
+    will have to scan the whole collection.
+    """
+
+
+def register_indexes(collection: str, indexes: list):
+    """
+    Declare the indexes a collection needs, as a list of
+    {INDEX_KEYS: [(field, direction), ...], INDEX_UNIQUE: bool} specs.
+    The query modules call this when they are imported; the indexes
+    are built by `build_indexes()` when we connect.
+    """
+    index_registry[collection] = indexes
+
+
+def index_options(spec: dict) -> dict:
+    """
+    The create_index() options for an index spec. An index with a
+    collation needs its own name, as it may share its keys with another.
+    """
+    options = {'unique': spec.get(INDEX_UNIQUE, False)}
+    if spec.get(INDEX_COLLATION):
+        options['collation'] = Collation(**spec[INDEX_COLLATION])
+        options['name'] = '_'.join(f'{field}_{direction}' for field, direction
+                                   in spec[INDEX_KEYS]) + '_collated'
+    return options
+
+
+def build_indexes(mongo_client, db=SE_DB):
+    """
+    Create every registered index.
+    create_index() does nothing for an index that already exists, so
+    this is safe to run on every start.
+    An index we can't build (e.g. a unique index over duplicate data)
+    is reported, not fatal.
+    """
+    for collection, indexes in index_registry.items():
+        for spec in indexes:
+            try:
+                mongo_client[db][collection].create_index(
+                    spec[INDEX_KEYS], **index_options(spec))
+            except pm.errors.OperationFailure as e:
+                warnings.warn(f'Could not build index {spec[INDEX_KEYS]} '
+                              f'on {collection}: {e}')
+
+
+@handle_errors
+@needs_db
+def ensure_indexes(db=SE_DB):
+    """
+    Build the registered indexes now, e.g. from a deploy script.
+    """
+    build_indexes(client, db=db)
+
+
+def filter_keys(filt: dict) -> set:
+    """
+    The fields a filter tests, looking inside $and / $or.
+    """
+    keys = set()
+    for key, val in (filt or {}).items():
+        if key in ('$and', '$or'):
+            for sub_filt in val:
+                keys |= filter_keys(sub_filt)
+        elif not key.startswith('$'):
+            keys.add(key)
+    return keys
+
+
+def is_indexed(collection: str, filt: dict) -> bool:
+    """
+    Can Mongo answer this filter from an index?
+    An index helps if its leading field is one of the filter's fields.
+    Collections with no registered indexes aren't checked.
+    """
+    if collection not in index_registry:
+        return True
+    keys = filter_keys(filt)
+    if not keys or MONGO_ID in keys:
+        return True
+    leading = {spec[INDEX_KEYS][0][0]
+               for spec in index_registry[collection]}
+    return bool(keys & leading)
+
+
+def check_indexed(collection: str, filt: dict):
+    """
+    Warn (once per shape of filter) about queries that would scan the
+    whole collection.
+    """
+    if is_indexed(collection, filt):
+        return
+    shape = (collection, frozenset(filter_keys(filt)))
+    if shape not in collscan_warned:
+        collscan_warned.add(shape)
+        warnings.warn(f'{collection} has no index for a filter on '
+                      f'{sorted(shape[1])}: this is a collection scan.',
+                      CollScanWarning, stacklevel=3)
+
+
+def is_sort_indexed(collection: str, sort, collation=None) -> bool:
+    """
+    Can an index hand back docs in this order, so that nobody has to
+    sort them?
+    It can if its keys start with the sort's fields, in the same order,
+    with the directions all the same or all reversed, and it has the
+    same collation.
+    """
+    if not sort:
+        return True
+    for spec in index_registry.get(collection, []):
+        if spec.get(INDEX_COLLATION) != collation:
+            continue
+        keys = spec[INDEX_KEYS][:len(sort)]
+        if [field for field, _ in keys] != [field for field, _ in sort]:
+            continue
+        flips = {direction == key_dir for (_, direction), (_, key_dir)
+                 in zip(sort, keys)}
+        if len(flips) == 1:
+            return True
+    return False
+
+
+def is_case_insensitive(collation) -> bool:
+    """
+    For the backends: strength 1 or 2 ignores case.
+    """
+    return bool(collation) and collation.get('strength', 3) <= 2
+
+
+def is_cloud() -> bool:
+    return os.environ.get('CLOUD_MONGO', LOCAL) == CLOUD
+
+
+def client_args() -> tuple:
+    """
+    The (uri, settings) that both our sync and async clients are built
+    from. A uri of None means the local default.
+    """
+    settings = dict(PA_SETTINGS, event_listeners=[pool_monitor,
+                                                  metrics.command_monitor])
+    if not is_cloud():
+        return None, settings
+    password = os.environ.get('MONGO_PASSWD')
+    if not password:
+        raise ValueError('You must set your password '
+                         + 'to use Mongo in the cloud.')
+    uri = (f'{cloud_mdb}://{user_nm}:{password}'
+           + f'@{cloud_svc}/{SE_DB}'
+           + f'?{db_params}')
+    return uri, dict(settings, tlsCAFile=certifi.where())
+
+
+def new_client():
+    uri, settings = client_args()
+    if uri:
+        print('Connecting to Mongo in the cloud.')
+        new = pm.MongoClient(uri, **settings)
+        new.admin.command("ping")
+        print("MongoDB ping successful")
+    else:
+        print("Connecting to Mongo locally.")
+        new = pm.MongoClient(**settings)
+    return new
+
+
 def convert_mongo_id(doc: dict | None):
     if not doc:
         return
     if MONGO_ID in doc:
         doc[MONGO_ID] = str(doc[MONGO_ID])
 
+
 @handle_errors
 @retry_mongo()
+@pluggable
 @needs_db
 def create(collection, doc, db=SE_DB):
     """
     Insert a single doc into collection.
     """
-    print(f'{db=}')
     ret = client[db][collection].insert_one(doc)
     return str(ret.inserted_id)
 
+
 @handle_errors
 @retry_mongo()
+@pluggable
 @needs_db
 def read_one(collection, filt, db=SE_DB):
     """
     Find with a filter and return on the first doc found.
     Return None if not found.
     """
+    check_indexed(collection, filt)
     doc = client[db][collection].find_one(filt)
     if doc:
-        convert_mongo_id(doc) 
-    return doc   
+        convert_mongo_id(doc)
+    return doc
+
 
 @handle_errors
 @retry_mongo()
+@pluggable
 @needs_db
 def delete(collection: str, filt: dict, db=SE_DB):
     """
     Find with a filter and return on the first doc found.
     """
-    print(f'{filt=}')
+    check_indexed(collection, filt)
     del_result = client[db][collection].delete_one(filt)
     return del_result.deleted_count
 
+
 @handle_errors
 @retry_mongo()
+@pluggable
 @needs_db
 def update(collection, filters, update_dict, db=SE_DB):
+    check_indexed(collection, filters)
     res = client[db][collection].update_one(filters, {'$set': update_dict})
     return res.modified_count
 
+
+def validate_batch(docs: list, validate=None, ordered=True) -> dict:
+    """
+    Run `validate` over a batch.
+    Returns a dict mapping the index of each doc we must not write to
+    the reason why.
+    With `ordered` everything after the first bad doc is skipped too.
+    """
+    if not isinstance(docs, list):
+        raise ValueError(f'Bad type for {type(docs)=}')
+    bad = {}
+    for i, doc in enumerate(docs):
+        if ordered and bad:
+            bad[i] = NOT_ATTEMPTED
+            continue
+        if validate:
+            try:
+                validate(doc)
+            except ValueError as e:
+                bad[i] = str(e)
+    return bad
+
+
+def batches(items: list, size: int = BULK_BATCH_SIZE):
+    for start in range(0, len(items), size):
+        yield start, items[start:start + size]
+
+
+def create_many(collection, docs: list, db=SE_DB, ordered=True,
+                validate=None) -> list:
+    """
+    Validate a batch of docs and insert the good ones.
+    Returns one result per doc, in order: {BULK_ID: new_id} or
+    {BULK_ERROR: reason}.
+    With `ordered` we stop at the first failure, as Mongo does.
+    """
+    results = [None] * len(docs)
+    for i, reason in validate_batch(docs, validate, ordered).items():
+        results[i] = {BULK_ERROR: reason}
+    good = [i for i, res in enumerate(results) if res is None]
+    if good:
+        written = insert_many(collection, [docs[i] for i in good], db=db,
+                              ordered=ordered)
+        for i, res in zip(good, written):
+            results[i] = res
+    return results
+
+
+@handle_errors
+@retry_mongo(retries=1)
+@pluggable
+@needs_db
+def insert_many(collection, docs: list, db=SE_DB, ordered=True) -> list:
+    """
+    Insert docs with insert_many(), in chunks of BULK_BATCH_SIZE,
+    returning one {BULK_ID}/{BULK_ERROR} result per doc.
+    There is no retry here (a retried batch would collide with the docs
+    that made it in the first time), but the circuit breaker still
+    applies.
+    """
+    results = []
+    stopped = False
+    for _, batch in batches(docs):
+        failed = {}
+        if not stopped:
+            try:
+                client[db][collection].insert_many(batch, ordered=ordered)
+            except BulkWriteError as e:
+                for err in e.details.get('writeErrors', []):
+                    failed[err['index']] = err.get('errmsg', str(e))
+        for pos, doc in enumerate(batch):
+            if pos in failed:
+                results.append({BULK_ERROR: failed[pos]})
+            elif stopped or (ordered and failed and pos > min(failed)):
+                results.append({BULK_ERROR: NOT_ATTEMPTED})
+            else:
+                results.append({BULK_ID: str(doc[MONGO_ID])})
+        stopped = stopped or (ordered and bool(failed))
+    return results
+
+
+def to_write_model(op: tuple):
+    if op[0] == UPDATE:
+        _, filt, update_dict = op
+        return pm.UpdateOne(filt, {'$set': update_dict})
+    if op[0] == DELETE:
+        return pm.DeleteOne(op[1])
+    raise ValueError(f'Bad bulk operation: {op[0]}')
+
+
+def bulk_write(collection, items: list, db=SE_DB, ordered=True,
+               make_op=None) -> dict:
+    """
+    Validate a batch of updates and deletes and run the good ones.
+    `make_op` turns each item into an (UPDATE, filt, update_dict) or
+    (DELETE, filt) tuple, raising ValueError for a bad item; without it
+    the items must already be such tuples.
+    Returns the totals plus a list of {BULK_INDEX, BULK_ERROR} dicts for
+    the items that were not written.
+    """
+    bad = validate_batch(items, make_op, ordered)
+    good = [i for i in range(len(items)) if i not in bad]
+    ret = {BULK_MATCHED: 0, BULK_MODIFIED: 0, BULK_DELETED: 0}
+    if good:
+        ops = [make_op(items[i]) if make_op else items[i] for i in good]
+        ret, failed = write_ops(collection, ops, db=db, ordered=ordered)
+        for pos, reason in failed.items():
+            bad[good[pos]] = reason
+        if ordered and failed:
+            first_bad = good[min(failed)]
+            for i in good:
+                if i > first_bad and i not in bad:
+                    bad[i] = NOT_ATTEMPTED
+    ret[BULK_ERRORS] = [{BULK_INDEX: i, BULK_ERROR: bad[i]}
+                        for i in sorted(bad)]
+    return ret
+
+
+@handle_errors
+@retry_mongo(retries=1)
+@pluggable
+@needs_db
+def write_ops(collection, ops: list, db=SE_DB, ordered=True) -> tuple:
+    """
+    Run bulk_write() over `ops` in chunks of BULK_BATCH_SIZE.
+    Returns the totals and a dict of {position in ops: reason} for the
+    ops that failed.
+    Not retried, as for insert_many().
+    """
+    totals = {BULK_MATCHED: 0, BULK_MODIFIED: 0, BULK_DELETED: 0}
+    failed = {}
+    for start, batch in batches(ops):
+        try:
+            res = client[db][collection].bulk_write(
+                [to_write_model(op) for op in batch], ordered=ordered)
+            details = {'nMatched': res.matched_count,
+                       'nModified': res.modified_count,
+                       'nRemoved': res.deleted_count}
+        except BulkWriteError as e:
+            details = e.details
+            for err in details.get('writeErrors', []):
+                failed[start + err['index']] = err.get('errmsg', str(e))
+        totals[BULK_MATCHED] += details.get('nMatched', 0)
+        totals[BULK_MODIFIED] += details.get('nModified', 0)
+        totals[BULK_DELETED] += details.get('nRemoved', 0)
+        if ordered and failed:
+            break
+    return totals, failed
+
+
+def make_projection(fields, no_id=True) -> dict | None:
+    """
+    Turn a list of field names (or a ready-made projection dict) into
+    a Mongo projection.
+    If `no_id` is set we ask Mongo not to send `_id` at all, rather than
+    deleting it from every doc after it has crossed the wire.
+    """
+    if fields is None:
+        return {MONGO_ID: 0} if no_id else None
+    if isinstance(fields, dict):
+        projection = dict(fields)
+    else:
+        projection = {field: 1 for field in fields}
+    if no_id:
+        projection[MONGO_ID] = 0
+    return projection
+
+
+def find_cursor(collection, db=SE_DB, no_id=True, filt=None, fields=None,
+                sort=None, limit=0, batch_size=0, collation=None,
+                raw=False):
+    """
+    Build (but don't run) a find cursor with everything pushed down.
+    With `raw` it yields RawBSONDocuments.
+    """
+    check_indexed(collection, filt)
+    coll = (client[db].get_collection(collection, codec_options=RAW_OPTIONS)
+            if raw else client[db][collection])
+    return coll.find(
+        filt or {}, make_projection(fields, no_id), sort=sort, limit=limit,
+        batch_size=batch_size,
+        collation=Collation(**collation) if collation else None)
+
+
+def clean_doc(doc: dict, no_id=True) -> dict:
+    if no_id:
+        doc.pop(MONGO_ID, None)
+    else:
+        convert_mongo_id(doc)
+    return doc
+
+
 @handle_errors
 @retry_mongo()
+@pluggable
 @needs_db
-def read(collection, db=SE_DB, no_id=True) -> list:
+def read(collection, db=SE_DB, no_id=True, filt=None, fields=None,
+         sort=None, limit=0, collation=None) -> list:
     """
     Returns a list from the db.
+    `filt`, `fields` (a projection), `sort` (a list of (key, direction)
+    pairs) and `limit` are all executed inside MongoDB, so only the
+    docs and fields asked for come back over the wire.
+    `collation` (e.g. CI_COLLATION) applies to the filter and the sort.
     """
-    ret = []
-    for doc in client[db][collection].find():
-        if no_id:
-            del doc[MONGO_ID]
-        else:
-            convert_mongo_id(doc)
-        ret.append(doc)
-    return ret
+    cursor = find_cursor(collection, db=db, no_id=no_id, filt=filt,
+                         fields=fields, sort=sort, limit=limit,
+                         collation=collation)
+    return [clean_doc(doc, no_id) for doc in cursor]
+
+
+@stream_errors
+@pluggable
+@needs_db
+def read_iter(collection, db=SE_DB, no_id=True, filt=None, fields=None,
+              sort=None, limit=0, batch_size=DEFAULT_BATCH_SIZE,
+              collation=None):
+    """
+    A generator version of `read()`.
+    Docs are pulled from the server `batch_size` at a time, so memory
+    stays flat however big the collection is.
+    A failure part way through can't be retried, so it is just raised
+    as a DBError; see `stream_errors()` for a failure at the start.
+    """
+    cursor = find_cursor(collection, db=db, no_id=no_id, filt=filt,
+                         fields=fields, sort=sort, limit=limit,
+                         batch_size=batch_size, collation=collation)
+    try:
+        for doc in cursor:
+            yield clean_doc(doc, no_id)
+    except pm.errors.PyMongoError as e:
+        raise DBError(str(e)) from e
+    finally:
+        cursor.close()
+
 
 @handle_errors
-@retry_mongo
+@retry_mongo()
+@pluggable
+@needs_db
+def count(collection, filt=None, db=SE_DB) -> int:
+    """
+    How many docs match `filt`, counted by the server.
+    With no filter we use the collection's metadata, which costs the
+    same however big the collection is.
+    """
+    if not filt:
+        return client[db][collection].estimated_document_count()
+    check_indexed(collection, filt)
+    return client[db][collection].count_documents(filt)
+
+
+@handle_errors
+@retry_mongo()
+@pluggable
+@needs_db
+def group_count(collection, field, filt=None, db=SE_DB) -> dict:
+    """
+    Count the docs for each value of `field` with an aggregation
+    pipeline, so only the totals come back: {value: count}.
+    Docs without the field are counted under None.
+    """
+    pipeline = [{'$group': {MONGO_ID: f'${field}', 'count': {'$sum': 1}}},
+                {'$sort': {MONGO_ID: ASCENDING}}]
+    if filt:
+        check_indexed(collection, filt)
+        pipeline.insert(0, {'$match': filt})
+    return {group[MONGO_ID]: group['count']
+            for group in client[db][collection].aggregate(pipeline)}
+
+
+def page_sort(sort) -> list:
+    """
+    A page's sort keys, with `_id` last so that every doc has a distinct
+    position, even when the other keys tie.
+    `_id` goes the way the last key goes, so an index ending in `_id`
+    (see `register_indexes()`) can be read backwards for a descending
+    sort too.
+    """
+    keys = [(field, direction) for field, direction in (sort or [])
+            if field != MONGO_ID]
+    last = dict(sort or []).get(MONGO_ID,
+                                keys[-1][1] if keys else ASCENDING)
+    return keys + [(MONGO_ID, last)]
+
+
+def encode_cursor(keys: list, doc: dict, collation=None) -> str:
+    """
+    An opaque token for the position just after `doc` in `keys` order.
+    """
+    state = {'sort': keys, 'collation': collation,
+             'after': [doc.get(field) for field, _ in keys]}
+    return base64.urlsafe_b64encode(
+        json_util.dumps(state).encode()).decode()
+
+
+def decode_cursor(cursor: str, keys: list, collation=None) -> list:
+    """
+    Returns the sort key values stored in `cursor`. A cursor made for
+    another sort order is refused.
+    """
+    try:
+        state = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+        values = state['after']
+        same_sort = [list(key) for key in state['sort']] == [
+            list(key) for key in keys] and state.get('collation') == collation
+    except (binascii.Error, ValueError, KeyError, TypeError,
+            UnicodeDecodeError):
+        raise ValueError(f'Bad page cursor: {cursor}')
+    if not same_sort or len(values) != len(keys):
+        raise ValueError('The page cursor is for a different sort order.')
+    if isinstance(values[-1], str) and ObjectId.is_valid(values[-1]):
+        values[-1] = ObjectId(values[-1])
+    return values
+
+
+def after_cond(field: str, direction: int, value) -> dict | None:
+    """
+    Docs that come after `value` on one key, or None if none can.
+    Nulls sort first, so they come after everything going down and
+    before everything going up.
+    """
+    if direction == ASCENDING:
+        if value is None:
+            return {field: {'$ne': None}}
+        return {field: {'$gt': value}}
+    if value is None:
+        return None
+    return {'$or': [{field: {'$lt': value}}, {field: None}]}
+
+
+def after_filter(keys: list, values: list) -> dict:
+    """
+    The keyset range query for "after this position":
+        k1 > v1 or (k1 == v1 and k2 > v2) or ...
+    Each branch starts with an equality prefix on the sort keys, so an
+    index on them answers it without a skip.
+    """
+    branches = []
+    for pos, (field, direction) in enumerate(keys):
+        branch = {key: values[i] for i, (key, _) in enumerate(keys[:pos])}
+        cond = after_cond(field, direction, values[pos])
+        if cond is None:
+            continue
+        branches.append({'$and': [branch, cond]} if branch else cond)
+    return {'$or': branches} if branches else {MONGO_ID: {'$in': []}}
+
+
+def read_page(collection, db=SE_DB, no_id=True, filt=None, fields=None,
+              sort=None, limit=DEFAULT_PAGE_SIZE, after=None,
+              collation=None) -> tuple:
+    """
+    One page of a sorted read, using keyset pagination: `after` is the
+    cursor returned with the previous page, and turns into a range
+    query on the sort keys rather than a skip, so every page costs the
+    same however deep it is.
+    Returns (docs, cursor for the next page or None on the last page).
+    """
+    if not isinstance(limit, int) or limit < 1:
+        raise ValueError(f'Bad value for {limit=}')
+    keys = page_sort(sort)
+    if after:
+        range_filt = after_filter(keys, decode_cursor(after, keys,
+                                                      collation))
+        filt = {'$and': [filt, range_filt]} if filt else range_filt
+    extra = []
+    if fields is not None:
+        fields = list(fields)
+        extra = [field for field, _ in keys if field not in fields]
+        fields += extra
+    docs = read(collection, db=db, no_id=False, filt=filt, fields=fields,
+                sort=keys, limit=limit + 1, collation=collation)
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        next_cursor = encode_cursor(keys, docs[-1], collation)
+    for doc in docs:
+        for field in extra:
+            doc.pop(field, None)
+        if no_id:
+            doc.pop(MONGO_ID, None)
+    return docs, next_cursor
+
+
+def relaxed_json(val) -> str:
+    """
+    A decoded BSON value as relaxed extended JSON, laid out exactly as
+    python-bsonjs (libbson) lays it out, so a doc reads the same whether
+    or not that is installed.
+    """
+    if isinstance(val, dict):
+        return '{ ' + ', '.join(f'{json.dumps(key, ensure_ascii=False)} : '
+                                f'{relaxed_json(item)}'
+                                for key, item in val.items()) + ' }'
+    if isinstance(val, list):
+        return '[ ' + ', '.join(relaxed_json(item) for item in val) + ' ]'
+    if val is None or isinstance(val, bool) or type(val) is str:
+        return json.dumps(val, ensure_ascii=False)
+    if isinstance(val, int):
+        return str(int(val))
+    if isinstance(val, float):
+        if not math.isfinite(val):
+            return relaxed_json({'$numberDouble': str(val).replace(
+                'inf', 'Infinity').replace('nan', 'NaN')})
+        text = format(val, '.20g')
+        return text + '.0' if text.lstrip('-').isdigit() else text
+    return relaxed_json(json_util.default(
+        val, json_options=json_util.RELAXED_JSON_OPTIONS))
+
+
+def raw_to_json(raw: RawBSONDocument) -> str:
+    if bsonjs is not None:
+        return bsonjs.dumps(raw.raw)
+    return relaxed_json(bson.decode(raw.raw))
+
+
+@stream_errors
+@pluggable
 @needs_db
+def read_json_iter(collection, db=SE_DB, filt=None, fields=None, sort=None,
+                   limit=0, batch_size=DEFAULT_BATCH_SIZE, collation=None):
+    """
+    As `read_iter()`, but yields each doc (without `_id`) as a JSON
+    string, for responses that are going to be JSON anyway.
+    Docs come off the wire as RawBSONDocuments and, if python-bsonjs is
+    installed, are turned into JSON without ever becoming dicts.
+    Without it each doc is decoded just long enough to be dumped.
+    """
+    cursor = find_cursor(collection, db=db, filt=filt, fields=fields,
+                         sort=sort, limit=limit, batch_size=batch_size,
+                         collation=collation, raw=True)
+    try:
+        for raw in cursor:
+            yield raw_to_json(raw)
+    except pm.errors.PyMongoError as e:
+        raise DBError(str(e)) from e
+    finally:
+        cursor.close()
+
+
 def read_dict(collection, key, db=SE_DB, no_id=True) -> dict:
+    """
+    `read()` already connects, retries and converts errors.
+    """
     recs = read(collection, db=db, no_id=no_id)
     recs_as_dict = {}
     for rec in recs:
         recs_as_dict[rec[key]] = rec
     return recs_as_dict
 
-@handle_errors
-@retry_mongo
-@needs_db
+
 def fetch_all_as_dict(key, collection, db=SE_DB):
-    ret = {}
-    for doc in client[db][collection].find():
-        del doc[MONGO_ID]
-        ret[doc[key]] = doc
-    return ret
+    return read_dict(collection, key, db=db)
+
 
 def is_valid_id(_id: str) -> bool:
     if not isinstance(_id, str):
@@ -196,4 +1277,3 @@ def is_valid_id(_id: str) -> bool:
     if len(_id) < MIN_ID_LEN:
         return False
     return True
-
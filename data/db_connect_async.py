@@ -0,0 +1,212 @@
+"""
+The asyncio twin of db_connect.py.
+The functions here have the same names and arguments as there, but are
+coroutines, so one process can keep many Mongo requests in flight
+instead of one per thread.
+"""
+import asyncio
+import os
+import time
+
+from functools import wraps
+
+from pymongo import AsyncMongoClient
+from pymongo.collation import Collation
+from pymongo.errors import PyMongoError
+
+import data.db_connect as dbc
+from data import metrics
+from data.db_connect import DBError, SE_DB
+
+client = None
+# An async client belongs to the event loop it was first used on.
+client_loop = None
+
+
+def forget_client():
+    global client, client_loop
+    client = None
+    client_loop = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=forget_client)
+
+
+def pluggable(fn):
+    """
+    As `dbc.pluggable()`: the other engines are in-process, so we just
+    call them.
+    """
+    @wraps(fn)
+    async def wrapper(*args, **kwargs):
+        engine = dbc.get_backend()
+        if engine is not None:
+            return getattr(engine, fn.__name__)(*args, **kwargs)
+        return await fn(*args, **kwargs)
+    return wrapper
+
+
+def needs_db(fn):
+    @wraps(fn)
+    async def wrapper(*args, **kwargs):
+        if client is None or client_loop is not asyncio.get_running_loop():
+            await connect_db()
+        return await fn(*args, **kwargs)
+    return wrapper
+
+
+def retry_mongo(retries=3, deadline=None):
+    """
+    The same backoff, deadline and circuit breaker as `dbc.retry_mongo()`,
+    but waiting with asyncio.sleep().
+    """
+    def deco(fn):
+        @wraps(fn)
+        async def wrapper(*args, **kwargs):
+            give_up_at = time.monotonic() + (dbc.RETRY_DEADLINE
+                                             if deadline is None
+                                             else deadline)
+            for attempt in range(retries):
+                dbc.breaker.before_call()
+                try:
+                    ret = await fn(*args, **kwargs)
+                except dbc.RETRYABLE:
+                    delay = dbc.retry_decision(attempt, retries, give_up_at)
+                    if delay is None:
+                        raise
+                    metrics.record_retry(
+                        metrics.op_collection(args, kwargs), fn.__name__)
+                    await asyncio.sleep(delay)
+                except BaseException:
+                    # anything else means the db is there (and ends a
+                    # trial call, which would otherwise hold the circuit
+                    # half open for good)
+                    dbc.breaker.record_success()
+                    raise
+                else:
+                    dbc.breaker.record_success()
+                    return ret
+        return wrapper
+    return deco
+
+
+def handle_errors(fn):
+    """
+    As `dbc.handle_errors()`, recording into the same metrics.
+    """
+    @wraps(fn)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        ret, error = None, True
+        try:
+            ret = await fn(*args, **kwargs)
+            error = False
+            return ret
+        except PyMongoError as e:
+            raise DBError(str(e)) from e
+        finally:
+            metrics.record_op(metrics.op_collection(args, kwargs),
+                              fn.__name__,
+                              (time.perf_counter() - start) * 1000,
+                              metrics.doc_count(ret), error)
+    return wrapper
+
+
+async def connect_db():
+    """
+    Make the async client for the running event loop.
+    There is no await between the check and the assignment, so
+    coroutines on the same loop can't create two clients.
+    A client left over from another loop is closed, not leaked.
+    """
+    global client, client_loop
+    loop = asyncio.get_running_loop()
+    if client is None or client_loop is not loop:
+        old, old_loop = client, client_loop
+        uri, settings = dbc.client_args()
+        client = AsyncMongoClient(uri, **settings)
+        client_loop = loop
+        if old is not None:
+            await close_client(old, old_loop)
+        if uri:
+            await client.admin.command('ping')
+    return client
+
+
+async def close_client(old, old_loop):
+    """
+    Close a client made on another event loop.
+    If that loop is still running (in another thread) the close is
+    run there; otherwise it is tried here and any error is ignored,
+    as the loop that owned the client's sockets is gone.
+    """
+    try:
+        if old_loop is not None and old_loop.is_running():
+            asyncio.run_coroutine_threadsafe(old.close(), old_loop)
+        else:
+            await old.close()
+    except Exception:
+        pass
+
+
+@handle_errors
+@retry_mongo()
+@pluggable
+@needs_db
+async def create(collection, doc, db=SE_DB):
+    """
+    Insert a single doc into collection.
+    """
+    ret = await client[db][collection].insert_one(doc)
+    return str(ret.inserted_id)
+
+
+@handle_errors
+@retry_mongo()
+@pluggable
+@needs_db
+async def read_one(collection, filt, db=SE_DB):
+    """
+    Find with a filter and return on the first doc found.
+    Return None if not found.
+    """
+    doc = await client[db][collection].find_one(filt)
+    if doc:
+        dbc.convert_mongo_id(doc)
+    return doc
+
+
+@handle_errors
+@retry_mongo()
+@pluggable
+@needs_db
+async def delete(collection: str, filt: dict, db=SE_DB):
+    del_result = await client[db][collection].delete_one(filt)
+    return del_result.deleted_count
+
+
+@handle_errors
+@retry_mongo()
+@pluggable
+@needs_db
+async def update(collection, filters, update_dict, db=SE_DB):
+    res = await client[db][collection].update_one(filters,
+                                                  {'$set': update_dict})
+    return res.modified_count
+
+
+@handle_errors
+@retry_mongo()
+@pluggable
+@needs_db
+async def read(collection, db=SE_DB, no_id=True, filt=None, fields=None,
+               sort=None, limit=0, collation=None) -> list:
+    """
+    Returns a list from the db, with everything pushed down as in
+    `dbc.read()`.
+    """
+    cursor = client[db][collection].find(
+        filt or {}, dbc.make_projection(fields, no_id), sort=sort,
+        limit=limit, collation=Collation(**collation) if collation else None)
+    return [dbc.clean_doc(doc, no_id) async for doc in cursor]
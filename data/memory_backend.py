@@ -0,0 +1,339 @@
+"""
+An in-process storage engine: every collection is a dict of docs keyed
+by `_id`, with a hash index on each field that leads an index the query
+modules registered with `dbc.register_indexes()`.
+Select it with DB_BACKEND=memory. Nothing is saved when the process
+exits, which is what we want for tests and for benchmarking the rest of
+the stack with no network in the way.
+"""
+import threading
+
+from copy import deepcopy
+
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+import data.db_connect as dbc
+from data.backend import Backend
+from data.db_connect import MONGO_ID, SE_DB
+
+# Sort order of values of different types, roughly as in Mongo.
+TYPE_ORDER = {type(None): 0, bool: 4, int: 1, float: 1, str: 2}
+OTHER_TYPES = 3
+
+
+def get_field(doc: dict, path: str):
+    """
+    Look up a possibly dotted field; returns (found, value).
+    """
+    val = doc
+    for part in path.split('.'):
+        if not isinstance(val, dict) or part not in val:
+            return False, None
+        val = val[part]
+    return True, val
+
+
+def fold(val, ci: bool):
+    """
+    Strings compare without case under a case-insensitive collation.
+    """
+    return val.casefold() if ci and isinstance(val, str) else val
+
+
+def compare(op: str, val, arg, ci: bool = False) -> bool:
+    val, arg = fold(val, ci), fold(arg, ci)
+    try:
+        if op == '$gt':
+            return val > arg
+        if op == '$gte':
+            return val >= arg
+        if op == '$lt':
+            return val < arg
+        if op == '$lte':
+            return val <= arg
+    except TypeError:  # Mongo never matches across types
+        return False
+    raise ValueError(f'Unsupported operator: {op}')
+
+
+def matches_cond(found: bool, val, cond, ci: bool = False) -> bool:
+    is_ops = (isinstance(cond, dict) and cond
+              and all(key.startswith('$') for key in cond))
+    if not is_ops:
+        if cond is None:
+            return val is None
+        cond = fold(cond, ci)
+        return found and (fold(val, ci) == cond
+                          or (isinstance(val, list)
+                              and cond in [fold(item, ci) for item in val]))
+    for op, arg in cond.items():
+        if op == '$eq':
+            ok = matches_cond(found, val, arg, ci)
+        elif op == '$ne':
+            ok = not matches_cond(found, val, arg, ci)
+        elif op == '$in':
+            ok = any(matches_cond(found, val, item, ci) for item in arg)
+        elif op == '$nin':
+            ok = not any(matches_cond(found, val, item, ci) for item in arg)
+        elif op == '$exists':
+            ok = found == bool(arg)
+        else:
+            ok = found and val is not None and compare(op, val, arg, ci)
+        if not ok:
+            return False
+    return True
+
+
+def matches(doc: dict, filt: dict, ci: bool = False) -> bool:
+    """
+    Does `doc` pass a Mongo-style filter? With `ci`, strings are
+    compared without case.
+    Supports equality, $eq, $ne, $gt(e), $lt(e), $in, $nin, $exists,
+    $and and $or.
+    """
+    for key, cond in (filt or {}).items():
+        if key == '$and':
+            if not all(matches(doc, sub, ci) for sub in cond):
+                return False
+        elif key == '$or':
+            if not any(matches(doc, sub, ci) for sub in cond):
+                return False
+        elif not matches_cond(*get_field(doc, key), cond, ci):
+            return False
+    return True
+
+
+def project(doc: dict, projection: dict | None) -> dict:
+    """
+    Apply a projection as built by `dbc.make_projection()`.
+    """
+    if not projection:
+        return doc
+    keep = [field for field, on in projection.items() if on]
+    if keep:
+        ret = {field: doc[field] for field in keep if field in doc}
+        if projection.get(MONGO_ID, 1) and MONGO_ID in doc:
+            ret[MONGO_ID] = doc[MONGO_ID]
+        return ret
+    return {field: val for field, val in doc.items()
+            if projection.get(field, 1)}
+
+
+def sort_key(val, ci: bool = False):
+    rank = TYPE_ORDER.get(type(val), OTHER_TYPES)
+    return (rank, fold(val, ci) if rank != OTHER_TYPES else str(val))
+
+
+def sort_docs(docs: list, sort, ci: bool = False) -> list:
+    """
+    Sort by a list of (field, direction) pairs; missing fields sort as
+    null, i.e. first.
+    """
+    for field, direction in reversed(sort or []):
+        docs.sort(key=lambda doc: sort_key(get_field(doc, field)[1], ci),
+                  reverse=direction == dbc.DESCENDING)
+    return docs
+
+
+class MemCollection:
+    def __init__(self, indexes: list):
+        self.docs = {}
+        # field -> value -> set of _ids, for every field that leads
+        # a registered index
+        self.hashes = {spec[dbc.INDEX_KEYS][0][0]: {} for spec in indexes}
+        self.unique = [tuple(field for field, _ in spec[dbc.INDEX_KEYS])
+                       for spec in indexes if spec.get(dbc.INDEX_UNIQUE)]
+
+    def index(self, doc: dict):
+        for field, hash_idx in self.hashes.items():
+            val = doc.get(field)
+            if isinstance(val, (str, int, float, type(None))):
+                hash_idx.setdefault(val, set()).add(doc[MONGO_ID])
+
+    def unindex(self, doc: dict):
+        for field, hash_idx in self.hashes.items():
+            ids = hash_idx.get(doc.get(field))
+            if ids:
+                ids.discard(doc[MONGO_ID])
+
+    def check_unique(self, doc: dict, ignore=None):
+        for fields in self.unique:
+            key = tuple(doc.get(field) for field in fields)
+            for other in self.candidates(dict(zip(fields, key))):
+                if other[MONGO_ID] != ignore and tuple(
+                        other.get(field) for field in fields) == key:
+                    raise DuplicateKeyError(
+                        f'Duplicate key for {fields}: {key}')
+
+    def candidates(self, filt: dict):
+        """
+        The docs that might match: narrowed by the hash indexes when
+        the filter tests an indexed field for equality.
+        """
+        filt = filt or {}
+        if MONGO_ID in filt and not isinstance(filt[MONGO_ID], dict):
+            doc = self.docs.get(filt[MONGO_ID])
+            return [doc] if doc else []
+        best = None
+        for field, hash_idx in self.hashes.items():
+            val = filt.get(field)
+            if field in filt and not isinstance(val, (dict, list)):
+                ids = hash_idx.get(val, set())
+                if best is None or len(ids) < len(best):
+                    best = ids
+        if best is None:
+            return list(self.docs.values())
+        return [self.docs[_id] for _id in best]
+
+    def find(self, filt: dict, ci: bool = False) -> list:
+        """
+        The hash indexes are case-sensitive, so they can't narrow a
+        case-insensitive search.
+        """
+        if ci:
+            return [doc for doc in self.docs.values()
+                    if matches(doc, filt, ci)]
+        return [doc for doc in self.candidates(filt) if matches(doc, filt)]
+
+    def insert(self, doc: dict):
+        doc.setdefault(MONGO_ID, ObjectId())
+        if doc[MONGO_ID] in self.docs:
+            raise DuplicateKeyError(f'Duplicate _id: {doc[MONGO_ID]}')
+        self.check_unique(doc)
+        stored = deepcopy(doc)
+        self.docs[stored[MONGO_ID]] = stored
+        self.index(stored)
+        return stored[MONGO_ID]
+
+    def update(self, filt: dict, update_dict: dict) -> tuple:
+        """
+        Returns (matched, modified).
+        """
+        found = self.find(filt)
+        if not found:
+            return 0, 0
+        doc = found[0]
+        new = dict(doc, **deepcopy(update_dict))
+        if new == doc:
+            return 1, 0
+        self.check_unique(new, ignore=doc[MONGO_ID])
+        self.unindex(doc)
+        doc.update(new)
+        self.index(doc)
+        return 1, 1
+
+    def delete(self, filt: dict) -> int:
+        found = self.find(filt)
+        if not found:
+            return 0
+        self.unindex(found[0])
+        del self.docs[found[0][MONGO_ID]]
+        return 1
+
+
+class MemoryBackend(Backend):
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.dbs = {}
+
+    def collection(self, db: str, collection: str) -> MemCollection:
+        colls = self.dbs.setdefault(db, {})
+        if collection not in colls:
+            colls[collection] = MemCollection(
+                dbc.index_registry.get(collection, []))
+        return colls[collection]
+
+    def clear(self):
+        with self.lock:
+            self.dbs = {}
+
+    def create(self, collection, doc, db=SE_DB) -> str:
+        with self.lock:
+            return str(self.collection(db, collection).insert(doc))
+
+    def read_one(self, collection, filt, db=SE_DB) -> dict | None:
+        with self.lock:
+            found = self.collection(db, collection).find(filt)
+            if not found:
+                return None
+            doc = deepcopy(found[0])
+        dbc.convert_mongo_id(doc)
+        return doc
+
+    def read(self, collection, db=SE_DB, no_id=True, filt=None, fields=None,
+             sort=None, limit=0, collation=None) -> list:
+        projection = dbc.make_projection(fields, no_id)
+        ci = dbc.is_case_insensitive(collation)
+        with self.lock:
+            docs = sort_docs(self.collection(db, collection).find(filt, ci),
+                             sort, ci)
+            if limit:
+                docs = docs[:limit]
+            docs = [deepcopy(project(doc, projection)) for doc in docs]
+        return [dbc.clean_doc(doc, no_id) for doc in docs]
+
+    def read_iter(self, collection, db=SE_DB, no_id=True, filt=None,
+                  fields=None, sort=None, limit=0, batch_size=0,
+                  collation=None):
+        yield from self.read(collection, db=db, no_id=no_id, filt=filt,
+                             fields=fields, sort=sort, limit=limit,
+                             collation=collation)
+
+    def count(self, collection, filt=None, db=SE_DB) -> int:
+        with self.lock:
+            coll = self.collection(db, collection)
+            return len(coll.find(filt) if filt else coll.docs)
+
+    def group_count(self, collection, field, filt=None, db=SE_DB) -> dict:
+        counts = {}
+        with self.lock:
+            for doc in self.collection(db, collection).find(filt):
+                val = get_field(doc, field)[1]
+                counts[val] = counts.get(val, 0) + 1
+        return counts
+
+    def update(self, collection, filters, update_dict, db=SE_DB) -> int:
+        with self.lock:
+            return self.collection(db, collection).update(filters,
+                                                          update_dict)[1]
+
+    def delete(self, collection, filt, db=SE_DB) -> int:
+        with self.lock:
+            return self.collection(db, collection).delete(filt)
+
+    def insert_many(self, collection, docs, db=SE_DB, ordered=True) -> list:
+        results = []
+        with self.lock:
+            coll = self.collection(db, collection)
+            for doc in docs:
+                if ordered and results and dbc.BULK_ERROR in results[-1]:
+                    results.append({dbc.BULK_ERROR: dbc.NOT_ATTEMPTED})
+                    continue
+                try:
+                    results.append({dbc.BULK_ID: str(coll.insert(doc))})
+                except DuplicateKeyError as e:
+                    results.append({dbc.BULK_ERROR: str(e)})
+        return results
+
+    def write_ops(self, collection, ops, db=SE_DB, ordered=True) -> tuple:
+        totals = {dbc.BULK_MATCHED: 0, dbc.BULK_MODIFIED: 0,
+                  dbc.BULK_DELETED: 0}
+        failed = {}
+        with self.lock:
+            coll = self.collection(db, collection)
+            for pos, op in enumerate(ops):
+                try:
+                    if op[0] == dbc.UPDATE:
+                        matched, modified = coll.update(op[1], op[2])
+                        totals[dbc.BULK_MATCHED] += matched
+                        totals[dbc.BULK_MODIFIED] += modified
+                    elif op[0] == dbc.DELETE:
+                        totals[dbc.BULK_DELETED] += coll.delete(op[1])
+                    else:
+                        raise ValueError(f'Bad bulk operation: {op[0]}')
+                except (DuplicateKeyError, ValueError) as e:
+                    failed[pos] = str(e)
+                    if ordered:
+                        break
+        return totals, failed
@@ -0,0 +1,245 @@
+"""
+What our database calls cost, per collection and per operation.
+Two layers are measured:
+- operations: each call to a `dbc` function (create, read, ...), timed
+  by its `handle_errors` wrapper, with the retries `retry_mongo` made.
+  These cover every storage engine. For the streamed reads
+  (`read_iter()`, `read_json_iter()`) only the time to the first doc
+  is counted, by `stream_errors`, as the rest goes by while the caller
+  consumes them.
+- commands: each command pymongo sends to the server, as seen by
+  `CommandMonitor`, with the docs that came back. The find and getMore
+  commands of the streamed reads are counted here.
+  With MONGO_METRICS_BYTES=1 the bytes that went over the wire are
+  counted too; they are 0 otherwise.
+Read them with `dbc.get_metrics()`.
+"""
+import bisect
+import os
+import threading
+
+import bson
+
+from pymongo import monitoring
+
+# Measuring bytes means re-encoding every command and reply, so it is
+# off unless asked for.
+COUNT_BYTES = os.getenv('MONGO_METRICS_BYTES', '0') != '0'
+
+# upper bounds of the latency histogram buckets, in ms; slower calls
+# go in a last, open-ended bucket
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# keys of get_metrics()
+OPERATIONS = 'operations'
+COMMANDS = 'commands'
+COUNT = 'count'
+ERRORS = 'errors'
+RETRIES = 'retries'
+DOCS = 'docs'
+BYTES_SENT = 'bytes_sent'
+BYTES_RECEIVED = 'bytes_received'
+TOTAL_MS = 'total_ms'
+MAX_MS = 'max_ms'
+P50_MS = 'p50_ms'
+P95_MS = 'p95_ms'
+P99_MS = 'p99_ms'
+HISTOGRAM = 'histogram'
+
+
+def bucket_label(pos: int) -> str:
+    if pos < len(BUCKETS_MS):
+        return f'<={BUCKETS_MS[pos]}ms'
+    return f'>{BUCKETS_MS[-1]}ms'
+
+
+class OpStats:
+    """
+    Counters and a latency histogram for one (collection, operation).
+    """
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.docs = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+
+    def add(self, ms: float, docs: int = 0, error: bool = False):
+        self.count += 1
+        self.errors += error
+        self.docs += docs
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.buckets[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+
+    def percentile(self, fraction: float) -> float:
+        """
+        An estimate: the upper bound of the bucket the percentile is in.
+        """
+        if not self.count:
+            return 0.0
+        seen = 0
+        for pos, num in enumerate(self.buckets):
+            seen += num
+            if seen >= fraction * self.count:
+                break
+        return (float(BUCKETS_MS[pos]) if pos < len(BUCKETS_MS)
+                else self.max_ms)
+
+    def to_dict(self) -> dict:
+        return {
+            COUNT: self.count,
+            ERRORS: self.errors,
+            RETRIES: self.retries,
+            DOCS: self.docs,
+            BYTES_SENT: self.bytes_sent,
+            BYTES_RECEIVED: self.bytes_received,
+            TOTAL_MS: round(self.total_ms, 3),
+            MAX_MS: round(self.max_ms, 3),
+            P50_MS: self.percentile(.5),
+            P95_MS: self.percentile(.95),
+            P99_MS: self.percentile(.99),
+            HISTOGRAM: {bucket_label(pos): num
+                        for pos, num in enumerate(self.buckets) if num},
+        }
+
+
+class Registry:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # a new lock too: after fork() the old one may be held forever
+        self.lock = threading.Lock()
+        self.stats = {OPERATIONS: {}, COMMANDS: {}}
+
+    def get(self, kind: str, collection: str, name: str) -> OpStats:
+        """
+        Call with the lock held.
+        """
+        ops = self.stats[kind].setdefault(collection, {})
+        if name not in ops:
+            ops[name] = OpStats()
+        return ops[name]
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {kind: {coll: {name: stats.to_dict()
+                                  for name, stats in ops.items()}
+                           for coll, ops in colls.items()}
+                    for kind, colls in self.stats.items()}
+
+
+registry = Registry()
+
+
+def snapshot() -> dict:
+    return registry.snapshot()
+
+
+def op_collection(args: tuple, kwargs: dict) -> str | None:
+    """
+    Every `dbc` operation takes the collection first.
+    """
+    collection = kwargs.get('collection', args[0] if args else None)
+    return collection if isinstance(collection, str) else None
+
+
+def doc_count(ret) -> int:
+    return len(ret) if isinstance(ret, list) else 0
+
+
+def record_op(collection: str, op: str, ms: float, docs: int = 0,
+              error: bool = False):
+    with registry.lock:
+        registry.get(OPERATIONS, collection, op).add(ms, docs, error)
+
+
+def record_retry(collection: str, op: str):
+    with registry.lock:
+        registry.get(OPERATIONS, collection, op).retries += 1
+
+
+def bson_size(doc) -> int:
+    if not COUNT_BYTES or doc is None:
+        return 0
+    try:
+        return len(bson.encode(doc))
+    except (bson.errors.InvalidDocument, TypeError):
+        return 0
+
+
+def reply_docs(reply) -> int:
+    """
+    Docs returned by a cursor command, or written by a write command.
+    """
+    cursor = reply.get('cursor')
+    if isinstance(cursor, dict):
+        batch = cursor.get('firstBatch', cursor.get('nextBatch', []))
+        return len(batch)
+    num = reply.get('n', 0)
+    return num if isinstance(num, int) else 0
+
+
+class CommandMonitor(monitoring.CommandListener):
+    """
+    Times every command sent to Mongo, using the server round trip
+    pymongo measures, and counts its docs and bytes.
+    Commands not aimed at a collection (hello, ping, ...) are left out.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.pending_lock = threading.Lock()
+        # (connection, request id) -> (collection, bytes sent) of the
+        # commands in flight
+        self.pending = {}
+
+    def started(self, event):
+        name = event.command_name
+        collection = (event.command.get('collection') if name == 'getMore'
+                      else event.command.get(name))
+        if not isinstance(collection, str):
+            return
+        with self.pending_lock:
+            self.pending[(event.connection_id, event.request_id)] = (
+                collection, bson_size(event.command))
+
+    def finished(self, event, reply=None):
+        with self.pending_lock:
+            found = self.pending.pop((event.connection_id, event.request_id),
+                                     None)
+        if found is None:
+            return
+        collection, sent = found
+        docs = reply_docs(reply) if reply is not None else 0
+        received = bson_size(reply)
+        with registry.lock:
+            stats = registry.get(COMMANDS, collection, event.command_name)
+            stats.add(event.duration_micros / 1000, docs,
+                      error=reply is None)
+            stats.bytes_sent += sent
+            stats.bytes_received += received
+
+    def succeeded(self, event):
+        self.finished(event, event.reply)
+
+    def failed(self, event):
+        self.finished(event)
+
+
+command_monitor = CommandMonitor()
+
+
+def reset():
+    registry.reset()
+    command_monitor.reset()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset)
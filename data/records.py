@@ -0,0 +1,70 @@
+"""
+Compact records for the entity caches.
+A dict per record repeats its keys and keeps spare room for more; a
+record type made by `record_type()` has a slot for each of an entity's
+fields instead, and a dict only for fields it wasn't told about.
+The caches store these, and hand out dicts.
+"""
+import sys
+
+RESERVED = {'extra_fields', 'get', 'to_dict', 'from_dict', 'FIELDS',
+            'FIELD_SET'}
+
+
+class CompactRecord:
+    __slots__ = ('extra_fields',)
+    # the slotted fields, in order, and as a set to look them up in
+    FIELDS = ()
+    FIELD_SET = frozenset()
+
+    @classmethod
+    def from_dict(cls, doc: dict):
+        rec = cls()
+        extra = None
+        for key, val in doc.items():
+            if key in cls.FIELD_SET:
+                setattr(rec, key, val)
+            else:
+                if extra is None:
+                    extra = {}
+                extra[key] = val
+        rec.extra_fields = extra
+        return rec
+
+    def get(self, field: str, default=None):
+        if field in self.FIELD_SET:
+            return getattr(self, field, default)
+        if self.extra_fields is None:
+            return default
+        return self.extra_fields.get(field, default)
+
+    def to_dict(self) -> dict:
+        doc = {field: getattr(self, field) for field in self.FIELDS
+               if hasattr(self, field)}
+        if self.extra_fields:
+            doc.update(self.extra_fields)
+        return doc
+
+
+def record_type(name: str, fields) -> type:
+    """
+    A CompactRecord class with a slot for each of `fields` that can be
+    one (fields that aren't identifiers go in `extra_fields`).
+    """
+    slots = tuple(dict.fromkeys(field for field in fields
+                                if field.isidentifier()
+                                and field not in RESERVED))
+    return type(f'{name}_record', (CompactRecord,),
+                {'__slots__': slots, 'FIELDS': slots,
+                 'FIELD_SET': frozenset(slots)})
+
+
+def size(rec) -> int:
+    """
+    Bytes taken by the record itself, not counting its values (which a
+    dict and a compact record share).
+    """
+    if isinstance(rec, CompactRecord):
+        return sys.getsizeof(rec) + (sys.getsizeof(rec.extra_fields)
+                                     if rec.extra_fields else 0)
+    return sys.getsizeof(rec)
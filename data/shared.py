@@ -0,0 +1,85 @@
+"""
+What the workers of one server share about each cached collection:
+a version stamp in a memory-mapped file, bumped by every write in any
+of them, and file locks so that only one of them at a time reloads a
+collection from the db (the others then load the snapshot it wrote).
+"""
+import mmap
+import os
+import struct
+import time
+
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # not on Windows
+    fcntl = None
+
+# the stamp: the version, when it was last bumped, and a random epoch
+# drawn when the file is made, so that a new stamp's versions can't be
+# taken for an old one's
+STAMP = struct.Struct('<QdQ')
+STAMP_EXT = '.version'
+LOCK_EXT = '.lock'
+
+
+def available() -> bool:
+    return fcntl is not None
+
+
+@contextmanager
+def file_lock(path: str):
+    """
+    Hold an exclusive lock on `path` (made if need be).
+    The file is opened afresh each time: a descriptor inherited across a
+    fork shares its lock with the parent, and so excludes nobody.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)  # releases the lock
+
+
+def new_epoch() -> int:
+    return int.from_bytes(os.urandom(8), 'little')
+
+
+class SharedStamp:
+    def __init__(self, path: str):
+        self.path = path
+        with file_lock(path):
+            fd = os.open(path, os.O_RDWR)
+            try:
+                if os.fstat(fd).st_size < STAMP.size:
+                    os.ftruncate(fd, STAMP.size)
+                    os.pwrite(fd, STAMP.pack(0, time.time(), new_epoch()),
+                              0)
+                # a shared mapping stays shared with forked children
+                self.mm = mmap.mmap(fd, STAMP.size)
+            finally:
+                os.close(fd)
+
+    def read(self) -> tuple:
+        """
+        (version, when it was last bumped, epoch). No lock: a torn read
+        only looks like another change, which costs a reload.
+        """
+        return STAMP.unpack_from(self.mm, 0)
+
+    def version(self) -> int:
+        return self.read()[0]
+
+    def modified_at(self) -> float:
+        return self.read()[1]
+
+    def epoch(self) -> int:
+        return self.read()[2]
+
+    def bump(self) -> int:
+        with file_lock(self.path):
+            version, _, epoch = self.read()
+            STAMP.pack_into(self.mm, 0, version + 1, time.time(), epoch)
+        return version + 1
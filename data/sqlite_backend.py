@@ -0,0 +1,447 @@
+"""
+An embedded storage engine for small single-node deployments and edge
+caches: each collection is a SQLite table of JSON documents.
+Select it with DB_BACKEND=sqlite; the file is SQLITE_PATH.
+
+The fields the query modules filter on most (`name`, `id`,
+`state_code`, `country_code`) are generated columns with their own
+indexes, and every index registered with `dbc.register_indexes()` is
+built over the same expressions, so the filters and sorts we translate
+to SQL are answered from an index.
+The database runs in WAL mode, so readers don't block the writer, and
+every statement is parameterized, so sqlite3 reuses its prepared form.
+Unlike Mongo, equality in SQL does not look inside arrays; none of our
+collections store them.
+"""
+import json
+import os
+import re
+import sqlite3
+import threading
+import warnings
+from contextlib import contextmanager
+
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+import data.db_connect as dbc
+import data.memory_backend as mem
+from data.backend import Backend
+from data.db_connect import MONGO_ID, SE_DB
+
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'winterest.sqlite3')
+# how many prepared statements each connection keeps
+STATEMENT_CACHE_SIZE = 256
+
+# fields stored as indexed generated columns
+GENERATED = ('name', 'id', 'state_code', 'country_code')
+
+# plain field names (possibly dotted) we can turn into a JSON path
+FIELD_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*$')
+
+COMPARISONS = {'$gt': '>', '$gte': '>=', '$lt': '<', '$lte': '<='}
+
+# what a case-insensitive collation becomes; NOCASE only folds ASCII
+NOCASE = ' COLLATE NOCASE'
+
+
+class Untranslatable(Exception):
+    """
+    A filter or sort we don't turn into SQL; it is applied in Python.
+    """
+
+
+def table_name(db: str, collection: str) -> str:
+    return f'"{db}__{collection}"'
+
+
+def json_path(field: str) -> str:
+    if not FIELD_RE.match(field):
+        raise Untranslatable(field)
+    return f"'$.{field}'"
+
+
+def field_sql(field: str) -> str:
+    """
+    The SQL expression for a field: the same text is used when building
+    indexes, so that SQLite can match the two up.
+    """
+    if field == MONGO_ID:
+        return MONGO_ID
+    if field in GENERATED:
+        return field
+    return f'json_extract(doc, {json_path(field)})'
+
+
+def param(val):
+    if isinstance(val, ObjectId):
+        return str(val)
+    if isinstance(val, bool):
+        return int(val)
+    if val is None or isinstance(val, (str, int, float)):
+        return val
+    raise Untranslatable(val)
+
+
+def eq_sql(col: str, val, collate: str = '') -> tuple:
+    if val is None:
+        return f'{col} IS NULL', []
+    return f'{col} = ?{collate}', [param(val)]
+
+
+def in_sql(col: str, vals: list, collate: str = '') -> tuple:
+    vals = list(vals)
+    has_null = None in vals
+    vals = [param(val) for val in vals if val is not None]
+    clauses = []
+    if vals:
+        clauses.append(f'{col}{collate} IN ({", ".join("?" * len(vals))})')
+    if has_null:
+        clauses.append(f'{col} IS NULL')
+    return '(' + (' OR '.join(clauses) or '0') + ')', vals
+
+
+def cond_sql(field: str, cond, collate: str = '') -> tuple:
+    col = field_sql(field)
+    is_ops = (isinstance(cond, dict) and cond
+              and all(key.startswith('$') for key in cond))
+    if not is_ops:
+        return eq_sql(col, cond, collate)
+    clauses, params = [], []
+    for op, arg in cond.items():
+        if op == '$eq':
+            sql, args = eq_sql(col, arg, collate)
+        elif op == '$ne':
+            sql, args = (f'{col} IS NOT NULL', []) if arg is None else (
+                f'{col} IS NOT ?{collate}', [param(arg)])
+        elif op in COMPARISONS and arg is not None:
+            sql, args = (f'{col} {COMPARISONS[op]} ?{collate}',
+                         [param(arg)])
+        elif op == '$in':
+            sql, args = in_sql(col, arg, collate)
+        elif op == '$nin':
+            sql, args = in_sql(col, arg, collate)
+            sql = f'NOT {sql}'
+        elif op == '$exists' and field != MONGO_ID:
+            sql = (f'json_type(doc, {json_path(field)}) IS '
+                   + ('NOT NULL' if arg else 'NULL'))
+            args = []
+        else:
+            raise Untranslatable(op)
+        clauses.append(sql)
+        params.extend(args)
+    return ' AND '.join(clauses), params
+
+
+def where_sql(filt: dict, collate: str = '') -> tuple:
+    """
+    Translate a Mongo filter into a WHERE clause and its parameters.
+    """
+    clauses, params = [], []
+    for key, cond in (filt or {}).items():
+        if key in ('$and', '$or'):
+            subs = [where_sql(sub, collate) for sub in cond]
+            joiner = ' AND ' if key == '$and' else ' OR '
+            clauses.append('(' + (joiner.join(sql for sql, _ in subs)
+                                  or '1') + ')')
+            for _, args in subs:
+                params.extend(args)
+        elif key.startswith('$'):
+            raise Untranslatable(key)
+        else:
+            sql, args = cond_sql(key, cond, collate)
+            clauses.append(sql)
+            params.extend(args)
+    return ' AND '.join(clauses) or '1', params
+
+
+def order_sql(sort, collate: str = '') -> str:
+    if not sort:
+        return ''
+    return ' ORDER BY ' + ', '.join(
+        field_sql(field) + collate + (' DESC' if direction == dbc.DESCENDING
+                                      else ' ASC')
+        for field, direction in sort)
+
+
+def to_doc(_id: str, text: str) -> dict:
+    doc = {MONGO_ID: ObjectId(_id) if ObjectId.is_valid(_id) else _id}
+    doc.update(json.loads(text))
+    return doc
+
+
+def to_row(doc: dict) -> tuple:
+    body = {key: val for key, val in doc.items() if key != MONGO_ID}
+    return str(doc[MONGO_ID]), json.dumps(body, default=str)
+
+
+class SQLiteBackend(Backend):
+    def __init__(self, path: str = None):
+        self.path = path or SQLITE_PATH
+        self.local = threading.local()
+        self.tables = set()
+        self.tables_lock = threading.Lock()
+
+    def conn(self) -> sqlite3.Connection:
+        """
+        sqlite3 connections can't be shared between threads (or
+        processes), so each thread of each process opens its own.
+        """
+        if getattr(self.local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, check_same_thread=False,
+                                   cached_statements=STATEMENT_CACHE_SIZE)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return self.local.conn
+
+    @contextmanager
+    def writing(self):
+        """
+        A transaction for a write that first reads what it changes.
+        sqlite3 would only begin one at the write itself, so two threads
+        could both read the old doc and the later write lose the earlier
+        one; BEGIN IMMEDIATE takes the write lock before the read.
+        """
+        conn = self.conn()
+        if not conn.in_transaction:
+            conn.execute('BEGIN IMMEDIATE')
+        with conn:
+            yield conn
+
+    def table(self, db: str, collection: str) -> str:
+        name = table_name(db, collection)
+        if name in self.tables:
+            return name
+        with self.tables_lock:
+            if name not in self.tables:
+                self.create_table(name, collection)
+                self.tables.add(name)
+        return name
+
+    def create_table(self, name: str, collection: str):
+        generated = ''.join(
+            f', {field} GENERATED ALWAYS AS '
+            f'(json_extract(doc, {json_path(field)})) VIRTUAL'
+            for field in GENERATED)
+        conn = self.conn()
+        with conn:
+            conn.execute(f'CREATE TABLE IF NOT EXISTS {name} '
+                         f'({MONGO_ID} TEXT PRIMARY KEY, '
+                         f'doc TEXT NOT NULL{generated})')
+            for field in GENERATED:
+                conn.execute(f'CREATE INDEX IF NOT EXISTS '
+                             f'"{name[1:-1]}__{field}" ON {name} ({field})')
+        for num, spec in enumerate(dbc.index_registry.get(collection, [])):
+            unique = 'UNIQUE ' if spec.get(dbc.INDEX_UNIQUE) else ''
+            collate = (NOCASE if dbc.is_case_insensitive(
+                spec.get(dbc.INDEX_COLLATION)) else '')
+            cols = ', '.join(
+                field_sql(field) + collate
+                + (' DESC' if direction == dbc.DESCENDING else '')
+                for field, direction in spec[dbc.INDEX_KEYS])
+            try:
+                with conn:
+                    conn.execute(f'CREATE {unique}INDEX IF NOT EXISTS '
+                                 f'"{name[1:-1]}__idx{num}" ON {name} '
+                                 f'({cols})')
+            except sqlite3.IntegrityError as e:
+                warnings.warn(f'Could not build index {spec[dbc.INDEX_KEYS]}'
+                              f' on {collection}: {e}')
+
+    def rows(self, table: str, filt: dict, sort=None, limit=0,
+             ci: bool = False) -> sqlite3.Cursor:
+        """
+        The matching (_id, doc) rows, all done in SQL.
+        Raises Untranslatable if the filter or sort can't be.
+        """
+        collate = NOCASE if ci else ''
+        where, params = where_sql(filt, collate)
+        sql = (f'SELECT {MONGO_ID}, doc FROM {table} WHERE {where}'
+               + order_sql(sort, collate))
+        if limit:
+            sql += f' LIMIT {int(limit)}'
+        return self.conn().execute(sql, params)
+
+    def select(self, table: str, filt: dict, sort=None, limit=0,
+               ci: bool = False):
+        """
+        Yield matching docs. Whatever we can't express in SQL is done
+        here in Python, after fetching the rows.
+        """
+        in_sql_filter = in_sql_sort = True
+        try:
+            rows = self.rows(table, filt, sort, limit, ci)
+        except Untranslatable:
+            in_sql_sort = False
+            try:
+                rows = self.rows(table, filt, ci=ci)
+            except Untranslatable:
+                rows = self.rows(table, None)
+                in_sql_filter = False
+        docs = (to_doc(*row) for row in rows)
+        if not in_sql_filter:
+            docs = (doc for doc in docs if mem.matches(doc, filt, ci))
+        if not in_sql_sort:
+            docs = iter(mem.sort_docs(list(docs), sort, ci))
+        for count, doc in enumerate(docs):
+            if limit and count >= limit:
+                break
+            yield doc
+
+    def first_match(self, table: str, filt: dict):
+        return next(self.select(table, filt, limit=1), None)
+
+    def insert(self, table: str, doc: dict) -> ObjectId:
+        doc.setdefault(MONGO_ID, ObjectId())
+        try:
+            self.conn().execute(f'INSERT INTO {table} ({MONGO_ID}, doc) '
+                                'VALUES (?, ?)', to_row(doc))
+        except sqlite3.IntegrityError as e:
+            raise DuplicateKeyError(str(e)) from e
+        return doc[MONGO_ID]
+
+    def update_first(self, table: str, filt: dict,
+                     update_dict: dict) -> tuple:
+        """
+        Returns (matched, modified).
+        """
+        doc = self.first_match(table, filt)
+        if doc is None:
+            return 0, 0
+        new = dict(doc, **update_dict)
+        if json.loads(to_row(new)[1]) == json.loads(to_row(doc)[1]):
+            return 1, 0
+        try:
+            self.conn().execute(f'UPDATE {table} SET doc = ? '
+                                f'WHERE {MONGO_ID} = ?',
+                                (to_row(new)[1], str(doc[MONGO_ID])))
+        except sqlite3.IntegrityError as e:
+            raise DuplicateKeyError(str(e)) from e
+        return 1, 1
+
+    def delete_first(self, table: str, filt: dict) -> int:
+        doc = self.first_match(table, filt)
+        if doc is None:
+            return 0
+        self.conn().execute(f'DELETE FROM {table} WHERE {MONGO_ID} = ?',
+                            (str(doc[MONGO_ID]),))
+        return 1
+
+    def create(self, collection, doc, db=SE_DB) -> str:
+        with self.conn():
+            return str(self.insert(self.table(db, collection), doc))
+
+    def read_one(self, collection, filt, db=SE_DB) -> dict | None:
+        doc = self.first_match(self.table(db, collection), filt)
+        dbc.convert_mongo_id(doc)
+        return doc
+
+    def read(self, collection, db=SE_DB, no_id=True, filt=None, fields=None,
+             sort=None, limit=0, collation=None) -> list:
+        return list(self.read_iter(collection, db=db, no_id=no_id,
+                                   filt=filt, fields=fields, sort=sort,
+                                   limit=limit, collation=collation))
+
+    def read_iter(self, collection, db=SE_DB, no_id=True, filt=None,
+                  fields=None, sort=None, limit=0, batch_size=0,
+                  collation=None):
+        projection = dbc.make_projection(fields, no_id)
+        for doc in self.select(self.table(db, collection), filt, sort,
+                               limit, dbc.is_case_insensitive(collation)):
+            yield dbc.clean_doc(mem.project(doc, projection), no_id)
+
+    def count(self, collection, filt=None, db=SE_DB) -> int:
+        table = self.table(db, collection)
+        try:
+            where, params = where_sql(filt)
+        except Untranslatable:
+            return sum(1 for _ in self.select(table, filt))
+        return self.conn().execute(
+            f'SELECT COUNT(*) FROM {table} WHERE {where}',
+            params).fetchone()[0]
+
+    def group_count(self, collection, field, filt=None, db=SE_DB) -> dict:
+        table = self.table(db, collection)
+        try:
+            where, params = where_sql(filt)
+            col = field_sql(field)
+        except Untranslatable:
+            counts = {}
+            for doc in self.select(table, filt):
+                val = mem.get_field(doc, field)[1]
+                counts[val] = counts.get(val, 0) + 1
+            return counts
+        return dict(self.conn().execute(
+            f'SELECT {col}, COUNT(*) FROM {table} WHERE {where} '
+            f'GROUP BY {col}', params).fetchall())
+
+    def read_json_iter(self, collection, db=SE_DB, filt=None, fields=None,
+                       sort=None, limit=0, batch_size=0, collation=None):
+        """
+        Docs are stored as JSON without `_id`, so a query done all in
+        SQL with no projection can hand them over as they are.
+        """
+        if fields is None:
+            try:
+                rows = self.rows(self.table(db, collection), filt, sort,
+                                 limit, dbc.is_case_insensitive(collation))
+            except Untranslatable:
+                rows = None
+            if rows is not None:
+                for _, text in rows:
+                    yield text
+                return
+        yield from super().read_json_iter(
+            collection, db=db, filt=filt, fields=fields, sort=sort,
+            limit=limit, batch_size=batch_size, collation=collation)
+
+    def update(self, collection, filters, update_dict, db=SE_DB) -> int:
+        table = self.table(db, collection)
+        with self.writing():
+            return self.update_first(table, filters, update_dict)[1]
+
+    def delete(self, collection, filt, db=SE_DB) -> int:
+        table = self.table(db, collection)
+        with self.writing():
+            return self.delete_first(table, filt)
+
+    def insert_many(self, collection, docs, db=SE_DB, ordered=True) -> list:
+        table = self.table(db, collection)
+        results = []
+        with self.conn():
+            for doc in docs:
+                if ordered and results and dbc.BULK_ERROR in results[-1]:
+                    results.append({dbc.BULK_ERROR: dbc.NOT_ATTEMPTED})
+                    continue
+                try:
+                    results.append({dbc.BULK_ID: str(self.insert(table,
+                                                                 doc))})
+                except DuplicateKeyError as e:
+                    results.append({dbc.BULK_ERROR: str(e)})
+        return results
+
+    def write_ops(self, collection, ops, db=SE_DB, ordered=True) -> tuple:
+        table = self.table(db, collection)
+        totals = {dbc.BULK_MATCHED: 0, dbc.BULK_MODIFIED: 0,
+                  dbc.BULK_DELETED: 0}
+        failed = {}
+        with self.writing():
+            for pos, op in enumerate(ops):
+                try:
+                    if op[0] == dbc.UPDATE:
+                        matched, modified = self.update_first(table, op[1],
+                                                              op[2])
+                        totals[dbc.BULK_MATCHED] += matched
+                        totals[dbc.BULK_MODIFIED] += modified
+                    elif op[0] == dbc.DELETE:
+                        totals[dbc.BULK_DELETED] += self.delete_first(
+                            table, op[1])
+                    else:
+                        raise ValueError(f'Bad bulk operation: {op[0]}')
+                except (DuplicateKeyError, ValueError) as e:
+                    failed[pos] = str(e)
+                    if ordered:
+                        break
+        return totals, failed
@@ -0,0 +1,492 @@
+import asyncio
+import os
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+
+import data.cache as dcache
+from data import records
+from data import shared
+
+COLL = 'cache_test'
+
+
+@pytest.fixture
+def cache():
+    cache = dcache.EntityCache(COLL, ttl=60, max_size=3,
+                               loader=lambda: {'a': {'n': 1}, 'b': {'n': 2}})
+    yield cache
+    dcache.caches.pop(COLL, None)
+
+
+def test_acts_like_a_dict(cache):
+    assert not cache
+    cache['a'] = {'n': 1}
+    assert cache and 'a' in cache and len(cache) == 1
+    assert cache['a'] == {'n': 1}
+    assert cache.get('zz') is None
+    cache.update({'b': {'n': 2}})
+    assert sorted(cache) == ['a', 'b']
+    assert cache.pop('b') == {'n': 2}
+    del cache['a']
+    assert 'a' not in cache
+    with pytest.raises(KeyError):
+        cache['a']
+
+
+def test_hits_and_misses(cache):
+    cache['a'] = {}
+    cache['a']
+    cache.get('b')
+    stats = cache.stats()
+    assert stats[dcache.HITS] == 1
+    assert stats[dcache.MISSES] == 1
+
+
+def test_lru_eviction(cache):
+    for key in 'abc':
+        cache[key] = {}
+    cache['a']  # now b is the least recently used
+    cache['d'] = {}
+    assert sorted(cache) == ['a', 'c', 'd']
+    assert cache.stats()[dcache.EVICTIONS] == 1
+
+
+def test_ttl(cache):
+    cache['a'] = {}
+    with patch('data.cache.time.monotonic', return_value=1e12):
+        assert 'a' not in cache
+        assert cache.values() == []
+    assert cache.stats()[dcache.EXPIRATIONS] == 1
+
+
+def test_load_and_invalidate(cache):
+    assert cache.needs_load()
+    cache.ensure_loaded()
+    assert not cache.needs_load()
+    assert cache['b'] == {'n': 2}
+    cache.invalidate('b')
+    assert 'b' not in cache
+    assert not cache.needs_load()
+    cache.invalidate()
+    assert cache.needs_load()
+    assert len(cache) == 0
+
+
+def test_load_expires(cache):
+    cache.ensure_loaded()
+    with patch('data.cache.time.monotonic', return_value=1e12):
+        assert cache.needs_load()
+
+
+def test_needs_cache(cache):
+    @dcache.needs_cache(cache)
+    def size():
+        return len(cache)
+    assert size() == 2
+
+
+def test_all_stats(cache):
+    assert dcache.all_stats()[COLL][dcache.MAX_SIZE] == 3
+
+
+@patch('data.db_connect.read_one')
+def test_fetch(mock_read_one, cache):
+    oid = '5f1d7f1e9d3b2a0012345678'
+    mock_read_one.return_value = {'_id': oid, 'n': 1}
+    assert cache.fetch(oid) == {'n': 1}
+    assert cache[oid] == {'n': 1}
+    assert cache.fetch(oid) == {'n': 1}
+    mock_read_one.assert_called_once()
+
+
+@patch('data.db_connect.read_one', return_value=None)
+def test_fetch_not_found(mock_read_one, cache):
+    cache.id_field = 'id'
+    assert cache.fetch('nope') is None
+    mock_read_one.assert_called_once_with(COLL, {'id': 'nope'})
+
+
+@pytest.fixture
+def indexed():
+    cache = dcache.EntityCache(COLL, ttl=60, max_size=3, id_field='id',
+                               index_on=[('name',), ('name', 'code')])
+    yield cache
+    dcache.caches.pop(COLL, None)
+
+
+def test_where(indexed):
+    indexed['a'] = {'id': 'A', 'name': 'x', 'code': 'NY'}
+    indexed['b'] = {'name': 'x', 'code': 'CA'}
+    assert sorted(indexed.where({'name': 'x'})) == ['a', 'b']
+    assert indexed.where({'code': 'CA', 'name': 'x'}) == ['b']
+    assert indexed.where({'id': 'A'}) == ['a']
+    assert indexed.where({'code': 'NY'}) == ['a']  # not indexed: a scan
+    assert indexed.where({'name': 'y'}) == []
+
+
+def test_indexes_follow_writes(indexed):
+    indexed['a'] = {'name': 'x'}
+    indexed.update_record('a', {'name': 'y'})
+    assert indexed.where({'name': 'x'}) == []
+    assert indexed.where({'name': 'y'}) == ['a']
+    del indexed['a']
+    assert indexed.where({'name': 'y'}) == []
+    for key in 'bcde':
+        indexed[key] = {'name': 'z'}
+    assert sorted(indexed.where({'name': 'z'})) == ['c', 'd', 'e']
+    indexed.invalidate()
+    assert indexed.indexes[('name',)] == {}
+    assert not indexed.update_record('c', {'name': 'q'})
+
+
+def test_update_one_and_delete_one(indexed):
+    indexed['a'] = {'name': 'x'}
+    indexed.update_one({'name': 'x'}, {'code': 'NY'})
+    assert indexed['a'] == {'name': 'x', 'code': 'NY'}
+    indexed['b'] = {'name': 'x'}
+    indexed.update_one({'name': 'x'}, {'code': 'CA'})  # which one?
+    assert 'a' not in indexed and 'b' not in indexed
+    indexed['c'] = {'name': 'y'}
+    indexed.delete_one({'name': 'y'})
+    assert 'c' not in indexed
+
+
+def test_fetch_by_id_field(indexed):
+    indexed['a'] = {'id': 'A'}
+    with patch('data.db_connect.read_one') as mock_read_one:
+        assert indexed.fetch('A') == {'id': 'A'}
+    mock_read_one.assert_not_called()
+
+
+def test_single_flight_load():
+    calls = []
+
+    def loader():
+        calls.append(1)
+        time.sleep(0.05)
+        return {'a': {}}
+
+    cache = dcache.EntityCache(COLL, loader=loader)
+    threads = [threading.Thread(target=cache.ensure_loaded)
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert 'a' in cache
+    dcache.caches.pop(COLL, None)
+
+
+def test_stale_served_while_loading(cache):
+    cache.ensure_loaded()
+    cache.loaded_at -= cache.ttl
+    with cache.load_lock:  # somebody else is loading
+        cache.ensure_loaded()
+    assert cache.needs_load()
+    assert 'a' in cache
+
+
+def test_partial_cache_is_not_served_as_whole(cache):
+    cache.ensure_loaded()
+    cache.invalidate()
+    cache['c'] = {'n': 3}  # as a create does
+
+    def loader():
+        time.sleep(0.05)
+        return {'a': {'n': 1}, 'b': {'n': 2}, 'c': {'n': 3}}
+    cache.loader = loader
+    cache.ensure_loaded()  # waits: 'c' alone isn't the collection
+    assert len(cache) == 3
+
+
+def test_writes_during_load_survive(cache):
+    def loader():
+        cache['c'] = {'n': 3}
+        del cache['x']
+        return {'a': {}, 'x': {}}
+    cache['x'] = {}
+    cache.loader = loader
+    cache.load()
+    assert sorted(cache) == ['a', 'c']
+
+
+def test_expiry_during_load_is_not_a_delete(cache):
+    def loader():
+        with patch('data.cache.time.monotonic', return_value=1e12):
+            assert 'x' not in cache  # expired, not deleted
+        return {'a': {}, 'x': {'n': 9}}
+    cache['x'] = {}
+    cache.loader = loader
+    cache.load()
+    assert cache['x'] == {'n': 9}
+
+
+def test_invalidate_during_load(cache):
+    def loader():
+        cache.invalidate()
+        return {'a': {}}
+    cache.loader = loader
+    cache.load()
+    assert cache.needs_load()
+    assert len(cache) == 0
+
+
+def test_update_record_copies(indexed):
+    rec = {'name': 'x'}
+    indexed['a'] = rec
+    indexed.update_record('a', {'name': 'y'})
+    assert rec == {'name': 'x'}
+    assert indexed['a'] == {'name': 'y'}
+
+
+def test_expired_cache_reloads_in_background(cache):
+    cache.ensure_loaded()
+    loading = threading.Event()
+    release = threading.Event()
+
+    def slow_loader():
+        loading.set()
+        release.wait(5)
+        return {'new': {}}
+
+    cache.loader = slow_loader
+    cache.loaded_at -= cache.ttl
+    cache.ensure_loaded()  # returns at once, with the old records
+    assert loading.wait(5)
+    assert 'a' in cache
+    release.set()
+    with cache.load_lock:
+        assert sorted(cache) == ['new']
+    assert not cache.needs_load()
+
+
+def test_refresh_failure_is_counted(cache):
+    def broken():
+        raise RuntimeError('db down')
+    cache.ensure_loaded()
+    cache.loader = broken
+    with pytest.warns(dcache.CacheRefreshWarning):
+        cache.refresh()
+    assert cache.stats()[dcache.REFRESH_ERRORS] == 1
+    assert 'a' in cache
+
+
+def test_refresher(cache):
+    cache.start_refresher(0.01)
+    try:
+        for _ in range(500):
+            if cache.stats()[dcache.REFRESHES]:
+                break
+            time.sleep(0.01)
+        assert 'a' in cache
+    finally:
+        cache.stop_refresher()
+
+
+def test_duplicate_cache_not_registered(cache):
+    with pytest.warns(dcache.DuplicateCacheWarning):
+        dcache.EntityCache(COLL)
+    assert dcache.caches[COLL] is cache
+
+
+def test_snapshot_round_trip(cache, tmp_path):
+    path = str(tmp_path / 'snap')
+    cache.ensure_loaded()
+    cache.dump(path)
+    copy = dcache.EntityCache(COLL, ttl=60, index_on=[('n',)],
+                              loader=lambda: {'a': {'n': 1}}, register=False)
+    with patch.object(copy, 'refresh') as mock_refresh:
+        assert copy.load_snapshot(path)
+    assert dict(copy.items()) == {'a': {'n': 1}, 'b': {'n': 2}}
+    assert copy.where({'n': 2}) == ['b']
+    assert not copy.needs_load()
+    mock_refresh.assert_called_once()
+
+
+def test_bad_snapshot(cache, tmp_path):
+    path = tmp_path / 'snap'
+    path.write_bytes(b'not a snapshot at all')
+    with pytest.warns(dcache.CacheRefreshWarning):
+        assert not cache.load_snapshot(str(path))
+    with pytest.warns(dcache.CacheRefreshWarning):
+        assert not cache.load_snapshot(str(tmp_path / 'missing'))
+    assert cache.needs_load()
+
+
+def test_writes_bumps_version(cache):
+    @dcache.writes(cache)
+    def write(fail=None):
+        if fail:
+            raise fail
+
+    version = cache.version
+    write()
+    assert cache.version == version + 1
+    with pytest.raises(ValueError):
+        write(ValueError('nothing written'))
+    assert cache.version == version + 1
+    with pytest.raises(RuntimeError):
+        write(RuntimeError('maybe written'))
+    assert cache.version == version + 2
+
+
+def test_writes_bumps_version_async(cache):
+    @dcache.writes(cache)
+    async def write():
+        return 1
+
+    version = cache.version
+    assert asyncio.run(write()) == 1
+    assert cache.version == version + 1
+
+
+@pytest.fixture
+def workers(tmp_path):
+    """
+    Two caches of one collection sharing a directory, as two workers'
+    caches would.
+    """
+    if not shared.available():
+        pytest.skip('needs fcntl')
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return {'a': {'n': len(loads)}}
+
+    one = dcache.EntityCache(COLL, ttl=60, loader=loader)
+    two = dcache.EntityCache(COLL, ttl=60, loader=loader, register=False)
+    for cache in (one, two):
+        cache.share(str(tmp_path))
+    yield one, two, loads
+    dcache.caches.pop(COLL, None)
+
+
+def test_shared_write_is_noticed(workers):
+    one, two, loads = workers
+    one.reload()
+    two.reload()
+    assert len(loads) == 1  # two read one's snapshot
+    assert not one.needs_load() and not two.needs_load()
+    assert one.etag() == two.etag()
+
+    dcache.writes(one)(lambda: None)()
+    assert not one.needs_load()  # its own write is in its cache
+    assert two.behind()
+    assert one.etag() == two.etag()
+    two.reload()
+    assert len(loads) == 2
+    assert not two.needs_load()
+
+
+def test_etag_not_reused_by_new_stamp(workers, tmp_path):
+    one, two, loads = workers
+    etag = one.etag()
+    os.remove(one.shared.path)
+    two.share(str(tmp_path))  # a new stamp file, at version 0 again
+    assert two.shared.version() == 0
+    assert two.etag() != etag
+
+
+def test_no_etag_unshared(cache):
+    assert cache.etag() is None
+    assert cache.last_modified() is None
+
+
+def test_shared_snapshot_version(workers, tmp_path):
+    one, two, loads = workers
+    one.shared.bump()
+    one.reload()
+    path = one.snapshot_path()
+    assert dcache.snapshot_version(path) == 1
+    assert dcache.snapshot_version(str(tmp_path / 'missing')) is None
+
+
+def test_compact_records():
+    cache = dcache.EntityCache(COLL, record_fields=('name', 'n'),
+                               index_on=[('name',)])
+    cache['a'] = {'name': 'x', 'n': 1, 'other': True}
+    assert isinstance(cache.entries['a'][0], records.CompactRecord)
+    assert cache['a'] == {'name': 'x', 'n': 1, 'other': True}
+    assert cache.where({'name': 'x'}) == ['a']
+    cache.update_record('a', {'name': 'y'})
+    assert cache.values() == [{'name': 'y', 'n': 1, 'other': True}]
+    assert cache.where({'name': 'y'}) == ['a']
+    cache['a'] = {'name': 'x', 'n': 1}
+    stats = cache.stats()
+    assert 0 < stats[dcache.RECORD_BYTES] < stats[dcache.DICT_BYTES]
+    dcache.caches.pop(COLL, None)
+
+
+@pytest.fixture
+def ordered():
+    cache = dcache.EntityCache(COLL, ttl=60, max_size=10, sorted_on='name',
+                               loader=lambda: {k: {'name': n} for k, n in
+                                               zip('abcd', 'DBCA')})
+    yield cache
+    dcache.caches.pop(COLL, None)
+
+
+def test_sorted_view(ordered):
+    ordered.load()
+    assert ordered.complete
+    assert [d['name'] for d in ordered.between()] == ['A', 'B', 'C', 'D']
+    assert ordered.between('B', 'D') == [{'name': 'B'}, {'name': 'C'}]
+    assert ordered.between('B', descending=True, limit=2) == [
+        {'name': 'D'}, {'name': 'C'}]
+    ordered['e'] = {'name': 'Bb'}
+    ordered.update_record('b', {'name': 'E'})
+    del ordered['c']
+    assert [d['name'] for d in ordered.between()] == ['A', 'Bb', 'D', 'E']
+    ordered.invalidate()
+    assert not ordered.complete and ordered.order == []
+
+
+def test_sorted_view_eviction(ordered):
+    ordered.load()
+    ordered.max_size = 4
+    ordered['e'] = {'name': 'E'}
+    assert not ordered.complete
+
+
+def test_read_range(ordered):
+    with patch('data.db_connect.read') as mock_read:
+        assert dcache.read_range(ordered, 'B', 'D', fields=['name']) == [
+            {'name': 'B'}, {'name': 'C'}]
+        mock_read.assert_not_called()
+        dcache.read_range(ordered, 'B', filt={'x': 1})
+    mock_read.assert_called_once_with(
+        COLL, filt={'$and': [{'x': 1}, {'name': {'$gte': 'B'}}]},
+        fields=None, sort=[('name', 1)], limit=0, collation=None)
+
+
+def test_sort_key():
+    vals = ['b', 2, None, 'a', 1.5]
+    assert sorted(vals, key=dcache.sort_key) == [None, 1.5, 2, 'a', 'b']
+
+
+def test_stale_records_served_during_refresh(ordered):
+    ordered.load()
+    loading = threading.Event()
+    release = threading.Event()
+
+    def slow_loader():
+        loading.set()
+        release.wait(5)
+        return {'e': {'name': 'E'}}
+
+    ordered.loader = slow_loader
+    with patch('data.cache.time.monotonic', return_value=1e12):
+        ordered.ensure_loaded()  # every record is past its TTL
+        assert loading.wait(5)
+        assert ordered.get('a') == {'name': 'D'}
+        assert len(ordered.values()) == 4
+        assert len(dcache.read_range(ordered, 'A')) == 4
+        release.set()
+        with ordered.load_lock:
+            assert ordered.values() == [{'name': 'E'}]
+    assert not ordered.refreshing
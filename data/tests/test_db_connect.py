@@ -1,5 +1,24 @@
+import datetime
+import json
+import threading
+import time
+import warnings
+from unittest.mock import MagicMock, patch
+
+import pytest
+
 import data.db_connect as dbc
 
+@pytest.fixture(autouse=True)
+def mongo_backend():
+    """
+    These tests mock the Mongo client, so make sure it is the one used.
+    """
+    with patch.object(dbc, 'DB_BACKEND', dbc.MONGO), \
+            patch.object(dbc, 'backend', None):
+        yield
+
+
 VALID_ID = '1' * dbc.MIN_ID_LEN
 INVALID_ID = '1' * (dbc.MIN_ID_LEN - 1)
 
@@ -13,4 +32,462 @@ def test_is_not_valid_id():
 
 
 def test_is_not_valid_id_bad_type():
-    assert not dbc.is_valid_id(17)
\ No newline at end of file
+    assert not dbc.is_valid_id(17)
+
+def test_make_projection_list():
+    assert dbc.make_projection(['name', 'population']) == {
+        'name': 1, 'population': 1, dbc.MONGO_ID: 0}
+
+
+def test_make_projection_keep_id():
+    assert dbc.make_projection(None, no_id=False) is None
+    assert dbc.make_projection(['name'], no_id=False) == {'name': 1}
+
+
+@patch('data.db_connect.client')
+def test_read_pushes_down(mock_client):
+    coll = mock_client[dbc.SE_DB]['cities']
+    coll.find.return_value = [{'name': 'Albany'}]
+    ret = dbc.read('cities', filt={'state_code': 'NY'}, fields=['name'],
+                   sort=[('name', dbc.ASCENDING)], limit=5)
+    assert ret == [{'name': 'Albany'}]
+    coll.find.assert_called_once_with({'state_code': 'NY'},
+                                      {'name': 1, dbc.MONGO_ID: 0},
+                                      sort=[('name', dbc.ASCENDING)],
+                                      limit=5, batch_size=0,
+                                      collation=None)
+
+
+@patch('data.db_connect.client')
+def test_read_iter(mock_client):
+    coll = mock_client[dbc.SE_DB]['cities']
+    cursor = coll.find.return_value
+    cursor.__iter__.return_value = iter([{dbc.MONGO_ID: 1, 'name': 'A'},
+                                         {dbc.MONGO_ID: 2, 'name': 'B'}])
+    docs = dbc.read_iter('cities', batch_size=10)
+    assert coll.find.called  # the first doc is pulled up front
+    assert list(docs) == [{'name': 'A'}, {'name': 'B'}]
+    assert coll.find.call_args.kwargs['batch_size'] == 10
+    cursor.close.assert_called_once()
+
+
+def must_have_name(doc):
+    if not doc.get('name'):
+        raise ValueError('no name')
+
+
+@patch('data.db_connect.client')
+def test_create_many_unordered(mock_client):
+    coll = mock_client[dbc.SE_DB]['cities']
+
+    def insert_many(docs, ordered):
+        for i, doc in enumerate(docs):
+            doc[dbc.MONGO_ID] = f'id{i}'
+    coll.insert_many.side_effect = insert_many
+    docs = [{'name': 'A'}, {}, {'name': 'C'}]
+    results = dbc.create_many('cities', docs, ordered=False,
+                              validate=must_have_name)
+    assert results == [{dbc.BULK_ID: 'id0'}, {dbc.BULK_ERROR: 'no name'},
+                       {dbc.BULK_ID: 'id1'}]
+    coll.insert_many.assert_called_once()
+
+
+@patch('data.db_connect.client')
+def test_create_many_ordered_stops(mock_client):
+    coll = mock_client[dbc.SE_DB]['cities']
+
+    def insert_many(docs, ordered):
+        for i, doc in enumerate(docs):
+            doc[dbc.MONGO_ID] = f'id{i}'
+    coll.insert_many.side_effect = insert_many
+    docs = [{'name': 'A'}, {}, {'name': 'C'}]
+    results = dbc.create_many('cities', docs, validate=must_have_name)
+    assert results == [{dbc.BULK_ID: 'id0'}, {dbc.BULK_ERROR: 'no name'},
+                       {dbc.BULK_ERROR: dbc.NOT_ATTEMPTED}]
+
+
+@patch('data.db_connect.client')
+def test_create_many_write_error(mock_client):
+    coll = mock_client[dbc.SE_DB]['cities']
+
+    def insert_many(docs, ordered):
+        for i, doc in enumerate(docs):
+            doc[dbc.MONGO_ID] = f'id{i}'
+        raise dbc.BulkWriteError({'writeErrors': [{'index': 1,
+                                                   'errmsg': 'dup'}]})
+    coll.insert_many.side_effect = insert_many
+    docs = [{'name': 'A'}, {'name': 'B'}, {'name': 'C'}]
+    results = dbc.create_many('cities', docs)
+    assert results == [{dbc.BULK_ID: 'id0'}, {dbc.BULK_ERROR: 'dup'},
+                       {dbc.BULK_ERROR: dbc.NOT_ATTEMPTED}]
+
+
+def test_create_many_bad_type():
+    with pytest.raises(ValueError):
+        dbc.create_many('cities', {'name': 'A'})
+
+
+@patch('data.db_connect.client')
+def test_bulk_write(mock_client):
+    coll = mock_client[dbc.SE_DB]['cities']
+    coll.bulk_write.return_value.matched_count = 1
+    coll.bulk_write.return_value.modified_count = 1
+    coll.bulk_write.return_value.deleted_count = 1
+    ops = [(dbc.UPDATE, {'name': 'A'}, {'mayor': 'B'}),
+           (dbc.DELETE, {'name': 'C'})]
+    ret = dbc.bulk_write('cities', ops, ordered=False)
+    assert ret[dbc.BULK_MODIFIED] == 1
+    assert ret[dbc.BULK_DELETED] == 1
+    assert ret[dbc.BULK_ERRORS] == []
+    models = coll.bulk_write.call_args.args[0]
+    assert isinstance(models[0], dbc.pm.UpdateOne)
+    assert isinstance(models[1], dbc.pm.DeleteOne)
+
+
+def test_env_int(monkeypatch):
+    monkeypatch.setenv('TEST_ENV_INT', '42')
+    assert dbc.env_int('TEST_ENV_INT', 1) == 42
+    monkeypatch.setenv('TEST_ENV_INT', '')
+    assert dbc.env_int('TEST_ENV_INT', 1) == 1
+
+
+def test_env_bool(monkeypatch):
+    monkeypatch.setenv('TEST_ENV_BOOL', 'False')
+    assert dbc.env_bool('TEST_ENV_BOOL', True) is False
+    monkeypatch.setenv('TEST_ENV_BOOL', 'yes')
+    assert dbc.env_bool('TEST_ENV_BOOL', False) is True
+
+
+@patch('data.db_connect.client', None)
+@patch('data.db_connect.build_indexes')
+@patch('data.db_connect.new_client')
+def test_connect_db_once_under_threads(mock_new_client, mock_build):
+    def slow_client():
+        time.sleep(0.05)
+        return object()
+    mock_new_client.side_effect = slow_client
+    threads = [threading.Thread(target=dbc.connect_db) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert mock_new_client.call_count == 1
+
+
+@patch('data.db_connect.client', 'parent client')
+def test_forget_client():
+    dbc.forget_client()
+    assert dbc.client is None
+
+
+def test_pool_stats():
+    dbc.pool_monitor.reset()
+    dbc.pool_monitor.connection_created(None)
+    dbc.pool_monitor.connection_created(None)
+    dbc.pool_monitor.connection_checked_out(None)
+    stats = dbc.pool_stats()
+    assert stats[dbc.POOL_OPEN] == 2
+    assert stats[dbc.POOL_IN_USE] == 1
+    assert stats[dbc.POOL_CHECKOUTS] == 1
+    assert stats[dbc.POOL_UTILIZATION] == 1 / stats[dbc.POOL_MAX_SIZE]
+    dbc.pool_monitor.reset()
+
+
+TEST_INDEXES = [
+    {dbc.INDEX_KEYS: [('name', dbc.ASCENDING)]},
+    {dbc.INDEX_KEYS: [('state_code', dbc.ASCENDING), ('name', dbc.ASCENDING)],
+     dbc.INDEX_UNIQUE: True},
+]
+
+
+@pytest.fixture
+def test_indexes():
+    dbc.register_indexes('test_coll', TEST_INDEXES)
+    yield 'test_coll'
+    del dbc.index_registry['test_coll']
+
+
+def test_build_indexes(test_indexes):
+    mock_client = MagicMock()
+    dbc.build_indexes(mock_client)
+    coll = mock_client[dbc.SE_DB][test_indexes]
+    coll.create_index.assert_any_call([('name', dbc.ASCENDING)],
+                                      unique=False)
+    coll.create_index.assert_any_call(TEST_INDEXES[1][dbc.INDEX_KEYS],
+                                      unique=True)
+
+
+def test_build_indexes_bad_data(test_indexes):
+    mock_client = MagicMock()
+    coll = mock_client[dbc.SE_DB][test_indexes]
+    coll.create_index.side_effect = dbc.pm.errors.OperationFailure('dups')
+    with pytest.warns(UserWarning):
+        dbc.build_indexes(mock_client)
+
+
+def test_is_indexed(test_indexes):
+    assert dbc.is_indexed(test_indexes, {'name': 'A'})
+    assert dbc.is_indexed(test_indexes, {'name': 'A', 'state_code': 'NY'})
+    assert dbc.is_indexed(test_indexes, {dbc.MONGO_ID: 'x'})
+    assert dbc.is_indexed(test_indexes, {})
+    assert not dbc.is_indexed(test_indexes, {'mayor': 'A'})
+    assert not dbc.is_indexed(test_indexes,
+                              {'$or': [{'mayor': 'A'}, {'area': 'B'}]})
+    assert dbc.is_indexed('unregistered', {'mayor': 'A'})
+
+
+def test_check_indexed_warns_once(test_indexes):
+    with pytest.warns(dbc.CollScanWarning):
+        dbc.check_indexed(test_indexes, {'mayor': 'A'})
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        dbc.check_indexed(test_indexes, {'mayor': 'B'})
+
+
+@pytest.fixture
+def fresh_breaker():
+    dbc.breaker.reset()
+    yield dbc.breaker
+    dbc.breaker.reset()
+
+
+def test_backoff_delay_is_capped():
+    for attempt in range(10):
+        assert 0 <= dbc.backoff_delay(attempt, base=0.1, cap=1.0) <= 1.0
+
+
+@patch('data.db_connect.time.sleep')
+def test_retry_mongo_backs_off(mock_sleep, fresh_breaker):
+    calls = []
+
+    @dbc.retry_mongo(retries=3)
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise dbc.AutoReconnect('down')
+        return 'ok'
+    retries = dbc.retry_stats()[dbc.RETRIES]
+    assert flaky() == 'ok'
+    assert mock_sleep.call_count == 2
+    assert dbc.retry_stats()[dbc.RETRIES] == retries + 2
+    assert fresh_breaker.state == dbc.CLOSED
+
+
+@patch('data.db_connect.time.sleep')
+def test_retry_mongo_deadline(mock_sleep, fresh_breaker):
+    @dbc.retry_mongo(retries=5, deadline=0)
+    def down():
+        raise dbc.NetworkTimeout('down')
+    with pytest.raises(dbc.NetworkTimeout):
+        down()
+    assert not mock_sleep.called
+
+
+def test_breaker_trips_and_recovers(fresh_breaker):
+    fresh_breaker.reset_after = 0.05
+    for _ in range(fresh_breaker.threshold):
+        fresh_breaker.record_failure()
+    assert fresh_breaker.state == dbc.OPEN
+    assert fresh_breaker.trips == 1
+    with pytest.raises(dbc.CircuitOpenError):
+        fresh_breaker.before_call()
+    time.sleep(0.06)
+    fresh_breaker.before_call()  # the trial call
+    assert fresh_breaker.state == dbc.HALF_OPEN
+    with pytest.raises(dbc.CircuitOpenError):
+        fresh_breaker.before_call()  # only one trial at a time
+    fresh_breaker.record_success()
+    assert fresh_breaker.state == dbc.CLOSED
+    fresh_breaker.reset_after = dbc.BREAKER_RESET
+
+
+@patch('data.db_connect.time.sleep')
+def test_open_breaker_fails_fast(mock_sleep, fresh_breaker):
+    calls = []
+
+    @dbc.retry_mongo(retries=1)
+    def down():
+        calls.append(1)
+        raise dbc.AutoReconnect('down')
+    for _ in range(fresh_breaker.threshold):
+        with pytest.raises(dbc.AutoReconnect):
+            down()
+    calls.clear()
+    with pytest.raises(dbc.CircuitOpenError):
+        down()
+    assert not calls
+
+
+def test_failed_trial_call_closes_breaker(fresh_breaker):
+    @dbc.retry_mongo(retries=1)
+    def dup():
+        raise dbc.pm.errors.DuplicateKeyError('dup')
+    for _ in range(fresh_breaker.threshold):
+        fresh_breaker.record_failure()
+    fresh_breaker.opened_at -= fresh_breaker.reset_after
+    with pytest.raises(dbc.pm.errors.DuplicateKeyError):
+        dup()  # the trial call: the db answered
+    assert fresh_breaker.state == dbc.CLOSED
+    with pytest.raises(dbc.pm.errors.DuplicateKeyError):
+        dup()  # not a CircuitOpenError
+
+
+@patch('data.db_connect.client')
+def test_stream_fails_up_front(mock_client, fresh_breaker):
+    coll = mock_client[dbc.SE_DB]['cities']
+    coll.find.return_value.__iter__.side_effect = dbc.AutoReconnect('down')
+    with pytest.raises(dbc.DBError):
+        dbc.read_iter('cities')  # before anything is consumed
+    assert fresh_breaker.failures == 1
+    for _ in range(fresh_breaker.threshold):
+        fresh_breaker.record_failure()
+    coll.find.reset_mock()
+    with pytest.raises(dbc.CircuitOpenError):
+        dbc.read_iter('cities')
+    assert not coll.find.called
+
+
+@patch('data.db_connect.client')
+def test_open_breaker_stops_bulk_writes(mock_client, fresh_breaker):
+    for _ in range(fresh_breaker.threshold):
+        fresh_breaker.record_failure()
+    with pytest.raises(dbc.CircuitOpenError):
+        dbc.create_many('cities', [{'name': 'A'}])
+    with pytest.raises(dbc.CircuitOpenError):
+        dbc.bulk_write('cities', [(dbc.DELETE, {'name': 'A'})])
+    coll = mock_client[dbc.SE_DB]['cities']
+    assert not coll.insert_many.called
+    assert not coll.bulk_write.called
+
+
+def test_after_filter():
+    keys = [('name', dbc.ASCENDING), (dbc.MONGO_ID, dbc.ASCENDING)]
+    assert dbc.after_filter(keys, ['Albany', 7]) == {'$or': [
+        {'name': {'$gt': 'Albany'}},
+        {'$and': [{'name': 'Albany'}, {dbc.MONGO_ID: {'$gt': 7}}]},
+    ]}
+
+
+def test_after_filter_desc_nulls():
+    keys = [('pop', dbc.DESCENDING), (dbc.MONGO_ID, dbc.DESCENDING)]
+    ret = dbc.after_filter(keys, [10, 7])
+    assert ret['$or'][0] == {'$or': [{'pop': {'$lt': 10}}, {'pop': None}]}
+    # nothing sorts after null going down, except on the tie breaker
+    ret = dbc.after_filter(keys, [None, 7])
+    assert len(ret['$or']) == 1
+    assert ret['$or'][0]['$and'][0] == {'pop': None}
+
+
+def test_page_sort():
+    asc, desc = dbc.ASCENDING, dbc.DESCENDING
+    assert dbc.page_sort(None) == [(dbc.MONGO_ID, asc)]
+    assert dbc.page_sort([('name', desc)]) == [
+        ('name', desc), (dbc.MONGO_ID, desc)]
+    assert dbc.page_sort([(dbc.MONGO_ID, asc), ('name', desc)]) == [
+        ('name', desc), (dbc.MONGO_ID, asc)]
+
+
+def test_cursor_round_trip():
+    keys = dbc.page_sort([('name', dbc.ASCENDING)])
+    oid = dbc.ObjectId()
+    cursor = dbc.encode_cursor(keys, {'name': 'Albany',
+                                      dbc.MONGO_ID: str(oid)})
+    assert dbc.decode_cursor(cursor, keys) == ['Albany', oid]
+
+
+def test_bad_cursor():
+    keys = dbc.page_sort(None)
+    with pytest.raises(ValueError):
+        dbc.decode_cursor('not a cursor!', keys)
+    other = dbc.encode_cursor(dbc.page_sort([('name', dbc.ASCENDING)]),
+                              {'name': 'A', dbc.MONGO_ID: 'x'})
+    with pytest.raises(ValueError):
+        dbc.decode_cursor(other, keys)
+
+
+def test_read_page_fetches_one_extra():
+    with patch.object(dbc, 'read', return_value=[
+            {'name': n, dbc.MONGO_ID: n} for n in 'abc']) as mock_read:
+        docs, after = dbc.read_page('cities', fields=['population'],
+                                    sort=[('name', dbc.ASCENDING)], limit=2)
+    assert mock_read.call_args.kwargs['limit'] == 3
+    assert mock_read.call_args.kwargs['fields'] == ['population', 'name',
+                                                    dbc.MONGO_ID]
+    assert docs == [{}, {}]
+    assert after is not None
+
+
+def test_is_sort_indexed(test_indexes):
+    asc, desc = dbc.ASCENDING, dbc.DESCENDING
+    assert dbc.is_sort_indexed(test_indexes, None)
+    assert dbc.is_sort_indexed(test_indexes, [('name', desc)])
+    assert dbc.is_sort_indexed(test_indexes, [('state_code', asc),
+                                              ('name', asc)])
+    assert dbc.is_sort_indexed(test_indexes, [('state_code', desc),
+                                              ('name', desc)])
+    assert not dbc.is_sort_indexed(test_indexes, [('state_code', asc),
+                                                  ('name', desc)])
+    assert not dbc.is_sort_indexed(test_indexes, [('population', asc)])
+    assert not dbc.is_sort_indexed(test_indexes, [('name', asc)],
+                                   dbc.CI_COLLATION)
+
+
+def test_index_options_collation():
+    options = dbc.index_options({dbc.INDEX_KEYS: [('name', dbc.ASCENDING)],
+                                 dbc.INDEX_COLLATION: dbc.CI_COLLATION})
+    assert options['name'] == 'name_1_collated'
+    assert options['collation'].document['strength'] == 2
+
+
+def test_count_uses_metadata():
+    coll = MagicMock()
+    coll.estimated_document_count.return_value = 7
+    coll.count_documents.return_value = 2
+    with patch.object(dbc, 'client', {dbc.SE_DB: {'cities': coll}}):
+        assert dbc.count('cities') == 7
+        assert dbc.count('cities', {'state_code': 'NY'}) == 2
+    coll.count_documents.assert_called_once_with({'state_code': 'NY'})
+
+
+def test_group_count_pipeline():
+    coll = MagicMock()
+    coll.aggregate.return_value = [{dbc.MONGO_ID: 'NY', 'count': 2}]
+    with patch.object(dbc, 'client', {dbc.SE_DB: {'cities': coll}}):
+        assert dbc.group_count('cities', 'state_code',
+                               {'population': 1}) == {'NY': 2}
+    pipeline = coll.aggregate.call_args.args[0]
+    assert pipeline[0] == {'$match': {'population': 1}}
+    assert pipeline[1]['$group'][dbc.MONGO_ID] == '$state_code'
+
+
+def test_read_json_iter_raw():
+    docs = [dbc.RawBSONDocument(dbc.bson.encode({'name': 'A', 'pop': 1}))]
+    coll = MagicMock()
+    coll.find.return_value.__iter__.return_value = iter(docs)
+    db = MagicMock()
+    db.get_collection.return_value = coll
+    with patch.object(dbc, 'client', {dbc.SE_DB: db}):
+        lines = list(dbc.read_json_iter('cities', filt={'name': 'A'}))
+    assert db.get_collection.call_args.kwargs['codec_options'] is (
+        dbc.RAW_OPTIONS)
+    assert [json.loads(line) for line in lines] == [{'name': 'A', 'pop': 1}]
+
+
+def test_raw_to_json_without_bsonjs():
+    raw = dbc.RawBSONDocument(dbc.bson.encode({'name': 'A'}))
+    with patch.object(dbc, 'bsonjs', None):
+        assert json.loads(dbc.raw_to_json(raw)) == {'name': 'A'}
+
+
+def test_raw_to_json_same_either_way():
+    bsonjs = pytest.importorskip('bsonjs')
+    doc = {dbc.MONGO_ID: dbc.ObjectId(), 'pop': dbc.bson.Int64(2 ** 40),
+           'founded': datetime.datetime(1686, 7, 22, 0, 0, 0, 123000),
+           'area': 0.1, 'big': 1e20, 'whole': 3.0, 'inf': float('inf'),
+           'name': 'Albany "NY"\n', 'tags': [], 'nested': {'a': [1, None]},
+           'code': dbc.bson.Code('x'), 'dec': dbc.bson.Decimal128('1.1')}
+    raw = dbc.RawBSONDocument(dbc.bson.encode(doc))
+    with patch.object(dbc, 'bsonjs', None):
+        fallback = dbc.raw_to_json(raw)
+    with patch.object(dbc, 'bsonjs', bsonjs):
+        assert dbc.raw_to_json(raw) == fallback
@@ -0,0 +1,104 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+import data.db_connect as dbc
+import data.db_connect_async as dbca
+
+
+@pytest.fixture(autouse=True)
+def mongo_backend():
+    """
+    These tests mock the Mongo client, so make sure it is the one used.
+    """
+    with patch.object(dbc, 'DB_BACKEND', dbc.MONGO), \
+            patch.object(dbc, 'backend', None):
+        yield
+
+
+class AsyncCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def __aiter__(self):
+        return self.aiter()
+
+    async def aiter(self):
+        for doc in self.docs:
+            yield doc
+
+
+@pytest.fixture
+def mock_client():
+    client = MagicMock()
+    with patch.object(dbca, 'client', client), \
+            patch.object(dbca, 'connect_db', AsyncMock()):
+        yield client
+
+
+def test_create(mock_client):
+    coll = mock_client[dbc.SE_DB]['cities']
+    coll.insert_one = AsyncMock()
+    coll.insert_one.return_value.inserted_id = 'abcd'
+    assert asyncio.run(dbca.create('cities', {'name': 'A'})) == 'abcd'
+
+
+def test_read(mock_client):
+    coll = mock_client[dbc.SE_DB]['cities']
+    coll.find.return_value = AsyncCursor([{dbc.MONGO_ID: 1, 'name': 'A'}])
+    docs = asyncio.run(dbca.read('cities', filt={'name': 'A'}, limit=1))
+    assert docs == [{'name': 'A'}]
+    coll.find.assert_called_once_with({'name': 'A'}, {dbc.MONGO_ID: 0},
+                                      sort=None, limit=1, collation=None)
+
+
+def test_read_one_converts_id(mock_client):
+    coll = mock_client[dbc.SE_DB]['cities']
+    coll.find_one = AsyncMock(return_value={dbc.MONGO_ID: 7, 'name': 'A'})
+    doc = asyncio.run(dbca.read_one('cities', {'name': 'A'}))
+    assert doc == {dbc.MONGO_ID: '7', 'name': 'A'}
+
+
+def test_errors_become_db_errors(mock_client):
+    coll = mock_client[dbc.SE_DB]['cities']
+    coll.delete_one = AsyncMock(side_effect=dbc.pm.errors.OperationFailure(
+        'boom'))
+    with pytest.raises(dbc.DBError):
+        asyncio.run(dbca.delete('cities', {'name': 'A'}))
+
+
+def test_retry(mock_client):
+    coll = mock_client[dbc.SE_DB]['cities']
+    coll.update_one = AsyncMock(side_effect=[dbc.AutoReconnect('x'),
+                                             MagicMock(modified_count=1)])
+    assert asyncio.run(dbca.update('cities', {'name': 'A'}, {})) == 1
+
+
+def test_failed_trial_call_closes_breaker():
+    @dbca.retry_mongo(retries=1)
+    async def dup():
+        raise dbc.pm.errors.DuplicateKeyError('dup')
+    dbc.breaker.reset()
+    try:
+        for _ in range(dbc.breaker.threshold):
+            dbc.breaker.record_failure()
+        dbc.breaker.opened_at -= dbc.breaker.reset_after
+        with pytest.raises(dbc.pm.errors.DuplicateKeyError):
+            asyncio.run(dup())
+        assert dbc.breaker.state == dbc.CLOSED
+    finally:
+        dbc.breaker.reset()
+
+
+def test_connect_db_closes_client_from_old_loop():
+    old = MagicMock()
+    old.close = AsyncMock()
+    old_loop = MagicMock()
+    old_loop.is_running.return_value = False
+    with patch.object(dbca, 'client', old), \
+            patch.object(dbca, 'client_loop', old_loop), \
+            patch.object(dbca, 'AsyncMongoClient', MagicMock()), \
+            patch.object(dbc, 'client_args', return_value=('', {})):
+        asyncio.run(dbca.connect_db())
+    old.close.assert_awaited_once()
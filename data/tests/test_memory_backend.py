@@ -0,0 +1,138 @@
+from unittest.mock import patch
+
+import pytest
+
+import data.db_connect as dbc
+import data.memory_backend as mem
+
+COLL = 'mem_test_cities'
+
+
+@pytest.fixture
+def mem_db():
+    dbc.register_indexes(COLL, [
+        {dbc.INDEX_KEYS: [('name', dbc.ASCENDING)]},
+        {dbc.INDEX_KEYS: [('state_code', dbc.ASCENDING),
+                          ('name', dbc.ASCENDING)],
+         dbc.INDEX_UNIQUE: True},
+    ])
+    with patch.object(dbc, 'DB_BACKEND', dbc.MEMORY), \
+            patch.object(dbc, 'backend', mem.MemoryBackend()):
+        for name, state_code, pop in [('Albany', 'NY', 100),
+                                      ('Buffalo', 'NY', 270),
+                                      ('Austin', 'TX', 960)]:
+            dbc.create(COLL, {'name': name, 'state_code': state_code,
+                              'population': pop})
+        yield dbc.backend
+    del dbc.index_registry[COLL]
+
+
+def test_matches():
+    doc = {'name': 'Albany', 'population': 100, 'tags': ['capital']}
+    assert mem.matches(doc, {'name': 'Albany'})
+    assert mem.matches(doc, {'population': {'$gte': 100, '$lt': 200}})
+    assert mem.matches(doc, {'name': {'$in': ['Albany', 'Troy']}})
+    assert mem.matches(doc, {'tags': 'capital'})
+    assert mem.matches(doc, {'mayor': None})
+    assert mem.matches(doc, {'$or': [{'name': 'Troy'}, {'population': 100}]})
+    assert not mem.matches(doc, {'population': {'$gt': 'abc'}})
+    assert not mem.matches(doc, {'mayor': {'$exists': True}})
+
+
+def test_project():
+    doc = {dbc.MONGO_ID: 1, 'name': 'A', 'population': 2}
+    assert mem.project(doc, {'name': 1, dbc.MONGO_ID: 0}) == {'name': 'A'}
+    assert mem.project(doc, {dbc.MONGO_ID: 0}) == {'name': 'A',
+                                                   'population': 2}
+    assert mem.project(doc, None) == doc
+
+
+def test_read_pushes_down(mem_db):
+    docs = dbc.read(COLL, filt={'state_code': 'NY'}, fields=['name'],
+                    sort=[('population', dbc.DESCENDING)], limit=1)
+    assert docs == [{'name': 'Buffalo'}]
+
+
+def test_hash_index_narrows(mem_db):
+    coll = mem_db.collection(dbc.SE_DB, COLL)
+    assert len(coll.candidates({'name': 'Austin'})) == 1
+    assert len(coll.candidates({'population': 960})) == 3
+
+
+def test_read_one_and_update(mem_db):
+    doc = dbc.read_one(COLL, {'name': 'Albany'})
+    assert isinstance(doc[dbc.MONGO_ID], str)
+    assert dbc.update(COLL, {'name': 'Albany'}, {'population': 101}) == 1
+    assert dbc.update(COLL, {'name': 'Albany'}, {'population': 101}) == 0
+    assert dbc.read_one(COLL, {'population': 101})['name'] == 'Albany'
+    assert dbc.read_one(COLL, {'population': 100}) is None
+
+
+def test_unique_index(mem_db):
+    with pytest.raises(dbc.DBError):
+        dbc.create(COLL, {'name': 'Albany', 'state_code': 'NY'})
+    results = dbc.create_many(COLL, [{'name': 'Troy', 'state_code': 'NY'},
+                                     {'name': 'Albany', 'state_code': 'NY'},
+                                     {'name': 'Utica', 'state_code': 'NY'}])
+    assert dbc.BULK_ID in results[0]
+    assert dbc.BULK_ERROR in results[1]
+    assert results[2] == {dbc.BULK_ERROR: dbc.NOT_ATTEMPTED}
+
+
+def test_delete_and_bulk(mem_db):
+    assert dbc.delete(COLL, {'name': 'Austin'}) == 1
+    assert dbc.delete(COLL, {'name': 'Austin'}) == 0
+    ret = dbc.bulk_write(COLL, [(dbc.UPDATE, {'name': 'Albany'},
+                                 {'population': 5}),
+                                (dbc.DELETE, {'name': 'Buffalo'})])
+    assert ret[dbc.BULK_MODIFIED] == 1
+    assert ret[dbc.BULK_DELETED] == 1
+    assert [doc['name'] for doc in dbc.read(COLL)] == ['Albany']
+
+
+def test_read_page(mem_db):
+    sort = [('name', dbc.ASCENDING)]
+    names, after = [], None
+    while True:
+        docs, after = dbc.read_page(COLL, fields=['name'], sort=sort,
+                                    limit=2, after=after)
+        names.append([doc['name'] for doc in docs])
+        assert all(list(doc) == ['name'] for doc in docs)
+        if after is None:
+            break
+    assert names == [['Albany', 'Austin'], ['Buffalo']]
+
+
+def test_read_page_ties_and_desc(mem_db):
+    dbc.create(COLL, {'name': 'Albany', 'state_code': 'GA',
+                      'population': 70})
+    sort = [('population', dbc.DESCENDING)]
+    first, after = dbc.read_page(COLL, filt={'name': 'Albany'}, sort=sort,
+                                 limit=1)
+    second, after = dbc.read_page(COLL, filt={'name': 'Albany'}, sort=sort,
+                                  limit=1, after=after)
+    assert [first[0]['state_code'], second[0]['state_code']] == ['NY', 'GA']
+    assert after is None
+
+
+def test_case_insensitive(mem_db):
+    dbc.create(COLL, {'name': 'aurora', 'state_code': 'CO',
+                      'population': 400})
+    names = [doc['name'] for doc in dbc.read(
+        COLL, sort=[('name', dbc.ASCENDING)], collation=dbc.CI_COLLATION)]
+    assert names == ['Albany', 'aurora', 'Austin', 'Buffalo']
+    assert len(dbc.read(COLL, filt={'name': 'ALBANY'},
+                        collation=dbc.CI_COLLATION)) == 1
+
+
+def test_counts(mem_db):
+    assert dbc.count(COLL) == 3
+    assert dbc.count(COLL, {'state_code': 'NY'}) == 2
+    assert dbc.group_count(COLL, 'state_code') == {'NY': 2, 'TX': 1}
+    assert dbc.group_count(COLL, 'mayor') == {None: 3}
+
+
+def test_read_json_iter(mem_db):
+    lines = list(dbc.read_json_iter(COLL, filt={'state_code': 'TX'}))
+    assert lines == ['{"name": "Austin", "state_code": "TX", '
+                     '"population": 960}']
@@ -0,0 +1,99 @@
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+
+import data.db_connect as dbc
+import data.memory_backend as mem
+from data import metrics
+
+COLL = 'metrics_test'
+
+
+@pytest.fixture(autouse=True)
+def fresh_metrics():
+    dbc.reset_metrics()
+    yield
+    dbc.reset_metrics()
+
+
+def event(name, command=None, reply=None, request_id=1, micros=3000):
+    return SimpleNamespace(command_name=name, command=command or {},
+                           reply=reply, request_id=request_id,
+                           connection_id=('localhost', 27017),
+                           duration_micros=micros)
+
+
+def test_histogram_and_percentiles():
+    stats = metrics.OpStats()
+    for ms in [0.5] * 98 + [30, 6000]:
+        stats.add(ms)
+    ret = stats.to_dict()
+    assert ret[metrics.COUNT] == 100
+    assert ret[metrics.HISTOGRAM] == {'<=1ms': 98, '<=50ms': 1,
+                                      '>5000ms': 1}
+    assert ret[metrics.P50_MS] == 1.0
+    assert ret[metrics.P99_MS] == 50.0
+    assert ret[metrics.MAX_MS] == 6000
+
+
+@patch('data.metrics.COUNT_BYTES', True)
+def test_command_monitor():
+    monitor = metrics.CommandMonitor()
+    monitor.started(event('find', {'find': COLL, 'filter': {}}))
+    monitor.succeeded(event('find', reply={
+        'cursor': {'firstBatch': [{'a': 1}, {'a': 2}]}, 'ok': 1}))
+    monitor.started(event('ping', {'ping': 1}, request_id=2))
+    monitor.succeeded(event('ping', reply={'ok': 1}, request_id=2))
+    stats = dbc.get_metrics()[metrics.COMMANDS]
+    assert list(stats) == [COLL]
+    find = stats[COLL]['find']
+    assert find[metrics.COUNT] == 1
+    assert find[metrics.DOCS] == 2
+    assert find[metrics.TOTAL_MS] == 3.0
+    assert find[metrics.BYTES_SENT] > 0
+    assert find[metrics.BYTES_RECEIVED] > 0
+
+
+def test_bytes_not_counted_by_default():
+    monitor = metrics.CommandMonitor()
+    monitor.started(event('find', {'find': COLL, 'filter': {}}))
+    monitor.succeeded(event('find', reply={'ok': 1}))
+    find = dbc.get_metrics()[metrics.COMMANDS][COLL]['find']
+    assert find[metrics.BYTES_SENT] == find[metrics.BYTES_RECEIVED] == 0
+
+
+def test_command_monitor_failure():
+    monitor = metrics.CommandMonitor()
+    monitor.started(event('getMore', {'getMore': 7, 'collection': COLL}))
+    monitor.failed(event('getMore'))
+    stats = dbc.get_metrics()[metrics.COMMANDS][COLL]['getMore']
+    assert stats[metrics.ERRORS] == 1
+
+
+def test_operations_timed():
+    with patch.object(dbc, 'DB_BACKEND', dbc.MEMORY), \
+            patch.object(dbc, 'backend', mem.MemoryBackend()):
+        dbc.create(COLL, {'name': 'a'})
+        dbc.create(COLL, {'name': 'b'})
+        dbc.read(COLL)
+    ops = dbc.get_metrics()[metrics.OPERATIONS][COLL]
+    assert ops['create'][metrics.COUNT] == 2
+    assert ops['read'][metrics.DOCS] == 2
+
+
+def test_errors_and_retries_counted():
+    @dbc.handle_errors
+    @dbc.retry_mongo(retries=3)
+    def flaky(collection):
+        raise dbc.AutoReconnect('down')
+
+    with patch.object(dbc, 'breaker',
+                      dbc.CircuitBreaker(threshold=10, reset_after=1)), \
+            patch('time.sleep'):
+        with pytest.raises(dbc.DBError):
+            flaky(COLL)
+    stats = dbc.get_metrics()[metrics.OPERATIONS][COLL]['flaky']
+    assert stats[metrics.COUNT] == 1
+    assert stats[metrics.ERRORS] == 1
+    assert stats[metrics.RETRIES] == 2
@@ -0,0 +1,26 @@
+from data import records
+
+City = records.record_type('cities', ('name', 'population', 'state_code',
+                                      'bad-name', 'get'))
+
+
+def test_round_trip():
+    doc = {'name': 'Albany', 'state_code': 'NY', 'mayor': 'Someone',
+           'bad-name': 1, 'get': 2}
+    rec = City.from_dict(doc)
+    assert rec.to_dict() == doc
+    assert rec.get('name') == 'Albany'
+    assert rec.get('mayor') == 'Someone'
+    assert rec.get('population') is None
+    assert rec.get('nope', 7) == 7
+    assert 'population' not in rec.to_dict()
+
+
+def test_no_extra_dict_when_not_needed():
+    rec = City.from_dict({'name': 'Albany'})
+    assert rec.extra_fields is None
+
+
+def test_smaller_than_a_dict():
+    doc = {'name': 'Albany', 'population': '99,000', 'state_code': 'NY'}
+    assert records.size(City.from_dict(doc)) < records.size(doc)
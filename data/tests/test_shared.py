@@ -0,0 +1,55 @@
+import multiprocessing
+import os
+
+import pytest
+
+from data import shared
+
+pytestmark = pytest.mark.skipif(not shared.available(),
+                                reason='needs fcntl')
+
+
+def test_stamp_starts_at_zero(tmp_path):
+    stamp = shared.SharedStamp(str(tmp_path / 'c.version'))
+    assert stamp.version() == 0
+    assert stamp.modified_at() > 0
+
+
+def test_new_stamp_new_epoch(tmp_path):
+    path = str(tmp_path / 'c.version')
+    stamp = shared.SharedStamp(path)
+    epoch = stamp.epoch()
+    stamp.bump()
+    assert stamp.epoch() == epoch
+    assert shared.SharedStamp(path).epoch() == epoch
+    os.remove(path)
+    assert shared.SharedStamp(path).epoch() != epoch
+
+
+def test_bump_is_seen_by_other_mappings(tmp_path):
+    path = str(tmp_path / 'c.version')
+    one, two = shared.SharedStamp(path), shared.SharedStamp(path)
+    assert one.bump() == 1
+    assert two.version() == 1
+    assert two.bump() == 2
+    assert one.read()[0] == 2
+
+
+def bump_many(path: str, times: int):
+    stamp = shared.SharedStamp(path)
+    for _ in range(times):
+        stamp.bump()
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_bumps_from_many_processes(tmp_path):
+    path = str(tmp_path / 'c.version')
+    stamp = shared.SharedStamp(path)
+    ctx = multiprocessing.get_context('fork')
+    procs = [ctx.Process(target=bump_many, args=(path, 50))
+             for _ in range(4)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    assert stamp.version() == 200
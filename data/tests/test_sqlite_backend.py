@@ -0,0 +1,164 @@
+import json
+import threading
+from unittest.mock import patch
+
+import pytest
+
+import data.db_connect as dbc
+import data.sqlite_backend as sql
+
+COLL = 'sqlite_test_counties'
+
+
+@pytest.fixture
+def sqlite_db(tmp_path):
+    dbc.register_indexes(COLL, [
+        {dbc.INDEX_KEYS: [('name', dbc.ASCENDING)]},
+        {dbc.INDEX_KEYS: [('STATE_CODE', dbc.ASCENDING),
+                          ('name', dbc.ASCENDING)],
+         dbc.INDEX_UNIQUE: True},
+    ])
+    db = sql.SQLiteBackend(str(tmp_path / 'test.sqlite3'))
+    with patch.object(dbc, 'DB_BACKEND', dbc.SQLITE), \
+            patch.object(dbc, 'backend', db):
+        for name, state_code, pop in [('Albany', 'NY', 100),
+                                      ('Erie', 'NY', 950),
+                                      ('Travis', 'TX', 1300)]:
+            dbc.create(COLL, {'name': name, 'STATE_CODE': state_code,
+                              'population': pop})
+        yield db
+    del dbc.index_registry[COLL]
+
+
+def test_where_sql():
+    where, params = sql.where_sql({'name': 'Albany',
+                                   'population': {'$gte': 100}})
+    assert where == "name = ? AND json_extract(doc, '$.population') >= ?"
+    assert params == ['Albany', 100]
+    assert sql.where_sql({}) == ('1', [])
+    assert sql.where_sql({'mayor': None})[0].endswith('IS NULL')
+
+
+def test_where_sql_untranslatable():
+    with pytest.raises(sql.Untranslatable):
+        sql.where_sql({'name': {'$regex': '^A'}})
+    with pytest.raises(sql.Untranslatable):
+        sql.where_sql({'bad field': 1})
+
+
+def test_read_pushes_down(sqlite_db):
+    docs = dbc.read(COLL, filt={'STATE_CODE': 'NY'}, fields=['name'],
+                    sort=[('population', dbc.DESCENDING)], limit=1)
+    assert docs == [{'name': 'Erie'}]
+
+
+def test_read_operators(sqlite_db):
+    names = [doc['name'] for doc in dbc.read(
+        COLL, filt={'$or': [{'name': {'$in': ['Albany', 'Nowhere']}},
+                            {'population': {'$gt': 1000}}]},
+        sort=[('name', dbc.ASCENDING)])]
+    assert names == ['Albany', 'Travis']
+    assert len(dbc.read(COLL, filt={'mayor': {'$exists': False}})) == 3
+    assert len(dbc.read(COLL, filt={'name': {'$ne': 'Erie'}})) == 2
+
+
+def test_python_fallback(sqlite_db):
+    dbc.update(COLL, {'name': 'Erie'}, {'county seat': 'Buffalo'})
+    docs = dbc.read(COLL, filt={'county seat': 'Buffalo'},
+                    sort=[('county seat', dbc.ASCENDING)])
+    assert [doc['name'] for doc in docs] == ['Erie']
+
+
+def test_indexes_used(sqlite_db):
+    table = sqlite_db.table(dbc.SE_DB, COLL)
+    where, params = sql.where_sql({'STATE_CODE': 'NY', 'name': 'Erie'})
+    plan = sqlite_db.conn().execute(
+        f'EXPLAIN QUERY PLAN SELECT doc FROM {table} WHERE {where}',
+        params).fetchall()
+    assert 'USING INDEX' in plan[0][-1]
+
+
+def test_read_one_update_delete(sqlite_db):
+    doc = dbc.read_one(COLL, {'name': 'Albany'})
+    assert isinstance(doc[dbc.MONGO_ID], str)
+    assert dbc.update(COLL, {'name': 'Albany'}, {'population': 101}) == 1
+    assert dbc.update(COLL, {'name': 'Albany'}, {'population': 101}) == 0
+    assert dbc.read_one(COLL, {'name': 'Albany'})['population'] == 101
+    assert dbc.delete(COLL, {'name': 'Albany'}) == 1
+    assert dbc.read_one(COLL, {'name': 'Albany'}) is None
+
+
+def test_unique_index(sqlite_db):
+    with pytest.raises(dbc.DBError):
+        dbc.create(COLL, {'name': 'Erie', 'STATE_CODE': 'NY'})
+    # same name in another state is fine
+    dbc.create(COLL, {'name': 'Erie', 'STATE_CODE': 'PA'})
+
+
+def test_bulk(sqlite_db):
+    results = dbc.create_many(COLL, [{'name': 'Kings', 'STATE_CODE': 'NY'},
+                                     {'name': 'Erie', 'STATE_CODE': 'NY'},
+                                     {'name': 'Queens', 'STATE_CODE': 'NY'}])
+    assert dbc.BULK_ID in results[0]
+    assert dbc.BULK_ERROR in results[1]
+    assert results[2] == {dbc.BULK_ERROR: dbc.NOT_ATTEMPTED}
+    ret = dbc.bulk_write(COLL, ['Kings', 'Travis'], ordered=False,
+                         make_op=lambda name: (dbc.DELETE, {'name': name}))
+    assert ret[dbc.BULK_DELETED] == 2
+
+
+def test_concurrent_updates_all_land(sqlite_db):
+    def bump(field):
+        for num in range(20):
+            dbc.update(COLL, {'name': 'Albany'}, {field: num})
+    threads = [threading.Thread(target=bump, args=(f'f{num}',))
+               for num in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    doc = dbc.read_one(COLL, {'name': 'Albany'})
+    assert all(doc[f'f{num}'] == 19 for num in range(4))
+
+
+def test_read_iter(sqlite_db):
+    names = [doc['name'] for doc in dbc.read_iter(
+        COLL, sort=[('name', dbc.DESCENDING)], batch_size=1)]
+    assert names == ['Travis', 'Erie', 'Albany']
+
+
+def test_read_page(sqlite_db):
+    sort = [('STATE_CODE', dbc.ASCENDING), ('name', dbc.DESCENDING)]
+    docs, after = dbc.read_page(COLL, sort=sort, limit=2)
+    assert [doc['name'] for doc in docs] == ['Erie', 'Albany']
+    docs, after = dbc.read_page(COLL, sort=sort, limit=2, after=after)
+    assert [doc['name'] for doc in docs] == ['Travis']
+    assert after is None
+
+
+def test_case_insensitive(sqlite_db):
+    dbc.create(COLL, {'name': 'bronx', 'STATE_CODE': 'NY'})
+    names = [doc['name'] for doc in dbc.read(
+        COLL, sort=[('name', dbc.ASCENDING)], collation=dbc.CI_COLLATION)]
+    assert names == ['Albany', 'bronx', 'Erie', 'Travis']
+    assert len(dbc.read(COLL, filt={'name': 'ERIE'},
+                        collation=dbc.CI_COLLATION)) == 1
+
+
+def test_counts(sqlite_db):
+    assert dbc.count(COLL) == 3
+    assert dbc.count(COLL, {'STATE_CODE': 'NY'}) == 2
+    assert dbc.count(COLL, {'bad field': None}) == 3
+    assert dbc.group_count(COLL, 'STATE_CODE') == {'NY': 2, 'TX': 1}
+    assert dbc.group_count(COLL, 'STATE_CODE',
+                           {'population': {'$gt': 500}}) == {'NY': 1,
+                                                             'TX': 1}
+
+
+def test_read_json_iter(sqlite_db):
+    lines = list(dbc.read_json_iter(COLL, filt={'STATE_CODE': 'NY'},
+                                    sort=[('name', dbc.ASCENDING)]))
+    assert [json.loads(line)['name'] for line in lines] == ['Albany', 'Erie']
+    lines = list(dbc.read_json_iter(COLL, filt={'name': 'Erie'},
+                                    fields=['population']))
+    assert [json.loads(line) for line in lines] == [{'population': 950}]
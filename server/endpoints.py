@@ -3,12 +3,21 @@ This is the file containing all of the endpoints for our flask app.
 The endpoint called `endpoints` will return all available endpoints.
 """
 # from http import HTTPStatus
-
-from flask import Flask  # , request
+import gzip
+import json
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Flask, Response, stream_with_context  # , request
 from flask_restx import Resource, Api  # , fields  # Namespace
 from flask import request
 from flask_cors import CORS
+from werkzeug.http import http_date, quote_etag
 
+import data.cache as dcache
+import data.db_connect as dbc
 import countries.queries_countries as countries
 import states.queries_states as states
 import cities.queries_cities as cities
@@ -16,6 +25,13 @@ import counties.queries_counties as counties
 
 # import werkzeug.exceptions as wz
 
+# share the entity caches with the other workers, if CACHE_SHARED is set,
+# warm them from their snapshots, if CACHE_SNAPSHOT_DIR is, and keep them
+# fresh in the background, if CACHE_REFRESH is
+dcache.share_caches()
+dcache.load_snapshots()
+dcache.start_refreshers()
+
 app = Flask(__name__)
 CORS(app)
 api = Api(
@@ -33,6 +49,373 @@ HELLO_EP = '/hello'
 HELLO_RESP = 'hello'
 MESSAGE = 'Message'
 
+FIELDS_PARAM = 'fields'
+# ?sort=state_code,-name sorts by state_code, then by name descending
+SORT_PARAM = 'sort'
+DESC_PREFIX = '-'
+# ?collation=ci sorts (and filters) without regard to case
+COLLATION_PARAM = 'collation'
+CASE_INSENSITIVE = 'ci'
+# keyset pagination: ?limit=50, then ?limit=50&after=<next>
+LIMIT_PARAM = 'limit'
+AFTER_PARAM = 'after'
+FROM_PARAM = 'from'
+TO_PARAM = 'to'
+# what, besides its filters, a list endpoint reads from the query string
+LIST_PARAMS = (FIELDS_PARAM, SORT_PARAM, COLLATION_PARAM, LIMIT_PARAM,
+               AFTER_PARAM, FROM_PARAM, TO_PARAM)
+NEXT = 'next'
+MAX_PAGE_LIMIT = 1000
+
+# bulk request bodies: a bare list of records, or
+# {BULK_RECORDS: [...], BULK_ORDERED: true}
+BULK_RECORDS = 'records'
+BULK_ORDERED = 'ordered'
+BULK_RESULTS = 'results'
+
+JSON_MIME = 'application/json'
+NDJSON_MIME = 'application/x-ndjson'
+# How many docs go into each chunk of a streamed response.
+STREAM_CHUNK_DOCS = 100
+
+# Lists carry these, so that pollers can ask for them conditionally.
+ETAG = 'ETag'
+LAST_MODIFIED = 'Last-Modified'
+NDJSON_TAG = 'nd'
+
+# The encoded bodies of recent list responses, one per request (path,
+# the query parameters that shape the list, and whether gzipped), each
+# kept with the version of the collection it was built from (see
+# `body_tag()`), so a write to the collection retires it, and for no
+# longer than the entity caches keep a record, so neither do writes
+# made outside the app go unseen for longer.
+BODY_CACHE_SIZE = 64
+BODY_CACHE_BYTES = 64 * 1024 * 1024
+BODY_TTL = dcache.CACHE_TTL
+GZIP = 'gzip'
+GZIP_MIN_BYTES = 1024
+# most of level 9's saving for a fraction of its time
+GZIP_LEVEL = 6
+body_cache = OrderedDict()
+body_lock = threading.Lock()
+NAME_SORT = [('name', dbc.ASCENDING)]
+
+# /stats is computed at most once per STATS_TTL seconds.
+STATS_TTL = 10
+STATS_AT = 'at'
+STATS = 'stats'
+stats_cache = {STATS_AT: 0.0, STATS: None}
+
+# Query parameters that each list endpoint turns into an equality filter.
+CITY_FILTERS = [cities.STATE_CODE, cities.STATE]
+COUNTY_FILTERS = [counties.STATE_CODE, counties.STATE]
+STATE_FILTERS = [states.COUNTRY_CODE, states.CODE]
+COUNTRY_FILTERS = [countries.CONTENTIENT]
+
+
+def list_args(filter_fields: list, collection: str) -> dict:
+    """
+    Build the `filt`, `fields`, `sort` and `collation` arguments for a
+    query module's `read()` from the request's query string, e.g.:
+        /cities?state_code=NY&fields=name,population&sort=-name
+    """
+    filt = {field: request.args[field] for field in filter_fields
+            if field in request.args}
+    fields = None
+    if request.args.get(FIELDS_PARAM):
+        fields = request.args[FIELDS_PARAM].split(',')
+    return dict(sort_args(collection), filt=filt, fields=fields)
+
+
+def sort_args(collection: str) -> dict:
+    """
+    The sort defaults to by name. We only take orders that an index can
+    deliver, so the db never sorts in memory and we never sort at all.
+    """
+    collation = None
+    if COLLATION_PARAM in request.args:
+        if request.args[COLLATION_PARAM] != CASE_INSENSITIVE:
+            raise ValueError(f'{COLLATION_PARAM} may only be '
+                             f'{CASE_INSENSITIVE}')
+        collation = dbc.CI_COLLATION
+    sort = NAME_SORT
+    if request.args.get(SORT_PARAM):
+        sort = [(field[1:], dbc.DESCENDING) if field.startswith(DESC_PREFIX)
+                else (field, dbc.ASCENDING)
+                for field in request.args[SORT_PARAM].split(',')]
+    paged = ((LIMIT_PARAM in request.args or AFTER_PARAM in request.args)
+             and FROM_PARAM not in request.args
+             and TO_PARAM not in request.args)
+    # a page is read in `dbc.page_sort()` order, which ends in _id
+    if not dbc.is_sort_indexed(collection,
+                               dbc.page_sort(sort) if paged else sort,
+                               collation):
+        raise ValueError(f'No index to sort {collection} by '
+                         f'{request.args.get(SORT_PARAM, "name")}'
+                         + (f' with {COLLATION_PARAM}={CASE_INSENSITIVE}'
+                            if collation else ''))
+    return {'sort': sort, 'collation': collation}
+
+
+def page_args() -> dict | None:
+    """
+    The `limit` and `after` arguments for a query module's `read_page()`,
+    or None if the client didn't ask for a page (and so gets the whole
+    list, as before).
+    """
+    if LIMIT_PARAM not in request.args and AFTER_PARAM not in request.args:
+        return None
+    limit = request.args.get(LIMIT_PARAM, str(dbc.DEFAULT_PAGE_SIZE))
+    if not limit.isdigit() or not 1 <= int(limit) <= MAX_PAGE_LIMIT:
+        raise ValueError(f'{LIMIT_PARAM} must be from 1 to '
+                         f'{MAX_PAGE_LIMIT}, not {limit}')
+    return {'limit': int(limit), 'after': request.args.get(AFTER_PARAM)}
+
+
+def range_args() -> dict | None:
+    """
+    The `start`, `end` and `limit` arguments for a query module's
+    `read_range()`, e.g. /cities?from=A&to=D for the cities from A up to
+    (not including) D, or None if the client didn't ask for a range.
+    """
+    if FROM_PARAM not in request.args and TO_PARAM not in request.args:
+        return None
+    page = page_args()
+    if page is not None and page['after'] is not None:
+        raise ValueError(f'{AFTER_PARAM} does not go with {FROM_PARAM} '
+                         f'and {TO_PARAM}')
+    return {'start': request.args.get(FROM_PARAM),
+            'end': request.args.get(TO_PARAM),
+            'limit': page['limit'] if page else 0}
+
+
+def grouped(counts: dict) -> dict:
+    """
+    JSON keys must be strings; docs without the field count as "None".
+    """
+    return {str(key): num for key, num in counts.items()}
+
+
+def get_stats() -> dict:
+    """
+    Totals and per-group counts, all computed by the db, and reused for
+    STATS_TTL seconds: they needn't be exact, and /stats gets polled.
+    """
+    now = time.monotonic()
+    if stats_cache[STATS] is None or now - stats_cache[STATS_AT] >= STATS_TTL:
+        stats_cache[STATS] = {
+            'countries': countries.count(),
+            'states': states.count(),
+            'cities': cities.count(),
+            'counties': counties.count(),
+            'cities_per_state': grouped(cities.count_by(cities.STATE_CODE)),
+            'counties_per_state': grouped(
+                counties.count_by(counties.STATE_CODE)),
+            'states_per_country': grouped(
+                states.count_by(states.COUNTRY_CODE)),
+        }
+        stats_cache[STATS_AT] = now
+    return stats_cache[STATS]
+
+
+def server_error(e: Exception) -> tuple:
+    """
+    The db being unreachable is a 503 (try again later); anything else
+    is a 500.
+    """
+    if (isinstance(e, dbc.CircuitOpenError)
+            or isinstance(e.__cause__, dbc.RETRYABLE)):
+        return ({'error': str(e)}, 503,
+                {'Retry-After': str(int(dbc.BREAKER_RESET))})
+    return {'error': str(e)}, 500
+
+
+def bulk_args() -> tuple:
+    """
+    Returns the (records, ordered) pair from a bulk request's body.
+    """
+    data = request.get_json(force=True)
+    if isinstance(data, dict):
+        return data.get(BULK_RECORDS), bool(data.get(BULK_ORDERED, True))
+    return data, True
+
+
+def wants_ndjson() -> bool:
+    """
+    Clients ask for a streamed list with `Accept: application/x-ndjson`.
+    """
+    return (request.accept_mimetypes.best_match([JSON_MIME, NDJSON_MIME])
+            == NDJSON_MIME)
+
+
+def ndjson_response(docs, headers: dict = None) -> Response:
+    """
+    Stream `docs` (any iterable of JSON strings) as newline-delimited
+    JSON, a chunk at a time, so neither the server nor the client holds
+    the whole list.
+    """
+    def generate():
+        lines = []
+        for doc in docs:
+            lines.append(doc + '\n')
+            if len(lines) >= STREAM_CHUNK_DOCS:
+                yield ''.join(lines)
+                lines = []
+        if lines:
+            yield ''.join(lines)
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIME,
+                    headers=headers)
+
+
+def validators(cache: dcache.EntityCache) -> dict:
+    """
+    The ETag and Last-Modified headers for a list of the collection as it
+    is now. Take them before reading the list: a write that lands while
+    we read then makes the client's next request fetch it again.
+    None at all unless the cache is shared, as only then do we hear of
+    every worker's writes.
+    HTTP dates are whole seconds, so Last-Modified is rounded up, and
+    only sent once that second is over: a later write then always has a
+    later date.
+    """
+    etag = cache.etag()
+    if etag is None:
+        return {}
+    if wants_ndjson():
+        etag = f'{etag}-{NDJSON_TAG}'
+    headers = {ETAG: quote_etag(etag)}
+    modified = math.ceil(cache.last_modified())
+    if modified <= time.time():
+        headers[LAST_MODIFIED] = http_date(modified)
+    return headers
+
+
+def not_modified(cache: dcache.EntityCache, headers: dict) -> bool:
+    """
+    Does the client already have this version of the list?
+    If-None-Match wins over If-Modified-Since when both are sent.
+    """
+    if ETAG not in headers:
+        return False
+    if request.if_none_match:
+        return request.if_none_match.contains(headers[ETAG].strip('"'))
+    if request.if_modified_since:
+        return (math.ceil(cache.last_modified())
+                <= request.if_modified_since.timestamp())
+    return False
+
+
+def not_modified_response(headers: dict) -> Response:
+    return Response(status=304, headers=headers)
+
+
+def body_key(filter_fields: list) -> tuple:
+    """
+    What a list response depends on. Query parameters that no list
+    endpoint reads are left out, so that they don't split the cache.
+    """
+    names = sorted(set(filter_fields).union(LIST_PARAMS))
+    args = tuple((name, request.args[name]) for name in names
+                 if name in request.args)
+    return (request.path, args, request.accept_encodings[GZIP] > 0)
+
+
+def body_response(body: bytes, gzipped: bool, headers: dict) -> Response:
+    resp = Response(body, mimetype=JSON_MIME, headers=headers)
+    resp.vary.add('Accept-Encoding')
+    if gzipped:
+        resp.content_encoding = GZIP
+    return resp
+
+
+def body_tag(cache: dcache.EntityCache) -> str:
+    """
+    The version of the collection a kept body is good for: its ETag if
+    the caches are shared, or else this process's own version, which
+    counts every write when there is only the one process. Take it
+    before reading the list, as with `validators()`.
+    """
+    return cache.etag() or f'{cache.collection}-{cache.version}'
+
+
+def cached_body(key: tuple, tag: str, headers: dict) -> Response | None:
+    """
+    The response we built for this same request, if the collection
+    hasn't changed since and it isn't too old: a copy of its bytes,
+    with no reading or encoding.
+    """
+    with body_lock:
+        entry = body_cache.get(key)
+        if (entry is None or entry[0] != tag
+                or time.monotonic() >= entry[1]):
+            return None
+        body_cache.move_to_end(key)
+    return body_response(entry[2], entry[3], headers)
+
+
+def list_response(data: dict, headers: dict, key: tuple,
+                  tag: str) -> Response:
+    """
+    Encode a list as flask-restx would and keep the bytes, with `tag`,
+    for `cached_body()`. It is gzipped if the client takes it and it's
+    worth it: not for a body too big to keep, which we would have to
+    compress again for every request.
+    """
+    body = (json.dumps(data) + '\n').encode()
+    keep = len(body) <= BODY_CACHE_BYTES
+    gzipped = key[2] and keep and len(body) >= GZIP_MIN_BYTES
+    if gzipped:
+        body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+    if keep:
+        with body_lock:
+            body_cache[key] = (tag, time.monotonic() + BODY_TTL, body,
+                               gzipped)
+            body_cache.move_to_end(key)
+            while (len(body_cache) > BODY_CACHE_SIZE
+                   or body_cache_bytes() > BODY_CACHE_BYTES):
+                body_cache.popitem(last=False)
+    return body_response(body, gzipped, headers)
+
+
+def body_cache_bytes() -> int:
+    return sum(len(entry[2]) for entry in body_cache.values())
+
+
+def list_get(module, cache: dcache.EntityCache, name: str,
+             filter_fields: list):
+    """
+    GET for one of our collections, shared by the list endpoints: reads
+    through query `module` and sends the list under `name`, as a range,
+    a page, a stream or the whole (filtered) list.
+    The query string is checked first, so a bad one is a 400 even when
+    the client's copy is current.
+    """
+    try:
+        args = list_args(filter_fields, cache.collection)
+        rng = range_args()
+        page = page_args() if rng is None else None
+        headers = validators(cache)
+        if not_modified(cache, headers):
+            return not_modified_response(headers)
+        if rng is None and page is None and wants_ndjson():
+            return ndjson_response(module.read_json_iter(**args), headers)
+        key, tag = body_key(filter_fields), body_tag(cache)
+        cached = cached_body(key, tag, headers)
+        if cached is not None:
+            return cached
+        if rng is not None:
+            docs = module.read_range(**rng, **args)
+            return list_response({name: docs}, headers, key, tag)
+        if page is not None:
+            docs, next_page = module.read_page(**page, **args)
+            return list_response({name: docs, NEXT: next_page}, headers,
+                                 key, tag)
+        return list_response({name: module.read(**args)}, headers, key, tag)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    except Exception as e:
+        return server_error(e)
+
 
 @api.route(HELLO_EP)
 class HelloWorld(Resource):
@@ -96,17 +479,26 @@ class Stats(Resource):
     @api.doc('get_stats')
     def get(self):
         """
-        Get count of all geographic entities
+        Get count of all geographic entities, and of cities and counties
+        per state and states per country
         """
         try:
-            return {
-                'countries': len(countries.read()),
-                'states': len(states.read()),
-                'cities': len(cities.read()),
-                'counties': len(counties.read())
-            }, 200
+            return get_stats(), 200
         except Exception as e:
-            return {'error': str(e)}, 500
+            return server_error(e)
+
+
+@api.route('/cache')
+class CacheStats(Resource):
+    """
+    Cache statistics endpoint
+    """
+    @api.doc('get_cache_stats')
+    def get(self):
+        """
+        Get hit, miss and eviction counts for each entity cache
+        """
+        return dcache.all_stats(), 200
 
 
 @api.route('/countries')
@@ -119,13 +511,8 @@ class Countries(Resource):
         """
         Get all countries
         """
-        try:
-            all_countries = countries.read()
-            sorted_countries = sorted(all_countries,
-                                      key=lambda x: x.get('name', ''))
-            return {'countries': sorted_countries}, 200
-        except Exception as e:
-            return {'error': str(e)}, 500
+        return list_get(countries, countries.country_cache, 'countries',
+                        COUNTRY_FILTERS)
 
     @api.doc('create_country')
     def post(self):
@@ -140,7 +527,52 @@ class Countries(Resource):
         except ValueError as e:
             return {'error': str(e)}, 400
         except Exception as e:
-            return {'error': str(e)}, 500
+            return server_error(e)
+
+
+@api.route('/countries/bulk')
+class CountriesBulk(Resource):
+    """
+    Endpoints for writing many countries at once
+    """
+    @api.doc('create_countries')
+    def post(self):
+        """
+        Create a batch of countries, returning one result per record
+        """
+        try:
+            recs, ordered = bulk_args()
+            return {BULK_RESULTS: countries.create_many(recs, ordered)}, 200
+        except ValueError as e:
+            return {'error': str(e)}, 400
+        except Exception as e:
+            return server_error(e)
+
+    @api.doc('update_countries')
+    def put(self):
+        """
+        Update a batch of countries: each record is {"name", "fields"}
+        """
+        try:
+            recs, ordered = bulk_args()
+            return countries.update_many(recs, ordered), 200
+        except ValueError as e:
+            return {'error': str(e)}, 400
+        except Exception as e:
+            return server_error(e)
+
+    @api.doc('delete_countries')
+    def delete(self):
+        """
+        Delete a batch of countries: each record is {"name"}
+        """
+        try:
+            recs, ordered = bulk_args()
+            return countries.delete_many(recs, ordered), 200
+        except ValueError as e:
+            return {'error': str(e)}, 400
+        except Exception as e:
+            return server_error(e)
 
 
 @api.route('/countries/<string:country_id>')
@@ -160,7 +592,7 @@ class Country(Resource):
             else:
                 return {'error': 'Country not found'}, 404
         except Exception as e:
-            return {'error': str(e)}, 500
+            return server_error(e)
 
     @api.doc('update_country')
     def put(self, country_id):
@@ -174,7 +606,7 @@ class Country(Resource):
         except ValueError as e:
             return {'error': str(e)}, 400
         except Exception as e:
-            return {'error': str(e)}, 500
+            return server_error(e)
 
     @api.doc('delete_country')
     def delete(self, country_id):
@@ -187,7 +619,7 @@ class Country(Resource):
         except ValueError as e:
             return {'error': str(e)}, 404
         except Exception as e:
-            return {'error': str(e)}, 500
+            return server_error(e)
 
 
 @api.route('/states')
@@ -200,13 +632,7 @@ class States(Resource):
         """
         Get all states
         """
-        try:
-            all_states = states.read()
-            sorted_states = sorted(all_states,
-                                   key=lambda x: x.get('name', ''))
-            return {'states': sorted_states}, 200
-        except Exception as e:
-            return {'error': str(e)}, 500
+        return list_get(states, states.state_cache, 'states', STATE_FILTERS)
 
     @api.doc('create_state')
     def post(self):
@@ -220,7 +646,52 @@ class States(Resource):
         except ValueError as e:
             return {'error': str(e)}, 400
         except Exception as e:
-            return {'error': str(e)}, 500
+            return server_error(e)
+
+
+@api.route('/states/bulk')
+class StatesBulk(Resource):
+    """
+    Endpoints for writing many states at once
+    """
+    @api.doc('create_states')
+    def post(self):
+        """
+        Create a batch of states, returning one result per record
+        """
+        try:
+            recs, ordered = bulk_args()
+            return {BULK_RESULTS: states.create_many(recs, ordered)}, 200
+        except ValueError as e:
+            return {'error': str(e)}, 400
+        except Exception as e:
+            return server_error(e)
+
+    @api.doc('update_states')
+    def put(self):
+        """
+        Update a batch of states: each record is {"id", "fields"}
+        """
+        try:
+            recs, ordered = bulk_args()
+            return states.update_many(recs, ordered), 200
+        except ValueError as e:
+            return {'error': str(e)}, 400
+        except Exception as e:
+            return server_error(e)
+
+    @api.doc('delete_states')
+    def delete(self):
+        """
+        Delete a batch of states: each record is {"id"}
+        """
+        try:
+            recs, ordered = bulk_args()
+            return states.delete_many(recs, ordered), 200
+        except ValueError as e:
+            return {'error': str(e)}, 400
+        except Exception as e:
+            return server_error(e)
 
 
 @api.route('/states/<string:state_id>')
@@ -240,7 +711,7 @@ class State(Resource):
             else:
                 return {'error': 'State not found'}, 404
         except Exception as e:
-            return {'error': str(e)}, 500
+            return server_error(e)
 
     @api.doc('update_state')
     def put(self, state_id):
@@ -254,7 +725,7 @@ class State(Resource):
         except ValueError as e:
             return {'error': str(e)}, 400
         except Exception as e:
-            return {'error': str(e)}, 500
+            return server_error(e)
 
     @api.doc('delete_state')
     def delete(self, state_id):
@@ -267,7 +738,7 @@ class State(Resource):
         except ValueError as e:
             return {'error': str(e)}, 404
         except Exception as e:
-            return {'error': str(e)}, 500
+            return server_error(e)
 
 
 @api.route('/cities')
@@ -280,13 +751,7 @@ class Cities(Resource):
         """
         Get all cities
         """
-        try:
-            all_cities = cities.read()
-            sorted_cities = sorted(all_cities,
-                                   key=lambda x: x.get('name', ''))
-            return {'cities': sorted_cities}, 200
-        except Exception as e:
-            return {'error': str(e)}, 500
+        return list_get(cities, cities.city_cache, 'cities', CITY_FILTERS)
 
     @api.doc('create_city')
     def post(self):
@@ -300,7 +765,52 @@ class Cities(Resource):
         except ValueError as e:
             return {'error': str(e)}, 400
         except Exception as e:
-            return {'error': str(e)}, 500
+            return server_error(e)
+
+
+@api.route('/cities/bulk')
+class CitiesBulk(Resource):
+    """
+    Endpoints for writing many cities at once
+    """
+    @api.doc('create_cities')
+    def post(self):
+        """
+        Create a batch of cities, returning one result per record
+        """
+        try:
+            recs, ordered = bulk_args()
+            return {BULK_RESULTS: cities.create_many(recs, ordered)}, 200
+        except ValueError as e:
+            return {'error': str(e)}, 400
+        except Exception as e:
+            return server_error(e)
+
+    @api.doc('update_cities')
+    def put(self):
+        """
+        Update a batch of cities: each record is {"name", "fields"}
+        """
+        try:
+            recs, ordered = bulk_args()
+            return cities.update_many(recs, ordered), 200
+        except ValueError as e:
+            return {'error': str(e)}, 400
+        except Exception as e:
+            return server_error(e)
+
+    @api.doc('delete_cities')
+    def delete(self):
+        """
+        Delete a batch of cities: each record is {"name"}
+        """
+        try:
+            recs, ordered = bulk_args()
+            return cities.delete_many(recs, ordered), 200
+        except ValueError as e:
+            return {'error': str(e)}, 400
+        except Exception as e:
+            return server_error(e)
 
 
 @api.route('/cities/<string:city_id>')
@@ -320,7 +830,7 @@ class City(Resource):
             else:
                 return {'error': 'City not found'}, 404
         except Exception as e:
-            return {'error': str(e)}, 500
+            return server_error(e)
 
     @api.doc('update_city')
     def put(self, city_id):
@@ -334,7 +844,7 @@ class City(Resource):
         except ValueError as e:
             return {'error': str(e)}, 400
         except Exception as e:
-            return {'error': str(e)}, 500
+            return server_error(e)
 
     @api.doc('delete_city')
     def delete(self, city_id):
@@ -347,7 +857,7 @@ class City(Resource):
         except ValueError as e:
             return {'error': str(e)}, 404
         except Exception as e:
-            return {'error': str(e)}, 500
+            return server_error(e)
 
 
 @api.route('/counties')
@@ -360,13 +870,8 @@ class Counties(Resource):
         """
         Get all counties
         """
-        try:
-            all_counties = counties.read()
-            sorted_counties = sorted(all_counties,
-                                     key=lambda x: x.get('name', ''))
-            return {'counties': sorted_counties}, 200
-        except Exception as e:
-            return {'error': str(e)}, 500
+        return list_get(counties, counties.county_cache, 'counties',
+                        COUNTY_FILTERS)
 
     @api.doc('create_county')
     def post(self):
@@ -381,7 +886,53 @@ class Counties(Resource):
         except ValueError as e:
             return {'error': str(e)}, 400
         except Exception as e:
-            return {'error': str(e)}, 500
+            return server_error(e)
+
+
+@api.route('/counties/bulk')
+class CountiesBulk(Resource):
+    """
+    Endpoints for writing many counties at once
+    """
+    @api.doc('create_counties')
+    def post(self):
+        """
+        Create a batch of counties, returning one result per record
+        """
+        try:
+            recs, ordered = bulk_args()
+            return {BULK_RESULTS: counties.create_many(recs, ordered)}, 200
+        except ValueError as e:
+            return {'error': str(e)}, 400
+        except Exception as e:
+            return server_error(e)
+
+    @api.doc('update_counties')
+    def put(self):
+        """
+        Update a batch of counties: each record is
+        {"name", "STATE_CODE", "fields"}
+        """
+        try:
+            recs, ordered = bulk_args()
+            return counties.update_many(recs, ordered), 200
+        except ValueError as e:
+            return {'error': str(e)}, 400
+        except Exception as e:
+            return server_error(e)
+
+    @api.doc('delete_counties')
+    def delete(self):
+        """
+        Delete a batch of counties: each record is {"name", "STATE_CODE"}
+        """
+        try:
+            recs, ordered = bulk_args()
+            return counties.delete_many(recs, ordered), 200
+        except ValueError as e:
+            return {'error': str(e)}, 400
+        except Exception as e:
+            return server_error(e)
 
 
 @api.route('/counties/<string:county_id>')
@@ -401,7 +952,7 @@ class County(Resource):
             else:
                 return {'error': 'County not found'}, 404
         except Exception as e:
-            return {'error': str(e)}, 500
+            return server_error(e)
 
     @api.doc('update_county')
     def put(self, county_id):
@@ -416,7 +967,7 @@ class County(Resource):
         except ValueError as e:
             return {'error': str(e)}, 400
         except Exception as e:
-            return {'error': str(e)}, 500
+            return server_error(e)
 
     @api.doc('delete_county')
     def delete(self, county_id):
@@ -429,4 +980,4 @@ class County(Resource):
         except ValueError as e:
             return {'error': str(e)}, 404
         except Exception as e:
-            return {'error': str(e)}, 500
+            return server_error(e)
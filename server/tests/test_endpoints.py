@@ -3,11 +3,14 @@ from http.client import (
     FORBIDDEN,
     NOT_ACCEPTABLE,
     NOT_FOUND,
+    NOT_MODIFIED,
     OK,
     SERVICE_UNAVAILABLE,
     CREATED,
 )
 
+import gzip
+import json
 from unittest.mock import patch
 
 import pytest
@@ -22,6 +25,12 @@ import endpoints as ep
 TEST_CLIENT = ep.app.test_client()
 
 
+@pytest.fixture(autouse=True)
+def no_cached_bodies():
+    """Tests that mock a read mustn't be answered by an earlier test's body"""
+    ep.body_cache.clear()
+
+
 def test_hello():
     resp = TEST_CLIENT.get(ep.HELLO_EP)
     resp_json = resp.get_json()
@@ -361,25 +370,51 @@ def test_delete_county(mock_delete):
     assert 'message' in resp_json
 
 
-@patch('countries.queries_countries.read')
-@patch('states.queries_states.read')
-@patch('cities.queries_cities.read')
-@patch('counties.queries_counties.read')
-def test_stats_endpoint(
-        mock_counties, mock_cities, mock_states, mock_countries):
+@pytest.fixture
+def no_stats_cache():
+    ep.stats_cache[ep.STATS] = None
+    yield
+    ep.stats_cache[ep.STATS] = None
+
+
+@patch('data.db_connect.group_count')
+@patch('data.db_connect.count')
+def test_stats_endpoint(mock_count, mock_group_count, no_stats_cache):
     """Test GET /stats endpoint"""
-    mock_countries.return_value = []
-    mock_states.return_value = []
-    mock_cities.return_value = []
-    mock_counties.return_value = []
+    mock_count.return_value = 3
+    mock_group_count.return_value = {'NY': 2, None: 1}
 
     resp = TEST_CLIENT.get('/stats')
     assert resp.status_code == OK
     resp_json = resp.get_json()
-    assert 'countries' in resp_json
-    assert 'states' in resp_json
-    assert 'cities' in resp_json
-    assert 'counties' in resp_json
+    assert resp_json['countries'] == 3
+    assert resp_json['states'] == 3
+    assert resp_json['cities'] == 3
+    assert resp_json['counties'] == 3
+    assert resp_json['cities_per_state'] == {'NY': 2, 'None': 1}
+    assert mock_group_count.call_args_list[0].args == ('cities',
+                                                       'state_code')
+
+
+@patch('data.db_connect.group_count', return_value={})
+@patch('data.db_connect.count', return_value=0)
+def test_stats_cached(mock_count, mock_group_count, no_stats_cache):
+    """Test GET /stats reuses its result for STATS_TTL seconds"""
+    TEST_CLIENT.get('/stats')
+    TEST_CLIENT.get('/stats')
+    assert mock_count.call_count == 4
+    ep.stats_cache[ep.STATS_AT] -= ep.STATS_TTL
+    TEST_CLIENT.get('/stats')
+    assert mock_count.call_count == 8
+
+
+def test_cache_endpoint():
+    """Test GET /cache reports each entity cache"""
+    resp = TEST_CLIENT.get('/cache')
+    assert resp.status_code == OK
+    resp_json = resp.get_json()
+    assert 'hits' in resp_json['cities']
+    assert 'evictions' in resp_json['countries']
 
 
 def test_health_endpoint():
@@ -397,4 +432,318 @@ def test_endpoints_list():
     assert resp.status_code == OK
     resp_json = resp.get_json()
     assert 'Available endpoints' in resp_json
-    assert isinstance(resp_json['Available endpoints'], list)
\ No newline at end of file
+    assert isinstance(resp_json['Available endpoints'], list)
+
+
+@patch('cities.queries_cities.read')
+def test_get_cities_filter_and_fields(mock_read):
+    """Test GET /cities passes filters and fields down to the query module"""
+    mock_read.return_value = [{'name': 'Albany'}]
+    resp = TEST_CLIENT.get('/cities?state_code=NY&fields=name,population')
+    assert resp.status_code == OK
+    mock_read.assert_called_once_with(filt={'state_code': 'NY'},
+                                      fields=['name', 'population'],
+                                      sort=ep.NAME_SORT, collation=None)
+
+
+@patch('cities.queries_cities.read_json_iter')
+def test_get_cities_ndjson(mock_read_iter):
+    """Test GET /cities streams NDJSON when asked for it"""
+    mock_read_iter.return_value = iter(['{"name": "Albany"}',
+                                        '{"name": "Buffalo"}'])
+    resp = TEST_CLIENT.get('/cities',
+                           headers={'Accept': ep.NDJSON_MIME})
+    assert resp.status_code == OK
+    assert resp.mimetype == ep.NDJSON_MIME
+    lines = resp.get_data(as_text=True).splitlines()
+    assert [json.loads(line) for line in lines] == [{'name': 'Albany'},
+                                                    {'name': 'Buffalo'}]
+    assert mock_read_iter.call_args.kwargs['sort'] == ep.NAME_SORT
+
+
+@patch('cities.queries_cities.read')
+def test_get_cities_sort(mock_read):
+    """Test GET /cities?sort= pushes an indexed, multi-key sort down"""
+    mock_read.return_value = [{'name': 'B'}, {'name': 'A'}]
+    resp = TEST_CLIENT.get('/cities?sort=-state_code,-name')
+    assert resp.status_code == OK
+    # returned in the db's order, not re-sorted
+    assert resp.get_json()['cities'] == [{'name': 'B'}, {'name': 'A'}]
+    assert mock_read.call_args.kwargs['sort'] == [
+        ('state_code', ep.dbc.DESCENDING), ('name', ep.dbc.DESCENDING)]
+    assert mock_read.call_args.kwargs['collation'] is None
+
+
+@pytest.fixture
+def shared_caches(tmp_path):
+    """The entity caches shared, as between workers, so lists get ETags"""
+    if not ep.dcache.shared.available():
+        pytest.skip('needs fcntl')
+    caches = [ep.cities.city_cache, ep.states.state_cache,
+              ep.counties.county_cache, ep.countries.country_cache]
+    for cache in caches:
+        cache.share(str(tmp_path))
+    yield caches
+    for cache in caches:
+        cache.shared = cache.seen = None
+
+
+@patch('cities.queries_cities.read', return_value=[])
+def test_get_cities_no_etag_unshared(mock_read):
+    """Test lists carry no validators that other workers' writes miss"""
+    resp = TEST_CLIENT.get('/cities')
+    assert ep.ETAG not in resp.headers
+    assert ep.LAST_MODIFIED not in resp.headers
+    resp = TEST_CLIENT.get('/cities', headers={'If-None-Match': '*'})
+    assert resp.status_code == OK
+
+
+@patch('cities.queries_cities.read', return_value=[])
+def test_get_cities_etag(mock_read, shared_caches):
+    """Test GET /cities answers If-None-Match without reading"""
+    resp = TEST_CLIENT.get('/cities')
+    etag = resp.headers[ep.ETAG]
+    resp = TEST_CLIENT.get('/cities', headers={'If-None-Match': etag})
+    assert resp.status_code == NOT_MODIFIED
+    assert mock_read.call_count == 1
+    ep.cities.city_cache.bump()  # as any write does
+    resp = TEST_CLIENT.get('/cities', headers={'If-None-Match': etag})
+    assert resp.status_code == OK
+    assert resp.headers[ep.ETAG] != etag
+
+
+@patch('cities.queries_cities.read', return_value=[])
+def test_bad_params_not_hidden_by_304(mock_read, shared_caches):
+    """Test a bad query string is a 400 even when the list is current"""
+    etag = TEST_CLIENT.get('/cities').headers[ep.ETAG]
+    resp = TEST_CLIENT.get('/cities?limit=0',
+                           headers={'If-None-Match': etag})
+    assert resp.status_code == BAD_REQUEST
+
+
+@patch('states.queries_states.read', return_value=[])
+def test_get_states_if_modified_since(mock_read, shared_caches):
+    """Test GET /states answers If-Modified-Since"""
+    now = ep.time.time()
+    with patch('endpoints.time.time', return_value=now + 2):
+        resp = TEST_CLIENT.get('/states')
+        since = resp.headers[ep.LAST_MODIFIED]
+        resp = TEST_CLIENT.get('/states',
+                               headers={'If-Modified-Since': since})
+    assert resp.status_code == NOT_MODIFIED
+    assert mock_read.call_count == 1
+
+
+@patch('states.queries_states.read', return_value=[])
+def test_no_last_modified_in_its_own_second(mock_read, shared_caches):
+    """Test a write later in the second a list was sent is not missed"""
+    now = ep.states.state_cache.last_modified()
+    with patch('endpoints.time.time', return_value=now):
+        resp = TEST_CLIENT.get('/states')
+    assert ep.LAST_MODIFIED not in resp.headers
+    since = ep.http_date(now)
+    ep.states.state_cache.bump()  # as any write does
+    resp = TEST_CLIENT.get('/states', headers={'If-Modified-Since': since})
+    assert resp.status_code == OK
+
+
+@patch('cities.queries_cities.read_range', return_value=[{'name': 'Buffalo'}])
+def test_get_cities_range(mock_read_range):
+    """Test GET /cities?from=&to= lists a range of names"""
+    resp = TEST_CLIENT.get('/cities?from=A&to=C&limit=5')
+    assert resp.status_code == OK
+    assert resp.get_json() == {'cities': [{'name': 'Buffalo'}]}
+    kwargs = mock_read_range.call_args.kwargs
+    assert (kwargs['start'], kwargs['end'], kwargs['limit']) == ('A', 'C', 5)
+
+
+def test_get_cities_range_after():
+    """Test a range can't be paged with after"""
+    resp = TEST_CLIENT.get('/cities?from=A&after=x')
+    assert resp.status_code == BAD_REQUEST
+
+
+@patch('cities.queries_cities.read', return_value=[{'name': 'Albany'}])
+def test_get_cities_cached_body(mock_read, shared_caches):
+    """Test a repeated list request reuses the encoded body until a write"""
+    first = TEST_CLIENT.get('/cities?state_code=NY')
+    again = TEST_CLIENT.get('/cities?state_code=NY')
+    assert again.data == first.data
+    assert again.get_json() == {'cities': [{'name': 'Albany'}]}
+    assert mock_read.call_count == 1
+    ep.cities.city_cache.bump()
+    TEST_CLIENT.get('/cities?state_code=NY')
+    assert mock_read.call_count == 2
+
+
+@patch('cities.queries_cities.read', return_value=[{'name': 'Albany'}])
+def test_cached_body_ignores_unread_params(mock_read, shared_caches):
+    """Test query parameters no list reads don't split the body cache"""
+    TEST_CLIENT.get('/cities?state_code=NY')
+    TEST_CLIENT.get('/cities?state_code=NY&utm_source=x')
+    assert mock_read.call_count == 1
+    TEST_CLIENT.get('/cities?state_code=CA')
+    assert mock_read.call_count == 2
+
+
+@patch('cities.queries_cities.read', return_value=[{'name': 'Albany'}])
+def test_cached_body_limits(mock_read, shared_caches):
+    """Test bodies expire, and aren't kept past the byte budget"""
+    with patch.object(ep, 'BODY_TTL', 0):
+        TEST_CLIENT.get('/cities')
+        TEST_CLIENT.get('/cities')
+    assert mock_read.call_count == 2
+    ep.body_cache.clear()
+    with patch.object(ep, 'BODY_CACHE_BYTES', 40):
+        TEST_CLIENT.get('/cities?state_code=NY')
+        TEST_CLIENT.get('/cities?state_code=CA')
+        assert 0 < ep.body_cache_bytes() <= 40
+        assert len(ep.body_cache) == 1  # the older body made room
+
+
+@patch('cities.queries_cities.read', return_value=[{'name': 'Albany'}])
+def test_cached_body_unshared(mock_read):
+    """Test one process reuses bodies until it writes, without ETags"""
+    resp = TEST_CLIENT.get('/cities')
+    assert ep.ETAG not in resp.headers
+    TEST_CLIENT.get('/cities')
+    assert mock_read.call_count == 1
+    ep.cities.city_cache.bump()  # as any write does
+    TEST_CLIENT.get('/cities')
+    assert mock_read.call_count == 2
+
+
+@patch('cities.queries_cities.read_json_iter')
+@patch('cities.queries_cities.read', return_value=[{'name': 'Albany'}])
+def test_stream_not_served_a_cached_body(mock_read, mock_read_iter):
+    """Test a streamed list isn't answered with a kept JSON body"""
+    mock_read_iter.return_value = iter(['{"name": "Albany"}'])
+    TEST_CLIENT.get('/cities')
+    resp = TEST_CLIENT.get('/cities', headers={'Accept': ep.NDJSON_MIME})
+    assert resp.mimetype == ep.NDJSON_MIME
+
+
+@patch('counties.queries_counties.read',
+       return_value=[{'name': f'County {i}'} for i in range(100)])
+def test_get_counties_gzip(mock_read):
+    """Test a big enough list is gzipped for clients that take it"""
+    resp = TEST_CLIENT.get('/counties', headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in resp.headers['Vary']
+    assert json.loads(gzip.decompress(resp.data))['counties'][99] == {
+        'name': 'County 99'}
+    resp = TEST_CLIENT.get('/counties')
+    assert 'Content-Encoding' not in resp.headers
+    assert len(resp.get_json()['counties']) == 100
+
+
+def test_etag_differs_for_ndjson(shared_caches):
+    """Test a streamed list doesn't share the JSON list's ETag"""
+    with patch('cities.queries_cities.read', return_value=[]):
+        etag = TEST_CLIENT.get('/cities').headers[ep.ETAG]
+    with patch('cities.queries_cities.read_json_iter', return_value=iter([])):
+        resp = TEST_CLIENT.get('/cities', headers={
+            'Accept': ep.NDJSON_MIME, 'If-None-Match': etag})
+    assert resp.status_code == OK
+
+
+def test_get_cities_ndjson_db_down():
+    """Test a streamed list of an unreachable db is a 503, not a
+    broken 200"""
+    down = ep.dbc.DBError('down')
+    down.__cause__ = ep.dbc.AutoReconnect('down')
+    with patch('cities.queries_cities.read_json_iter', side_effect=down):
+        resp = TEST_CLIENT.get('/cities',
+                               headers={'Accept': ep.NDJSON_MIME})
+    assert resp.status_code == 503
+
+
+@patch('cities.queries_cities.read')
+def test_get_cities_sort_ci(mock_read):
+    """Test GET /cities?collation=ci sorts by name without case"""
+    mock_read.return_value = []
+    resp = TEST_CLIENT.get('/cities?collation=ci')
+    assert resp.status_code == OK
+    assert mock_read.call_args.kwargs['sort'] == ep.NAME_SORT
+    assert mock_read.call_args.kwargs['collation'] == ep.dbc.CI_COLLATION
+
+
+def test_get_cities_sort_unindexed():
+    """Test GET /cities refuses sorts no index can deliver"""
+    for query in ['sort=population', 'sort=name,state_code',
+                  'sort=state_code,-name',
+                  'sort=state_code&collation=ci', 'collation=xx']:
+        resp = TEST_CLIENT.get(f'/cities?{query}')
+        assert resp.status_code == BAD_REQUEST, query
+
+
+@patch('cities.queries_cities.read_page')
+def test_get_cities_page(mock_read_page):
+    """Test GET /cities?limit=&after= returns one page and the next cursor"""
+    mock_read_page.return_value = ([{'name': 'Albany'}], 'abc')
+    resp = TEST_CLIENT.get('/cities?limit=1&after=xyz&state_code=NY')
+    assert resp.status_code == OK
+    assert resp.get_json() == {'cities': [{'name': 'Albany'}],
+                               ep.NEXT: 'abc'}
+    kwargs = mock_read_page.call_args.kwargs
+    assert kwargs['limit'] == 1
+    assert kwargs['after'] == 'xyz'
+    assert kwargs['filt'] == {'state_code': 'NY'}
+
+
+@patch('cities.queries_cities.read_page')
+def test_get_cities_page_needs_index(mock_read_page):
+    """Test a page is only read in an order an index ending in _id gives"""
+    mock_read_page.return_value = ([], None)
+    for query in ['sort=-name', 'sort=state_code,name', 'collation=ci']:
+        resp = TEST_CLIENT.get(f'/cities?limit=5&{query}')
+        assert resp.status_code == OK
+    resp = TEST_CLIENT.get('/cities?limit=5&sort=state_code')
+    assert resp.status_code == BAD_REQUEST
+    assert TEST_CLIENT.get('/cities?sort=state_code').status_code == OK
+
+
+def test_get_cities_bad_limit():
+    """Test GET /cities with a bad limit is a 400"""
+    for limit in ['0', 'ten', str(ep.MAX_PAGE_LIMIT + 1)]:
+        resp = TEST_CLIENT.get(f'/cities?limit={limit}')
+        assert resp.status_code == BAD_REQUEST
+
+
+@patch('cities.queries_cities.create_many')
+def test_bulk_create_cities(mock_create_many):
+    """Test POST /cities/bulk returns one result per record"""
+    mock_create_many.return_value = [{'id': 'a'}, {'error': 'bad'}]
+    resp = TEST_CLIENT.post('/cities/bulk',
+                            json={'records': [{}, {}], 'ordered': False})
+    assert resp.status_code == OK
+    assert resp.get_json()[ep.BULK_RESULTS] == [{'id': 'a'},
+                                                {'error': 'bad'}]
+    mock_create_many.assert_called_once_with([{}, {}], False)
+
+
+def test_bulk_create_cities_bad_body():
+    """Test POST /cities/bulk with something other than a list"""
+    resp = TEST_CLIENT.post('/cities/bulk', json={'records': 'nope'})
+    assert resp.status_code == BAD_REQUEST
+    assert 'error' in resp.get_json()
+
+
+@patch('counties.queries_counties.delete_many')
+def test_bulk_delete_counties(mock_delete_many):
+    """Test DELETE /counties/bulk"""
+    mock_delete_many.return_value = {'deleted': 1, 'errors': []}
+    resp = TEST_CLIENT.delete('/counties/bulk',
+                              json=[{'name': 'X', 'STATE_CODE': 'NY'}])
+    assert resp.status_code == OK
+    assert resp.get_json()['deleted'] == 1
+
+
+@patch('cities.queries_cities.read')
+def test_get_cities_db_down(mock_read):
+    """Test GET /cities is a 503 when the circuit breaker is open"""
+    from data.db_connect import CircuitOpenError
+    mock_read.side_effect = CircuitOpenError('down')
+    resp = TEST_CLIENT.get('/cities')
+    assert resp.status_code == SERVICE_UNAVAILABLE
+    assert 'Retry-After' in resp.headers
@@ -1,4 +1,4 @@
-from functools import wraps
+import data.cache as dcache
 import data.db_connect as dbc
 
 COLLECTION = 'states'
@@ -12,6 +12,9 @@ GOVERNOR = 'governor'
 COUNTRY_CODE = 'country_code'
 CODE = 'code'
 
+# bulk update items look like {ID: ..., FIELDS: {...}}
+FIELDS = 'fields'
+
 SAMPLE_STATE = {
     NAME: 'New York',
     POPULATION: 19870000,
@@ -21,22 +24,28 @@ SAMPLE_STATE = {
     CODE: 'NY'
 }
 
-state_cache = {
-    "1": SAMPLE_STATE,
-}
+INDEXES = [
+    {dbc.INDEX_KEYS: [(ID, dbc.ASCENDING)]},
+    # the sorts we page through end in _id: see `dbc.page_sort()`
+    {dbc.INDEX_KEYS: [(NAME, dbc.ASCENDING), (dbc.MONGO_ID, dbc.ASCENDING)]},
+    # for ?collation=ci
+    {dbc.INDEX_KEYS: [(NAME, dbc.ASCENDING), (dbc.MONGO_ID, dbc.ASCENDING)],
+     dbc.INDEX_COLLATION: dbc.CI_COLLATION},
+    {dbc.INDEX_KEYS: [(COUNTRY_CODE, dbc.ASCENDING),
+                      (NAME, dbc.ASCENDING), (dbc.MONGO_ID, dbc.ASCENDING)]},
+]
+dbc.register_indexes(COLLECTION, INDEXES)
 
+# what the cache keeps a slot for in each record
+RECORD_FIELDS = (ID, NAME, POPULATION, CAPITAL, GOVERNOR,
+                 COUNTRY_CODE, CODE)
 
-def needs_cache(fn):
-    @wraps(fn)
-    def wrapper(*args, **kwargs):
-        if not state_cache:
-            docs = dbc.read(COLLECTION)
-            for doc in docs:
-                state_id = doc.get(ID)
-                if state_id is not None:
-                    state_cache[state_id] = doc
-        return fn(*args, **kwargs)
-    return wrapper
+state_cache = dcache.EntityCache(COLLECTION, id_field=ID,
+                                 index_on=[(NAME,), (COUNTRY_CODE,)],
+                                 record_fields=RECORD_FIELDS,
+                                 sorted_on=NAME)
+needs_cache = dcache.needs_cache(state_cache)
+writes = dcache.writes(state_cache)
 
 
 def is_valid_id(_id: str):
@@ -68,7 +77,7 @@ def num_states():
     return len(state_cache)
 
 
-def create(fields: dict):
+def validate_create(fields: dict):
     if (not isinstance(fields, dict)):
         raise ValueError(f'Bad type for {type(fields)=}')
     if (not fields.get(NAME) or not isinstance(fields[NAME], str)):
@@ -80,17 +89,83 @@ def create(fields: dict):
     if (not fields.get(COUNTRY_CODE) or
             not isinstance(fields[COUNTRY_CODE], str)):
         raise ValueError(f'Bad value for {fields.get(COUNTRY_CODE)=}')
+
+
+@writes
+def create(fields: dict):
+    validate_create(fields)
     new_id = dbc.create(COLLECTION, fields)
-    state_cache[new_id] = fields
+    state_cache[new_id] = dcache.record(fields)
     return new_id
 
 
-@needs_cache
-def read(state_id=None):
-    return dbc.read(COLLECTION)
+def read(state_id=None, filt=None, fields=None, sort=None, limit=0,
+         collation=None):
+    """
+    With an id, the one state (or None), from the cache if we can.
+    Otherwise filter, projection, sort and limit are all passed down to
+    the db.
+    """
+    if state_id is not None:
+        return state_cache.fetch(state_id)
+    return dbc.read(COLLECTION, filt=filt, fields=fields, sort=sort,
+                    limit=limit, collation=collation)
 
 
-def update(state_id: str, fields: dict):
+def read_range(start=None, end=None, filt=None, fields=None, sort=None,
+               limit=0, collation=None) -> list:
+    """
+    The states named from `start` up to (not including) `end`; see
+    `dcache.read_range()`.
+    """
+    return dcache.read_range(state_cache, start=start, end=end, filt=filt,
+                             fields=fields, sort=sort, limit=limit,
+                             collation=collation)
+
+
+def read_iter(filt=None, fields=None, sort=None, limit=0, collation=None):
+    """
+    Stream docs from the db rather than building a list.
+    """
+    return dbc.read_iter(COLLECTION, filt=filt, fields=fields, sort=sort,
+                         limit=limit, collation=collation)
+
+
+def read_json_iter(filt=None, fields=None, sort=None, limit=0,
+                   collation=None):
+    """
+    Stream docs as JSON strings, never decoding them into dicts if we
+    can help it; see `dbc.read_json_iter()`.
+    """
+    return dbc.read_json_iter(COLLECTION, filt=filt, fields=fields,
+                              sort=sort, limit=limit, collation=collation)
+
+
+def read_page(filt=None, fields=None, sort=None,
+              limit=dbc.DEFAULT_PAGE_SIZE, after=None,
+              collation=None) -> tuple:
+    """
+    One page of docs, plus the cursor for the next; see `dbc.read_page()`.
+    """
+    return dbc.read_page(COLLECTION, filt=filt, fields=fields, sort=sort,
+                         limit=limit, after=after, collation=collation)
+
+
+def count(filt=None) -> int:
+    """
+    Counted by the db, without fetching any docs.
+    """
+    return dbc.count(COLLECTION, filt=filt)
+
+
+def count_by(field: str, filt=None) -> dict:
+    """
+    {value of `field`: number of docs}, grouped by the db.
+    """
+    return dbc.group_count(COLLECTION, field, filt=filt)
+
+
+def validate_update(state_id: str, fields: dict):
     if not isinstance(fields, dict):
         raise ValueError(f'Bad type for {type(fields)=}')
     if not state_id or not isinstance(state_id, str):
@@ -116,19 +191,95 @@ def update(state_id: str, fields: dict):
                                not isinstance(fields[GOVERNOR], str)):
         raise ValueError(f'Bad value for {fields.get(GOVERNOR)=}')
 
+
+@writes
+def update(state_id: str, fields: dict):
+    validate_update(state_id, fields)
     result = dbc.update(COLLECTION, {ID: state_id}, fields)
     if result < 1:
         raise ValueError(f'State not found: {state_id}')
 
-    # Update cache
-    if state_cache and state_id in state_cache:
-        state_cache[state_id].update(fields)
-
+    update_cache(state_id, fields)
     return result
 
 
+def update_cache(state_id: str, fields: dict):
+    state_cache.update_one({ID: state_id}, fields)
+
+
+@writes
 def delete(state_id: str):
-    if state_id not in state_cache:
-        raise ValueError(f'No such state: {state_id}')
-    del state_cache[state_id]
-    return True
+    """
+    Delete the state that `read(state_id)` finds: by `_id`, else by ID.
+    """
+    for filt in state_cache.lookups(state_id):
+        if dbc.delete(COLLECTION, filt) > 0:
+            drop_cache(filt)
+            return True
+    raise ValueError(f'State not found: {state_id}')
+
+
+def drop_cache(filt: dict):
+    if dbc.MONGO_ID in filt:
+        state_cache.pop(str(filt[dbc.MONGO_ID]))
+    else:
+        state_cache.delete_one(filt)
+
+
+@writes
+def create_many(recs: list, ordered: bool = True) -> list:
+    """
+    Validate and insert a batch of states in one go.
+    Returns one result per record: {dbc.BULK_ID: ...} or
+    {dbc.BULK_ERROR: ...}.
+    """
+    results = dbc.create_many(COLLECTION, recs, ordered=ordered,
+                              validate=validate_create)
+    state_cache.update({res[dbc.BULK_ID]: dcache.record(rec)
+                        for rec, res in zip(recs, results)
+                        if dbc.BULK_ID in res})
+    return results
+
+
+def update_op(item: dict) -> tuple:
+    if not isinstance(item, dict):
+        raise ValueError(f'Bad type for {type(item)=}')
+    validate_update(item.get(ID), item.get(FIELDS))
+    return (dbc.UPDATE, {ID: item[ID]}, item[FIELDS])
+
+
+@writes
+def update_many(items: list, ordered: bool = True) -> dict:
+    """
+    Apply a batch of {ID: ..., FIELDS: {...}} updates with one
+    bulk write, then bring the cache up to date.
+    """
+    ret = dbc.bulk_write(COLLECTION, items, ordered=ordered,
+                         make_op=update_op)
+    failed = {err[dbc.BULK_INDEX] for err in ret[dbc.BULK_ERRORS]}
+    for i, item in enumerate(items):
+        if i not in failed:
+            update_cache(item[ID], item[FIELDS])
+    return ret
+
+
+def delete_op(item: dict) -> tuple:
+    if not isinstance(item, dict):
+        raise ValueError(f'Bad type for {type(item)=}')
+    if not is_valid_id(item.get(ID)):
+        raise ValueError(f'Bad value for {item.get(ID)=}')
+    return (dbc.DELETE, {ID: item[ID]})
+
+
+@writes
+def delete_many(items: list, ordered: bool = True) -> dict:
+    """
+    Delete a batch of {ID: ...} states with one bulk write.
+    """
+    ret = dbc.bulk_write(COLLECTION, items, ordered=ordered,
+                         make_op=delete_op)
+    failed = {err[dbc.BULK_INDEX] for err in ret[dbc.BULK_ERRORS]}
+    for i, item in enumerate(items):
+        if i not in failed:
+            state_cache.delete_one({ID: item[ID]})
+    return ret
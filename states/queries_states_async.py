@@ -0,0 +1,46 @@
+"""
+Coroutine versions of the queries in queries_states.py, for use from an
+async worker. Validation and the cache are shared with that module.
+"""
+import data.cache as dcache
+import data.db_connect_async as dbca
+import states.queries_states as qry
+
+
+@qry.writes
+async def create(fields: dict):
+    qry.validate_create(fields)
+    new_id = await dbca.create(qry.COLLECTION, fields)
+    qry.state_cache[new_id] = dcache.record(fields)
+    return new_id
+
+
+async def read(state_id=None, filt=None, fields=None, sort=None, limit=0,
+               collation=None):
+    """
+    With an id, the one state (or None), from the cache if we can.
+    Otherwise everything is passed down to the db.
+    """
+    if state_id is not None:
+        return await qry.state_cache.fetch_async(state_id)
+    return await dbca.read(qry.COLLECTION, filt=filt, fields=fields,
+                           sort=sort, limit=limit, collation=collation)
+
+
+@qry.writes
+async def update(state_id: str, fields: dict):
+    qry.validate_update(state_id, fields)
+    result = await dbca.update(qry.COLLECTION, {qry.ID: state_id}, fields)
+    if result < 1:
+        raise ValueError(f'State not found: {state_id}')
+    qry.update_cache(state_id, fields)
+    return result
+
+
+@qry.writes
+async def delete(state_id: str):
+    for filt in qry.state_cache.lookups(state_id):
+        if await dbca.delete(qry.COLLECTION, filt) > 0:
+            qry.drop_cache(filt)
+            return True
+    raise ValueError(f'State not found: {state_id}')
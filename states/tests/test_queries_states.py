@@ -163,6 +163,13 @@ def test_delete_not_there():
     with pytest.raises(ValueError):
         qry.delete('a state that has not yet been created')
 
+
+def test_delete_removes_from_db():
+    new_id = qry.create(create_temp_state())
+    qry.delete(new_id)
+    assert new_id not in qry.state_cache
+    assert qry.read(new_id) is None  # not in the db either
+
 '''
 def test_delete(temp_city,city_delta):
     
@@ -0,0 +1,45 @@
+import asyncio
+from copy import deepcopy
+from unittest.mock import AsyncMock, patch
+
+import pytest
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import queries_states_async as aqry
+
+qry = aqry.qry
+
+
+@patch('data.db_connect_async.create', new_callable=AsyncMock)
+def test_create(mock_create):
+    mock_create.return_value = 'async-id'
+    state = deepcopy(qry.SAMPLE_STATE)
+    assert asyncio.run(aqry.create(state)) == 'async-id'
+    assert qry.state_cache['async-id'] == state
+    del qry.state_cache['async-id']
+
+
+def test_create_bad_capital():
+    state = deepcopy(qry.SAMPLE_STATE)
+    state[qry.CAPITAL] = 12
+    with pytest.raises(ValueError):
+        asyncio.run(aqry.create(state))
+
+
+def test_delete_not_there():
+    with pytest.raises(ValueError):
+        asyncio.run(aqry.delete('a state that has not yet been created'))
+
+
+@patch('data.db_connect_async.read_one', new_callable=AsyncMock)
+def test_read_by_id(mock_read_one):
+    oid = '5f1d7f1e9d3b2a00123456a3'
+    mock_read_one.return_value = {qry.dbc.MONGO_ID: oid, **qry.SAMPLE_STATE}
+    assert asyncio.run(aqry.read(oid)) == qry.SAMPLE_STATE
+    assert asyncio.run(aqry.read(oid)) == qry.SAMPLE_STATE  # now cached
+    mock_read_one.assert_called_once()
+    del qry.state_cache[oid]